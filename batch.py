@@ -0,0 +1,189 @@
+#!.venv/bin/python3
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import configure_cache
+from http_client import configure_client, shared_rate_state
+from main import add_pipeline_arguments, pipeline_options, valid_email
+
+# read_manifest() takes in an arg: manifest filepath (.json, .csv or .tsv).
+# Function: Read the list of jobs. Each job needs "family", "taxon", "sample_size" and "scan_size", and may set "name".
+# A JSON manifest is a list of job objects. A CSV/TSV manifest has a header row with those column names.
+# Output: List of job dicts, each with a unique name.
+def read_manifest(manifest_path):
+    if manifest_path.endswith(".json"):
+        with open(manifest_path, "r") as file:
+            jobs = json.load(file)
+    else:
+        delimiter = "," if manifest_path.endswith(".csv") else "\t"
+        with open(manifest_path, "r", newline = "") as file:
+            jobs = [row for row in csv.DictReader(file, delimiter = delimiter) if any((v or "").strip() for v in row.values())]
+
+    names = set()
+    for i, job in enumerate(jobs):
+        if not job.get("family") or not job.get("taxon"):
+            raise ValueError(f"Job {i + 1} in {manifest_path} needs both a family and a taxon.")
+        normalize_job(job)
+        # Jobs run without a terminal, so the sizes cannot be prompted for.
+        if job["sample_size"] is None or job["scan_size"] is None:
+            raise ValueError(f"Job {i + 1} in {manifest_path} needs both a sample_size and a scan_size.")
+        if job["name"] in names:
+            job["name"] = f"{job['name']}_{i + 1}"
+        names.add(job["name"])
+    return jobs
+
+# normalize_job() takes in an arg: job dict.
+# Function: Convert sample_size and scan_size to int (None if blank), and name the job after its family and taxon if it has no name.
+# The name becomes the job's directory, so it is reduced to word characters, dots and dashes, without leading or trailing dots (so never ".." or hidden).
+# Names left empty raise ValueError.
+# Output: The job dict.
+def normalize_job(job):
+    for key in ["sample_size", "scan_size"]:
+        job[key] = int(job[key]) if str(job.get(key) or "").strip() else None
+    name = str(job.get("name") or f"{job['family']}_{job['taxon']}")
+    job["name"] = re.sub(r"[^\w.-]+", "_", name).strip(".")
+    if not job["name"]:
+        raise ValueError(f"Invalid job name: {name}")
+    return job
+
+# run_job() takes in 5 args: job dict, batch output directory, email, pipeline tuning options and response cache settings.
+# Function: Run one pipeline job in its own directory, inside a worker process.
+# The worker changes into the job directory, so every job keeps its own out_dir, and redirects stdout/stderr (including external tools) to the job log.
+# Output: Dict of job status and timing.
+def run_job(job, batch_dir, email, options, cache_kwargs):
+    from input_handler import validate_inputs
+    from main import run_pipeline
+
+    configure_cache(**cache_kwargs)
+    job_dir = os.path.join(batch_dir, job["name"])
+    os.makedirs(job_dir, exist_ok = True)
+    os.chdir(job_dir)
+    result = {
+        "name" : job["name"],
+        "family" : job["family"],
+        "taxon" : job["taxon"],
+        "status" : "ok",
+        "seconds" : 0.0,
+        "out_dir" : "",
+        "error" : ""
+    }
+    start = time.time()
+    with open("job.log", "w") as log, redirect_fds(log):
+        try:
+            (pfam_id, pfam_name), (taxon_id, taxon_name) = validate_inputs(job["family"], job["taxon"], email)
+            out_dir = run_pipeline(email, pfam_name, taxon_id, taxon_name, job["sample_size"], job["scan_size"], interactive = False, **options)
+            result["out_dir"] = os.path.join(job_dir, out_dir)
+        except BaseException as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["error"] = str(e) or type(e).__name__
+    result["seconds"] = round(time.time() - start, 2)
+    return result
+
+# redirect_fds() takes in an arg: open log file.
+# Function: Point file descriptors 1 and 2 at the log file, so output of external tools is captured too, and restore them afterwards.
+@contextlib.contextmanager
+def redirect_fds(log):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+# write_summary() takes in 2 args: list of job results and summary filepath.
+# Function: Write the per-job status and timing table as TSV.
+def write_summary(results, summary_path):
+    fields = ["name", "family", "taxon", "status", "seconds", "out_dir", "error"]
+    with open(summary_path, "w", newline = "") as file:
+        writer = csv.DictWriter(file, fieldnames = fields, delimiter = "\t")
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key : str(result[key]).replace("\t", " ").replace("\n", " ") for key in fields})
+
+# worker_options() takes in 3 args: pipeline tuning options, number of worker processes and CPU thread cap.
+# Function: Split the CPU thread cap evenly between workers, as each job's threads and CPU budget, and make shared paths absolute,
+# as every job runs in its own directory.
+# Output: Dict of tuning options for the jobs.
+def worker_options(options, workers, max_threads):
+    share = max(1, max_threads // workers)
+    return {**options, "threads" : share, "cpu_budget" : share, "prosite_dat" : os.path.abspath(options["prosite_dat"]), "blast_store_dir" : os.path.abspath(options["blast_store_dir"]), "catalogue_dir" : os.path.abspath(options["catalogue_dir"])}
+
+# init_worker() takes in an arg: dict of host to shared rate limiter state.
+# Function: Give the worker process a HttpClient whose rate limiters are shared with the other workers.
+def init_worker(shared):
+    configure_client(shared = shared)
+
+# run_batch() takes in 7 args: list of jobs, batch output directory, email, number of worker processes, CPU thread cap, pipeline tuning options and response cache settings.
+# Function: Schedule jobs across a process pool. The CPU thread cap is split evenly between workers, as each job's threads and CPU budget,
+# so clustalo and blastp never use more threads in total, even with a job's stages running concurrently.
+# The workers share one rate limiter per host, so the jobs together send NCBI requests at its full permitted rate, and no faster.
+# Output: List of job results, in manifest order.
+def run_batch(jobs, batch_dir, email, workers, max_threads, options, cache_kwargs):
+    batch_dir = os.path.abspath(batch_dir)
+    os.makedirs(batch_dir, exist_ok = True)
+    # At least one thread per worker, so no more workers than the thread cap.
+    workers = max(1, min(workers, len(jobs), max_threads))
+    options = worker_options(options, workers, max_threads)
+    print(f"Running {len(jobs)} jobs on {workers} workers with {options['threads']} threads each...")
+
+    results = {}
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (shared_rate_state(),)) as executor:
+        futures = {executor.submit(run_job, job, batch_dir, email, options, cache_kwargs): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name" : job["name"], "family" : job["family"], "taxon" : job["taxon"], "status" : "failed", "seconds" : 0.0, "out_dir" : "", "error" : str(e)}
+            results[job["name"]] = result
+            print(f"[{len(results)}/{len(jobs)}] {result['name']}: {result['status']} in {result['seconds']}s {result['error']}")
+    return [results[job["name"]] for job in jobs]
+
+# build_parser() takes in no args.
+# Function: Define the command line switches of batch mode.
+# Output: argparse parser.
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Run many (protein family, taxon) pipeline jobs in parallel, without prompts.")
+    parser.add_argument("manifest", help = "Job manifest (.json list, or .csv/.tsv with columns family, taxon, sample_size, scan_size, name).")
+    parser.add_argument("--email", required = True, help = "Email sent with NCBI requests.")
+    parser.add_argument("--out", default = "batch_runs", help = "Batch output directory, one subdirectory per job (default: %(default)s).")
+    parser.add_argument("--workers", type = int, default = max(1, (os.cpu_count() or 1) // 4), help = "Number of jobs run at once.")
+    parser.add_argument("--max-threads", type = int, default = os.cpu_count() or 1, help = "Total CPU threads given to external tools across all jobs.")
+    add_pipeline_arguments(parser)
+    return parser
+
+# main() takes in an optional arg: list of command line arguments.
+# Function: Run a batch from a manifest and write batch_summary.tsv in the batch output directory.
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    if not valid_email(args.email):
+        sys.exit("Please input a valid email.")
+
+    jobs = read_manifest(args.manifest)
+    cache_kwargs = {"cache_dir" : os.path.abspath(args.cache_dir), "offline" : args.offline, "enabled" : not args.no_cache}
+    results = run_batch(jobs, args.out, args.email, args.workers, args.max_threads, pipeline_options(args), cache_kwargs)
+    summary_path = os.path.join(os.path.abspath(args.out), "batch_summary.tsv")
+    write_summary(results, summary_path)
+    failed = sum(result["status"] != "ok" for result in results)
+    print(f"\n{len(results) - failed} of {len(results)} jobs completed. Summary written to {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!.venv/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+import warnings
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+from parse_fasta import iter_fasta, parse_fasta
+from record_store import RecordStore
+from conservation_analysis import build_clustalo_input
+from conservation_engine import run_conservation_engine
+from scan_prosite import parse_clu_results, build_prosite_input, parse_prosite_output
+from blast_analysis import parse_blast_output, parse_blast_hits
+from plotting import get_pyplot
+
+# measure() takes in 2 args: function of no args and whether to trace memory.
+# Function: Time one call of the function, then (if asked) call it again under tracemalloc for its peak Python/numpy allocation.
+# Progress messages printed by the function are discarded.
+# Output: Tuple of elapsed seconds and peak allocated MB (None if not traced).
+def measure(func, memory = True):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if not memory:
+            return elapsed, None
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return elapsed, peak
+
+# prepare() takes in 4 args: out_dir, number of records, fraction of records selected for alignment and scanning, and random seed.
+# Function: Generate the synthetic inputs of every hot path: raw FASTA, the record store, a Clustal alignment and infoalign results,
+# patmatmotifs reports and blastp tabular output.
+# Output: Dict of the inputs.
+def prepare(scratch, n, fraction, seed):
+    shutil.rmtree(scratch, ignore_errors = True)
+    for directory in ["clustalo", "prosite", "blast"]:
+        os.makedirs(f"{scratch}/{directory}")
+    records = synthetic.make_records(n, seed)
+    selected = records[:max(1, int(n * fraction))]
+    uids = [entry["uid"] for entry in records]
+    synthetic.write_fasta_file(records, f"{scratch}/raw.fasta")
+    store = RecordStore.build(records, f"{scratch}/records")
+    synthetic.write_clustal(selected, f"{scratch}/clustalo/aligned.clu", seed = seed)
+    synthetic.write_infoalign(uids, f"{scratch}/clustalo/infoalign.txt", seed)
+    os.makedirs(f"{scratch}/reports")
+    reports = synthetic.write_patmatmotifs([entry["uid"] for entry in selected], f"{scratch}/reports", seed)
+    synthetic.write_blast_tab([uids[0]], uids, f"{scratch}/blast/blast.out", hits_per_query = n, seed = seed)
+    return {"store" : store, "selected" : selected, "reports" : reports}
+
+# hot_paths() takes in 3 args: out_dir, number of records and prepared inputs.
+# Output: List of (name, items processed, input bytes, function) tuples, one per hot path.
+def hot_paths(scratch, n, inputs):
+    store = inputs["store"]
+    size = len(inputs["selected"])
+
+    def prosite_reports():
+        shutil.rmtree(f"{scratch}/prosite", ignore_errors = True)
+        shutil.copytree(f"{scratch}/reports", f"{scratch}/prosite")
+
+    def blast_hits():
+        shutil.copy(f"{scratch}/blast/blast.out", f"{scratch}/blast/shard.tsv")
+        parse_blast_hits(scratch, "blast", ["shard.tsv"], 10.0, False)
+
+    prosite_reports()
+    size_of = lambda path: os.path.getsize(f"{scratch}/{path}")
+    return [
+        ("parse_fasta", n, size_of("raw.fasta"), lambda: parse_fasta(scratch, "raw.fasta")),
+        ("record_store_build", n, size_of("raw.fasta"), lambda: RecordStore.build(iter_fasta(f"{scratch}/raw.fasta"), f"{scratch}/records_bench")),
+        ("build_clustalo_input", n, size_of("records/sequence.bin"), lambda: build_clustalo_input(store, scratch, "clustalo", size)),
+        ("conservation_engine", size, size_of("clustalo/aligned.clu"), lambda: run_conservation_engine(scratch, "clustalo", "aligned.clu", False)),
+        ("parse_clu_results", n, size_of("clustalo/infoalign.txt"), lambda: parse_clu_results(store, scratch, "clustalo", "infoalign.txt", "prosite", size)),
+        ("build_prosite_input", size, 0, lambda: build_prosite_input(inputs["selected"], scratch, "prosite")),
+        ("parse_prosite_output", size, sum(os.path.getsize(f"{scratch}/reports/{file}") for file in inputs["reports"]), lambda: parse_prosite_output(scratch, "prosite", inputs["reports"], False)),
+        ("parse_blast_output", n, size_of("blast/blast.out"), lambda: parse_blast_output(scratch, "blast", "blast.out", False)),
+        ("parse_blast_hits", n, size_of("blast/blast.out"), blast_hits)
+    ]
+
+# main() takes in no args.
+# Function: Time the Python-side hot paths on seeded synthetic data at each scale, and report throughput and peak memory.
+# With --baseline, compare against a previous --json result and exit 1 if any hot path got slower than the tolerance.
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the pipeline's Python hot paths on synthetic data.")
+    parser.add_argument("--scales", nargs = "+", default = ["1k", "10k"], choices = list(synthetic.SCALES), help = "Dataset sizes (default: %(default)s).")
+    parser.add_argument("--only", nargs = "+", help = "Run only these hot paths.")
+    parser.add_argument("--fraction", type = float, default = 0.1, help = "Fraction of records aligned and scanned for PROSITE motifs (default: %(default)s).")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--no-memory", action = "store_true", help = "Skip the tracemalloc pass.")
+    parser.add_argument("--scratch", default = "bench_hot_paths")
+    parser.add_argument("--json", help = "Write the results to this JSON file.")
+    parser.add_argument("--baseline", help = "JSON results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type = float, default = 1.5, help = "Slowdown factor against the baseline that counts as a regression (default: %(default)s).")
+    parser.add_argument("--min-seconds", type = float, default = 0.05, help = "Ignore slowdowns smaller than this many seconds, as timer noise (default: %(default)s).")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", FutureWarning)
+    # Import the lazily loaded tabular and plotting libraries up front, so their import time is not charged to the first hot path.
+    import pandas, seaborn
+    get_pyplot()
+
+    # Stage functions name their files after out_dir, so each scale runs inside its own scratch directory with a plain out_dir.
+    root = os.getcwd()
+    results = []
+    print(f"{'scale':<6}{'hot path':<22}{'items':>8}{'seconds':>10}{'items/s':>12}{'MB/s':>9}{'peak MB':>9}")
+    for scale in args.scales:
+        n = synthetic.SCALES[scale]
+        os.makedirs(os.path.join(root, args.scratch, scale), exist_ok = True)
+        os.chdir(os.path.join(root, args.scratch, scale))
+        inputs = prepare("bench", n, args.fraction, args.seed)
+        for name, items, input_bytes, func in hot_paths("bench", n, inputs):
+            if args.only and name not in args.only:
+                continue
+            elapsed, peak = measure(func, not args.no_memory)
+            results.append({"scale" : scale, "name" : name, "items" : items, "seconds" : elapsed, "items_per_s" : items / elapsed, "mb_per_s" : input_bytes / 1e6 / elapsed, "peak_mb" : peak})
+            print(f"{scale:<6}{name:<22}{items:>8}{elapsed:>10.3f}{items / elapsed:>12.0f}{input_bytes / 1e6 / elapsed:>9.1f}{peak if peak is not None else float('nan'):>9.1f}")
+        os.chdir(root)
+    shutil.rmtree(args.scratch, ignore_errors = True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent = 2)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = {(result["scale"], result["name"]) : result["seconds"] for result in json.load(file)}
+        regressions = []
+        for result in results:
+            before = baseline.get((result["scale"], result["name"]))
+            if before is not None and result["seconds"] > args.tolerance * before and result["seconds"] - before > args.min_seconds:
+                regressions.append(result)
+        for result in regressions:
+            print(f"Regression: {result['name']} at {result['scale']} took {result['seconds']:.3f}s, baseline {baseline[(result['scale'], result['name'])]:.3f}s")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!.venv/bin/python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import synthetic
+
+# make_handler() takes in an arg: list of protein sequence dicts.
+# Function: Build an E-utilities stand-in serving the records: esearch returns the count with a history WebEnv,
+# efetch returns the retstart/retmax page of the records as FASTA (or their uids with rettype=acc), or the records of an id list.
+# Output: HTTP request handler class.
+def make_handler(records):
+    class EutilsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body):
+            body = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(json.dumps({"esearchresult" : {"count" : str(len(records)), "webenv" : "BENCHMARK", "querykey" : "1", "idlist" : []}}))
+
+        def do_POST(self):
+            params = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+            if "id" in params:
+                uids = set(params["id"][0].split(","))
+                self.reply(synthetic.fasta_text([entry for entry in records if entry["uid"] in uids]))
+                return
+            start = int(params["retstart"][0])
+            page = records[start:start + int(params["retmax"][0])]
+            if params["rettype"][0] == "acc":
+                self.reply("".join(f"{entry['uid']}\n" for entry in page))
+            else:
+                self.reply(synthetic.fasta_text(page))
+    return EutilsHandler
+
+# run_scale() takes in 6 args: number of records, working directory, random seed, sample size, scan size and pipeline options.
+# Function: In a fresh process, serve synthetic records from a local E-utilities stand-in, put the fake tools first on PATH,
+# and run the whole pipeline without prompts and without network access.
+# Output: List of stage and process events of the run's trace.
+def run_scale(n, work_dir, seed, sample_size, scan_size, options):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(synthetic.make_records(n, seed)))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    os.environ["NCBI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["NCBI_API_KEY"] = "benchmark"
+    os.environ["PATH"] = os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ["MPLBACKEND"] = "Agg"
+
+    from cache import configure_cache
+    from instrument import get_tracer
+    from main import run_pipeline
+    configure_cache(enabled = False)
+    os.makedirs(work_dir, exist_ok = True)
+    os.chdir(work_dir)
+    with open("pipeline.log", "w") as log:
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            run_pipeline("benchmark@example.org", "SyntheticFamily", "9606", "Synthetica", sample_size, scan_size, interactive = False, **options)
+        finally:
+            sys.stdout = stdout
+            server.shutdown()
+    return get_tracer().events
+
+# main() takes in no args.
+# Function: Run the full pipeline end to end on synthetic datasets, each scale in its own process, and report per-stage throughput (records/s) and peak memory.
+def main():
+    from main import add_pipeline_arguments, pipeline_options
+    parser = argparse.ArgumentParser(description = "Benchmark the whole pipeline offline, with a local NCBI stand-in and fake external tools.")
+    parser.add_argument("--scales", nargs = "+", default = ["1k", "10k"], choices = list(synthetic.SCALES), help = "Dataset sizes (default: %(default)s).")
+    parser.add_argument("--sample-size", type = int, default = 200, help = "Sequences aligned with ClustalO (default: %(default)s).")
+    parser.add_argument("--scan-size", type = int, default = 50, help = "Sequences scanned for PROSITE motifs (default: %(default)s).")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--scratch", default = "bench_pipeline")
+    parser.add_argument("--keep", action = "store_true", help = "Keep the pipeline outputs in the scratch directory.")
+    parser.add_argument("--json", help = "Write the trace events of every scale to this JSON file.")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+    options = {**pipeline_options(args), "fresh" : True}
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    print(f"{'scale':<6}{'stage':<14}{'status':<9}{'seconds':>9}{'records/s':>12}{'CPU s':>8}{'peak RSS MB':>13}")
+    for scale in args.scales:
+        n = synthetic.SCALES[scale]
+        work_dir = os.path.abspath(os.path.join(args.scratch, scale))
+        with context.Pool(1) as pool:
+            events = pool.apply(run_scale, (n, work_dir, args.seed, args.sample_size, args.scan_size, options))
+        results[scale] = events
+        stages = [event for event in events if event["type"] == "stage"]
+        for event in stages:
+            print(f"{scale:<6}{event['name']:<14}{event['status']:<9}{event['wall']:>9.3f}{n / max(event['wall'], 1e-9):>12.0f}{event['cpu']:>8.2f}{event['peak_rss_mb']:>13.1f}")
+        # Stages may overlap, so the total is the span from the first stage start to the last stage end.
+        total = max(event["start"] + event["wall"] for event in stages) - min(event["start"] for event in stages)
+        print(f"{scale:<6}{'total':<14}{'':<9}{total:>9.3f}{n / total:>12.0f}{'':>8}{max(event['peak_rss_mb'] for event in stages):>13.1f}")
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors = True)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!.venv/bin/python3
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scan_prosite import build_prosite_input, run_prosite_scan, parse_prosite_output
+
+# make_records() takes in 3 args: number of sequences, sequence length and random seed.
+# Output: List of random protein sequence dicts.
+def make_records(n, length, seed):
+    rng = random.Random(seed)
+    return [
+        {"uid" : f"SEQ{i:06d}.1", "description" : "synthetic protein", "species" : "Synthetica", "sequence" : "".join(rng.choices("ACDEFGHIKLMNPQRSTVWY", k = length)), "length" : length}
+        for i in range(n)
+    ]
+
+# bench() takes in 5 args: records, scratch directory, label, number of workers and chunk size.
+# Function: Time build_prosite_input() and run_prosite_scan() for one scan mode, then parse the results.
+# Output: Elapsed seconds and the parsed summary table.
+def bench(records, scratch, label, workers, chunk_size):
+    out_prosite = label
+    shutil.rmtree(f"{scratch}/{out_prosite}", ignore_errors = True)
+    os.makedirs(f"{scratch}/{out_prosite}")
+    start = time.perf_counter()
+    prosite_input = build_prosite_input(records, scratch, out_prosite)
+    prosite_output = run_prosite_scan(scratch, out_prosite, prosite_input, workers, chunk_size)
+    elapsed = time.perf_counter() - start
+    summary_df, motifs = parse_prosite_output(scratch, out_prosite, prosite_output, False)
+    return elapsed, summary_df
+
+# main() takes in no args.
+# Function: Compare the serial patmatmotifs loop with the parallel and packed scan modes on the same synthetic sequences,
+# and check that every mode gives the same merged result.
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark PROSITE scan modes.")
+    parser.add_argument("-n", type = int, default = 500, help = "Number of sequences.")
+    parser.add_argument("--length", type = int, default = 400, help = "Sequence length.")
+    parser.add_argument("--workers", type = int, default = os.cpu_count() or 1)
+    parser.add_argument("--chunk", type = int, default = 50)
+    parser.add_argument("--scratch", default = "bench_prosite_scan")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+    if not shutil.which("patmatmotifs"):
+        sys.exit("patmatmotifs is not on PATH.")
+
+    records = make_records(args.n, args.length, args.seed)
+    modes = [("serial", 1, 1), ("parallel", args.workers, 1), ("packed", 1, args.chunk), ("parallel_packed", args.workers, args.chunk)]
+    baseline = None
+    print(f"{'mode':<16}{'workers':>8}{'chunk':>7}{'seconds':>10}{'seqs/s':>10}{'speedup':>9}  same result")
+    for label, workers, chunk_size in modes:
+        elapsed, summary_df = bench(records, args.scratch, label, workers, chunk_size)
+        key = summary_df.sort_values(list(summary_df.columns)).reset_index(drop = True)
+        if baseline is None:
+            baseline = (elapsed, key)
+        same = key.equals(baseline[1])
+        print(f"{label:<16}{workers:>8}{chunk_size:>7}{elapsed:>10.2f}{args.n / elapsed:>10.1f}{baseline[0] / elapsed:>9.2f}  {same}")
+    shutil.rmtree(args.scratch, ignore_errors = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!.venv/bin/python3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["pandas", "matplotlib", "seaborn", "scipy"]
+
+# import_profile() takes in an arg: module name.
+# Function: Import the module in a fresh interpreter with python -X importtime and read the report from stderr.
+# Output: Tuple of cumulative import time of the module in seconds and the set of top-level packages imported.
+def import_profile(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd = REPO_DIR, capture_output = True, text = True, env = {**os.environ, "PYTHONDONTWRITEBYTECODE" : "1"})
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    total = 0.0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        packages.add(name.split(".")[0])
+        if name == module:
+            total = int(cumulative_us) / 1e6
+    return total, packages
+
+# main() takes in no args.
+# Function: Report the import time of each entry point, fail if any heavy plotting/tabular library is imported at startup,
+# or if the median import time exceeds the budget.
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark pipeline startup time with python -X importtime.")
+    parser.add_argument("--modules", nargs = "+", default = ["main", "batch"])
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--budget", type = float, default = 0.5, help = "Maximum median import time in seconds.")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<10}{'median s':>10}{'min s':>8}  heavy imports")
+    for module in args.modules:
+        times = []
+        for i in range(args.repeat):
+            total, packages = import_profile(module)
+            times.append(total)
+        heavy = sorted(packages & set(HEAVY_MODULES))
+        median = statistics.median(times)
+        print(f"{module:<10}{median:>10.3f}{min(times):>8.3f}  {', '.join(heavy) or '-'}")
+        failed = failed or bool(heavy) or median > args.budget
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
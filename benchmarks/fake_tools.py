@@ -0,0 +1,178 @@
+#!.venv/bin/python3
+
+import os
+import re
+import shlex
+import shutil
+import sys
+from collections import Counter
+
+# Stand-ins for clustalo, blastp, makeblastdb, blastdb_aliastool and the EMBOSS tools the pipeline calls.
+# Each takes the same command line switches the pipeline passes and writes output in the same format, computed cheaply,
+# so the pipeline runs end to end (and its Python side can be profiled) without the real tools installed.
+# The executables in benchmarks/bin call main() with their own name.
+
+MOTIF_PATTERNS = {
+    "ASN_GLYCOSYLATION" : "N[^P][ST][^P]",
+    "PKC_PHOSPHO_SITE" : "[ST].[RK]",
+    "CK2_PHOSPHO_SITE" : "[ST]..[DE]",
+    "MYRISTYL" : "G[^EDRKHPFYW]..[STAGCN][^P]"
+}
+
+# arg() takes in 3 args: list of command line arguments, switch name and default value.
+# Output: Value following the switch (or given as --switch=value), else the default.
+def arg(argv, name, default = None):
+    for i, token in enumerate(argv):
+        if token == name and i + 1 < len(argv):
+            return argv[i + 1]
+        if token.startswith(f"{name}="):
+            return token.split("=", 1)[1]
+    return default
+
+def read_fasta(path):
+    records = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                records.append([line[1:].split()[0], []])
+            elif records:
+                records[-1][1].append(line)
+    return [(name, "".join(chunks)) for name, chunks in records]
+
+def read_clustal(path):
+    rows = {}
+    with open(path, "r") as file:
+        for line in file:
+            if line.startswith("CLUSTAL") or not line.strip() or line[0].isspace():
+                continue
+            name, residues = line.split()[:2]
+            rows[name] = rows.get(name, "") + residues
+    return rows
+
+def write_clustal(rows, path):
+    width = max(len(name) for name in rows) + 4
+    length = max(len(row) for row in rows.values())
+    with open(path, "w") as file:
+        file.write("CLUSTAL O(1.2.4) multiple sequence alignment\n\n\n")
+        for start in range(0, length, 60):
+            for name, row in rows.items():
+                file.write(f"{name:<{width}}{row.ljust(length, '-')[start:start + 60]}\n")
+            file.write(" " * width + "\n\n")
+
+def consensus(rows):
+    columns = zip(*(row for row in rows.values()))
+    return "".join(Counter(column).most_common(1)[0][0] for column in columns)
+
+# read_profile() takes in an arg: alignment filepath, in Clustal or aligned FASTA format, as clustalo --p1 accepts.
+def read_profile(path):
+    with open(path, "r") as file:
+        is_fasta = file.read(1) == ">"
+    return dict(read_fasta(path)) if is_fasta else read_clustal(path)
+
+# clustalo: align by padding every sequence with trailing gaps. With --p1, the profile rows are kept first.
+def clustalo(argv):
+    rows = read_profile(arg(argv, "--p1")) if arg(argv, "--p1") else {}
+    for name, sequence in read_fasta(arg(argv, "-i")):
+        rows[name] = sequence
+    length = max(len(row) for row in rows.values())
+    write_clustal({name : row.ljust(length, "-") for name, row in rows.items()}, arg(argv, "-o"))
+
+# plotcon: -graph png writes a blank PNG, -graph data writes the similarity of each column to the consensus.
+def plotcon(argv):
+    graph = arg(argv, "-graph")
+    if graph == "png":
+        with open(f"{arg(argv, '-goutfile')}.1.png", "wb") as file:
+            file.write(b"\x89PNG\r\n\x1a\n")
+    elif graph == "data":
+        rows = read_clustal(arg(argv, "-sequence"))
+        cons = consensus(rows)
+        with open(f"{arg(argv, '-goutfile')}1.dat", "w") as file:
+            file.write("##Graphic\n##Title Similarity Plot of Aligned Sequences\n##Data\n")
+            for i, residue in enumerate(cons):
+                file.write(f"{i + 1}.000000\t{sum(row[i] == residue for row in rows.values()) / len(rows):.6f}\n")
+
+def cons(argv):
+    with open(arg(argv, "-outseq"), "w") as file:
+        file.write(f">EMBOSS_001\n{consensus(read_clustal(arg(argv, '-sequence'))).replace('-', '')}\n")
+
+# infoalign: % change of each sequence against the consensus, over its aligned span.
+def infoalign(argv):
+    rows = read_clustal(argv[0])
+    cons = consensus(rows)
+    with open(arg(argv, "-outfile"), "w") as file:
+        for name, row in rows.items():
+            span = len(row.rstrip("-")) - (len(row) - len(row.lstrip("-")))
+            identities = sum(a == b != "-" for a, b in zip(row, cons))
+            file.write(f"{name}\t{(span - identities) * 100 / span if span > 0 else 0:.6f}\n")
+
+# patmatmotifs: excel report of a few common PROSITE patterns, overlapping matches included.
+def patmatmotifs(argv):
+    with open(arg(argv, "-outfile"), "w") as file:
+        file.write("SeqName\tStart\tEnd\tScore\tStrand\tMotif\n")
+        for name, sequence in read_fasta(arg(argv, "-sequence")):
+            for motif, pattern in MOTIF_PATTERNS.items():
+                for match in re.finditer(f"(?=({pattern}))", sequence):
+                    file.write(f"{name}\t{match.start() + 1}\t{match.start() + len(match.group(1))}\t0.000\t+\t{motif}\n")
+
+# makeblastdb: the "database" is a copy of the input FASTA.
+def makeblastdb(argv):
+    out = arg(argv, "-out")
+    shutil.copy(arg(argv, "-in").strip('"'), f"{out}.psq")
+    for suffix in [".pin", ".phr"]:
+        with open(f"{out}{suffix}", "w") as file:
+            file.write("fake\n")
+
+def blastdb_aliastool(argv):
+    with open(f"{arg(argv, '-out')}.pal", "w") as file:
+        file.write(f"TITLE {arg(argv, '-title', '')}\nDBLIST {arg(argv, '-dblist')}\n")
+
+def read_db(db):
+    if os.path.exists(f"{db}.pal"):
+        with open(f"{db}.pal", "r") as file:
+            volumes = [shlex.split(line)[1:] for line in file if line.startswith("DBLIST")][0]
+        return [record for volume in volumes for record in read_db(volume)]
+    return read_fasta(f"{db}.psq")
+
+# blastp: score each subject by the fraction of the query's 3-mers it shares, and report the best hits as -outfmt 6 or 7.
+def blastp(argv):
+    subjects = read_db(arg(argv, "-db").strip('"'))
+    fmt = arg(argv, "-outfmt", "0").split()[0]
+    max_evalue = float(arg(argv, "-evalue", "10"))
+    max_targets = int(arg(argv, "-max_target_seqs", "500"))
+    subject_kmers = [(name, len(sequence), {sequence[i:i + 3] for i in range(len(sequence) - 2)}) for name, sequence in subjects]
+    out = open(arg(argv, "-out"), "w") if arg(argv, "-out") else sys.stdout
+    for query, sequence in read_fasta(arg(argv, "-query")):
+        kmers = {sequence[i:i + 3] for i in range(len(sequence) - 2)}
+        hits = []
+        for name, length, other in subject_kmers:
+            shared = len(kmers & other) / max(1, len(kmers))
+            if shared > 0.05:
+                evalue = 10.0 ** (-shared * 180)
+                if evalue <= max_evalue:
+                    hits.append((shared, name, length))
+        hits = sorted(hits, reverse = True)[:max_targets]
+        if fmt == "7":
+            out.write(f"# BLASTP 2.15.0+\n# Query: {query}\n# {len(hits)} hits found\n")
+        for shared, name, length in hits:
+            aligned = min(len(sequence), length)
+            pid = 100 * shared
+            out.write(f"{query}\t{name}\t{pid:.3f}\t{aligned}\t{int(aligned * (1 - shared))}\t0\t1\t{aligned}\t1\t{aligned}\t{10.0 ** (-shared * 180):.2e}\t{shared * 2 * aligned:.1f}\n")
+    if out is not sys.stdout:
+        out.close()
+
+TOOLS = {
+    "clustalo" : clustalo,
+    "plotcon" : plotcon,
+    "cons" : cons,
+    "infoalign" : infoalign,
+    "patmatmotifs" : patmatmotifs,
+    "makeblastdb" : makeblastdb,
+    "blastdb_aliastool" : blastdb_aliastool,
+    "blastp" : blastp
+}
+
+def main(tool, argv):
+    TOOLS[tool](argv)
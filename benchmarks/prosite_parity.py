@@ -0,0 +1,61 @@
+#!.venv/bin/python3
+
+import argparse
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parse_fasta import iter_fasta
+from prosite_engine import run_native_prosite_scan
+from scan_prosite import build_prosite_input, run_prosite_scan
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# read_hits() takes in a list of patmatmotifs report filepaths.
+# Output: Set of (SeqName, Start, End, Motif) tuples found in the reports.
+def read_hits(paths):
+    hits = set()
+    for path in paths:
+        with open(path, "r") as file:
+            for line in file:
+                if not line.strip() or line.startswith("#") or line.startswith("SeqName"):
+                    continue
+                fields = [field.strip() for field in line.split("\t")]
+                hits.add((fields[0], int(fields[1]), int(fields[2]), fields[5]))
+    return hits
+
+# main() takes in no args.
+# Function: Scan the fixture sequences with patmatmotifs and with the native engine, and compare the hits.
+# patmatmotifs must use a PROSITE database built (prosextract) from the same prosite.dat given to the native engine.
+# Exit status is 1 if the hits differ.
+def main():
+    parser = argparse.ArgumentParser(description = "Check the native PROSITE engine against patmatmotifs.")
+    parser.add_argument("--fasta", default = os.path.join(FIXTURES, "prosite_parity.fasta"))
+    parser.add_argument("--prosite-dat", default = os.path.join(FIXTURES, "prosite_parity.dat"))
+    parser.add_argument("--scratch", default = "prosite_parity")
+    args = parser.parse_args()
+    if not shutil.which("patmatmotifs"):
+        sys.exit("patmatmotifs is not on PATH.")
+
+    records = list(iter_fasta(args.fasta))
+    shutil.rmtree(args.scratch, ignore_errors = True)
+    os.makedirs(f"{args.scratch}/emboss")
+    os.makedirs(f"{args.scratch}/native")
+    prosite_input = build_prosite_input(records, args.scratch, "emboss")
+    emboss_output = run_prosite_scan(args.scratch, "emboss", prosite_input)
+    native_output = run_native_prosite_scan(records, args.scratch, "native", args.prosite_dat)
+
+    emboss_hits = read_hits([f"{args.scratch}/emboss/{file}" for file in emboss_output])
+    native_hits = read_hits([f"{args.scratch}/native/{file}" for file in native_output])
+    print(f"patmatmotifs hits: {len(emboss_hits)}\tnative hits: {len(native_hits)}\tshared: {len(emboss_hits & native_hits)}")
+    for hit in sorted(emboss_hits - native_hits):
+        print(f"only patmatmotifs: {hit}")
+    for hit in sorted(native_hits - emboss_hits):
+        print(f"only native: {hit}")
+    shutil.rmtree(args.scratch, ignore_errors = True)
+    sys.exit(0 if emboss_hits == native_hits else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!.venv/bin/python3
+
+import os
+import numpy as np
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype = np.uint8)
+SPECIES = ["Homo sapiens", "Mus musculus", "Danio rerio", "Gallus gallus", "Xenopus tropicalis", "Escherichia coli [strain K12]", "Bos taurus", "Rattus norvegicus"]
+MOTIFS = ["PKC_PHOSPHO_SITE", "CK2_PHOSPHO_SITE", "MYRISTYL", "ASN_GLYCOSYLATION", "CAMP_PHOSPHO_SITE", "TYR_PHOSPHO_SITE_1", "AMIDATION"]
+SCALES = {"1k" : 1000, "10k" : 10000, "100k" : 100000}
+
+# make_records() takes in 4 args: number of sequences, random seed, number of sequences per family and mutation rate.
+# Function: Generate protein records the way a family search returns them: random ancestral sequences, each copied into a family
+# of truncated variants with point mutations, so lengths vary and near-identical sequences exist for clustering.
+# Output: List of protein sequence dicts, as iter_fasta() yields.
+def make_records(n, seed = 1, family_size = 20, mutation_rate = 0.1):
+    rng = np.random.default_rng(seed)
+    n_families = max(1, n // family_size)
+    ancestors = [AMINO_ACIDS[rng.integers(0, 20, rng.integers(200, 900))] for i in range(n_families)]
+    families = rng.integers(0, n_families, n)
+    records = []
+    for i, family in enumerate(families):
+        ancestor = ancestors[family]
+        length = int(rng.integers(len(ancestor) // 2, len(ancestor) + 1))
+        sequence = ancestor[:length].copy()
+        mutated = rng.random(length) < mutation_rate
+        sequence[mutated] = AMINO_ACIDS[rng.integers(0, 20, int(mutated.sum()))]
+        sequence = "M" + sequence[1:].tobytes().decode("ascii")
+        records.append({
+            "uid": f"XP_{i:09d}.1",
+            "species": SPECIES[i % len(SPECIES)],
+            "description": f"synthetic protein family {family} isoform X{i % 7 + 1}",
+            "sequence": sequence,
+            "length": len(sequence)
+        })
+    return records
+
+# fasta_text() takes in 2 args: list of protein sequence dicts and line width.
+# Output: FASTA text as NCBI efetch returns it, with sequences wrapped at the line width and a blank line after each record.
+def fasta_text(records, width = 70):
+    chunks = []
+    for entry in records:
+        sequence = entry["sequence"]
+        chunks.append(f">{entry['uid']} {entry['description']} [{entry['species']}]\n")
+        chunks.append("\n".join(sequence[i:i + width] for i in range(0, len(sequence), width)))
+        chunks.append("\n\n")
+    return "".join(chunks)
+
+# write_fasta_file() takes in 2 args: list of protein sequence dicts and output filepath.
+def write_fasta_file(records, path):
+    with open(path, "w") as file:
+        file.write(fasta_text(records))
+
+# write_clustal() takes in 4 args: list of protein sequence dicts, output filepath, alignment width and random seed.
+# Function: Write a Clustal format (.clu) alignment of the records, cut to the alignment width, with random gaps and 60 column blocks.
+def write_clustal(records, path, width = 300, seed = 1):
+    rng = np.random.default_rng(seed)
+    rows = np.full((len(records), width), ord("-"), dtype = np.uint8)
+    for i, entry in enumerate(records):
+        residues = np.frombuffer(entry["sequence"][:width].encode("ascii"), dtype = np.uint8)
+        rows[i, :len(residues)] = residues
+    rows[rng.random(rows.shape) < 0.05] = ord("-")
+    names = [entry["uid"] for entry in records]
+    name_width = max(len(name) for name in names) + 4
+    with open(path, "w") as file:
+        file.write("CLUSTAL O(1.2.4) multiple sequence alignment\n\n\n")
+        for start in range(0, width, 60):
+            block = rows[:, start:start + 60]
+            file.writelines(f"{name:<{name_width}}{row.tobytes().decode('ascii')}\n" for name, row in zip(names, block))
+            file.write(" " * name_width + "\n\n")
+
+# write_infoalign() takes in 3 args: list of uids, output filepath and random seed.
+# Function: Write infoalign -only -name -change output: one "uid<TAB>% change" row per sequence.
+def write_infoalign(uids, path, seed = 1):
+    changes = np.random.default_rng(seed).uniform(0, 100, len(uids))
+    with open(path, "w") as file:
+        file.writelines(f"{uid}\t{change:.6f}\n" for uid, change in zip(uids, changes))
+
+# write_patmatmotifs() takes in 4 args: list of uids, output directory, random seed and mean hits per sequence.
+# Function: Write one excel-format patmatmotifs report per uid, as run_prosite_scan() leaves them.
+# Output: List of report filenames.
+def write_patmatmotifs(uids, out_dir, seed = 1, mean_hits = 4):
+    rng = np.random.default_rng(seed)
+    files = []
+    for uid in uids:
+        lines = ["SeqName\tStart\tEnd\tScore\tStrand\tMotif\n"]
+        for j in range(rng.poisson(mean_hits)):
+            start = int(rng.integers(1, 600))
+            lines.append(f"{uid}\t{start}\t{start + int(rng.integers(3, 12))}\t0.000\t+\t{MOTIFS[int(rng.integers(0, len(MOTIFS)))]}\n")
+        with open(os.path.join(out_dir, f"{uid}.patmatmotifs"), "w") as file:
+            file.writelines(lines)
+        files.append(f"{uid}.patmatmotifs")
+    return files
+
+# write_blast_tab() takes in 5 args: list of query uids, list of subject uids, output filepath, hits per query and random seed.
+# Function: Write blastp -outfmt 7 output (tabular with comment lines) with the hits of each query against random subjects.
+def write_blast_tab(queries, subjects, path, hits_per_query = 500, seed = 1):
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as file:
+        for query in queries:
+            n_hits = min(hits_per_query, len(subjects))
+            file.write(f"# BLASTP 2.15.0+\n# Query: {query}\n# Database: synthetic\n")
+            file.write("# Fields: query acc.ver, subject acc.ver, % identity, alignment length, mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score\n")
+            file.write(f"# {n_hits} hits found\n")
+            hits = rng.choice(len(subjects), n_hits, replace = False)
+            pid = np.sort(rng.uniform(20, 100, n_hits))[::-1]
+            length = rng.integers(50, 800, n_hits)
+            evalue = np.sort(10.0 ** rng.uniform(-180, 1, n_hits))
+            bitscore = np.sort(rng.uniform(30, 1500, n_hits))[::-1]
+            file.writelines(
+                f"{query}\t{subjects[s]}\t{p:.3f}\t{l}\t{int(l * (100 - p) / 100)}\t{int(l) % 5}\t1\t{l}\t1\t{l}\t{e:.2e}\t{b:.1f}\n"
+                for s, p, l, e, b in zip(hits, pid, length, evalue, bitscore)
+            )
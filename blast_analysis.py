@@ -1,61 +1,199 @@
 #!.venv/bin/python3
 
-import subprocess
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import os
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from plotting import PLOT_LOCK, get_pyplot, show_plot
+from instrument import run_command, carry_context
+from tables import read_table, write_parquet, write_hits_parquet, write_hits_tsv
 
-# make_blast_db() takes in 3 args: out_dir, list of dicts of all protein sequences and blast_db.
+BLAST_FIELDS = ["query", "subject", "pid", "length", "mismatch", "gap_open", "q_start", "q_end", "s_start", "s_end", "evalue", "bitscore"]
+# Column types of the compact hit table. query and subject are indices into a list of sequence names.
+BLAST_HIT_DTYPE = [("query", "i4"), ("subject", "i4"), ("pid", "f4"), ("length", "i4"), ("mismatch", "i4"), ("gap_open", "i4"),
+                   ("q_start", "i4"), ("q_end", "i4"), ("s_start", "i4"), ("s_end", "i4"), ("evalue", "f8"), ("bitscore", "f4")]
+
+# blast_db_arg() takes in an arg: BLAST database or input FASTA filepath.
+# Output: Shell-quoted value for -db or -in. BLAST reads these values as a space-separated list, so the path is also wrapped in double quotes.
+def blast_db_arg(path):
+    return shlex.quote(f"\"{path}\"")
+
+# make_blast_db() takes in 4 args: out_dir, RecordStore of all protein sequences, blast_db and an optional BlastStore.
 # Function: Run makeblastdb command line to construct a BLAST database.
-# Constructs a FASTA file containing all protein sequences.
-# Output: Custom BLAST database name.
-def make_blast_db(out_dir, records, blast_db):
+# Constructs a FASTA file containing all protein sequences, written straight from the record store.
+# With a BlastStore, the database is taken from (or added to) the persistent store instead, so an unchanged record set is never rebuilt.
+# Output: BLAST database path.
+def make_blast_db(out_dir, store, blast_db, blast_store = None):
+    if blast_store is not None:
+        return blast_store.ensure(store)
     blast_db_input = f"{out_dir}_records.fasta"
-    with open(f"{out_dir}/{blast_db}/{blast_db_input}", "w") as file:
-        for entry in records:
-            file.write(f">{entry['uid']} {entry['description']} [{entry['species']}]\n")
-            file.write(f"{entry['sequence']}\n\n")
-    subprocess.call(f"makeblastdb -in {out_dir}/{blast_db}/{blast_db_input} -dbtype prot -out {out_dir}/{blast_db}/{blast_db}", shell = True)
+    store.write_fasta(f"{out_dir}/{blast_db}/{blast_db_input}")
+    run_command(f"makeblastdb -in {blast_db_arg(f'{out_dir}/{blast_db}/{blast_db_input}')} -dbtype prot -out {shlex.quote(f'{out_dir}/{blast_db}/{blast_db}')}", check = True)
+    return f"{out_dir}/{blast_db}/{blast_db}"
 
-# select_blast_ref() takes in 4 args: Top sequences in JSON, top sequences in infoalign results, out_dir and blast_db.
+# select_blast_ref() takes in 4 args: RecordStore of parsed sequences, top sequences in infoalign results, out_dir and blast_db.
 # Function: Select the sequence with the highest % similarity with the consensus sequence and save the sequence in a FASTA file.
 # Output: BLAST reference sequence FASTA file.
-def select_blast_ref(top_records, top_df, out_dir, blast_db):
+def select_blast_ref(store, top_df, out_dir, blast_db):
     ref_seq = top_df.iloc[0]["Name"]
-    blast_ref = list(filter(lambda x: x["uid"] == ref_seq, top_records))[0]
-    ref_file = f"{blast_ref['uid']}_blast_ref.fasta"
-    with open(f"{out_dir}/{blast_db}/{ref_file}", "w") as file:
-        file.write(f">{blast_ref['uid']} {blast_ref['description']} [{blast_ref['species']}]\n")
-        file.write(f"{blast_ref['sequence']}\n\n")
+    ref_file = f"{ref_seq}_blast_ref.fasta"
+    store.write_fasta(f"{out_dir}/{blast_db}/{ref_file}", [store.index(ref_seq)])
     return ref_file
 
-# run_blast_search takes in 3 args: out_dir, BLAST reference sequence FASTA file and blast_db.
+# run_blast_search takes in 5 args: out_dir, BLAST reference sequence FASTA file, blast_db, number of threads and BLAST database path.
 # Function: Run blastp command line to conduct BLAST analysis of protein database with a protein sequence query.
+# The database path defaults to the database make_blast_db() builds in blast_db.
 # Output: BLAST output file.
-def run_blast_search(out_dir, blastref_filename, blast_db):
+def run_blast_search(out_dir, blastref_filename, blast_db, threads = 1, db_path = None):
     blast_output = f"{out_dir}_blastoutput.out"
-    subprocess.call(f"blastp -db {out_dir}/{blast_db}/{blast_db} -query {out_dir}/{blast_db}/{blastref_filename} -outfmt 7 > {out_dir}/{blast_db}/{blast_output}", shell = True)
+    db_path = db_path or f"{out_dir}/{blast_db}/{blast_db}"
+    run_command(f"blastp -db {blast_db_arg(db_path)} -query {shlex.quote(f'{out_dir}/{blast_db}/{blastref_filename}')} -outfmt 7 -num_threads {threads} > {shlex.quote(f'{out_dir}/{blast_db}/{blast_output}')}", check = True)
     return blast_output
 
-# parse_blast_output() takes in 3 args: out_dir, blast_db and BLAST output file.
+# parse_blast_output() takes in 5 args: out_dir, blast_db, BLAST output file, whether to show the plot and table format.
 # Function: Parse BLAST output file to a pandas dataframe, and visualise BLAST output by plotting a scatterplot of BLAST hits (Alignment Length against % Identity).
+# A BLAST output file ending in .parquet is read as a parsed hit table of an earlier run. With table format "parquet", the parsed hits are also written as typed Parquet.
 # Output: Scatterplot of BLAST hits and parsed BLAST output to pandas dataframe.
-def parse_blast_output(out_dir, blast_db, blastresults_filename):
-    fields = ["query", "subject", "pid", "length", "mismatch", "gap_open", "q_start", "q_end", "s_start", "s_end", "evalue", "bitscore"]
-    blast_df = pd.read_csv(f"{out_dir}/{blast_db}/{blastresults_filename}", sep = "\t", comment = "#", names = fields)
-
-    plt.figure(figsize = (12, 6))
-    sns.scatterplot(x = "pid", y = "length", data = blast_df, hue = "bitscore", palette = "Blues", s = 40, edgecolor = "black")
-    plt.title("Scatterplot of BLAST Hits")
-    plt.xlabel("% Identity")
-    plt.ylabel("Alignment Length")
-    plt.grid(color = "lightgray", linestyle = "--")
-    plt.tight_layout()
-    
-    print("Generating scatterplot_blast.png...")
-    plt.savefig(f"{out_dir}/{blast_db}/scatterplot_blast.png")
-    print("Outputting Scatterplot of BLAST Hits to terminal. Check plot, and close to continue!")
-    plt.show()
-    plt.close()
+def parse_blast_output(out_dir, blast_db, blastresults_filename, show = True, table_format = "tsv"):
+    import seaborn as sns
+    plt = get_pyplot()
+    blast_df = read_table(f"{out_dir}/{blast_db}/{blastresults_filename}", comment = "#", names = BLAST_FIELDS)
+    if table_format == "parquet" and not blastresults_filename.endswith(".parquet"):
+        write_parquet(blast_df, f"{out_dir}/{blast_db}/{os.path.splitext(blastresults_filename)[0]}.parquet", dict(BLAST_HIT_DTYPE[2:], query = "string", subject = "string"))
+
+    with PLOT_LOCK:
+        fig, ax = plt.subplots(figsize = (12, 6))
+        sns.scatterplot(x = "pid", y = "length", data = blast_df, hue = "bitscore", palette = "Blues", s = 40, edgecolor = "black", ax = ax)
+        ax.set_title("Scatterplot of BLAST Hits")
+        ax.set_xlabel("% Identity")
+        ax.set_ylabel("Alignment Length")
+        ax.grid(color = "lightgray", linestyle = "--")
+        fig.tight_layout()
+
+        print("Generating scatterplot_blast.png...")
+        fig.savefig(f"{out_dir}/{blast_db}/scatterplot_blast.png")
+        show_plot(plt, "Outputting Scatterplot of BLAST Hits to terminal. Check plot, and close to continue!", show)
+        plt.close(fig)
     return blast_df
 
+# shard_queries() takes in 5 args: RecordStore, query record indices, out_dir, blast_db and number of shards.
+# Function: Split the queries into query FASTA files of roughly equal total length, assigning each sequence (longest first) to the lightest shard.
+# Output: List of query FASTA filenames.
+def shard_queries(store, indices, out_dir, blast_db, n_shards):
+    lengths = store.lengths()
+    indices = sorted(indices, key = lambda i: lengths[i], reverse = True)
+    n_shards = max(1, min(n_shards, len(indices)))
+    shards = [[] for i in range(n_shards)]
+    loads = [0] * n_shards
+    for i in indices:
+        shard = loads.index(min(loads))
+        shards[shard].append(i)
+        loads[shard] += lengths[i]
+
+    query_files = []
+    for i, shard in enumerate(shards):
+        query_file = f"{out_dir}_blastquery_{i + 1}.fasta"
+        store.write_fasta(f"{out_dir}/{blast_db}/{query_file}", shard)
+        query_files.append(query_file)
+    return query_files
+
+# run_blast_shard() takes in 6 args: out_dir, blast_db, query FASTA file, BLAST database path, number of threads and e-value cutoff.
+# Function: Run blastp for one query shard with tabular output (-outfmt 6). A non-zero exit code raises ToolError.
+# Output: Shard hit table filename.
+def run_blast_shard(out_dir, blast_db, query_file, db_path, threads, evalue):
+    shard_output = query_file.replace(".fasta", ".tsv")
+    run_command(f"blastp -db {blast_db_arg(db_path)} -query {shlex.quote(f'{out_dir}/{blast_db}/{query_file}')} -outfmt 6 -evalue {evalue} -num_threads {threads} -out {shlex.quote(f'{out_dir}/{blast_db}/{shard_output}')}", check = True)
+    return shard_output
+
+# run_blast_multi() takes in 7 args: out_dir, RecordStore, query record indices, blast_db, BLAST database path, number of threads and e-value cutoff.
+# Function: BLAST many queries at once. The queries are split into shards that run as concurrent blastp processes,
+# and the thread budget is divided between them, so every shard gets -num_threads threads.
+# Output: List of shard hit table filenames.
+def run_blast_multi(out_dir, store, indices, blast_db, db_path, threads = 1, evalue = 1e-5):
+    query_files = shard_queries(store, indices, out_dir, blast_db, threads)
+    shard_threads = max(1, threads // len(query_files))
+    print(f"Running blastp on {len(query_files)} query shards with {shard_threads} threads each...")
+    with ThreadPoolExecutor(max_workers = len(query_files)) as executor:
+        shard_outputs = list(executor.map(carry_context(lambda x: run_blast_shard(out_dir, blast_db, x, db_path, shard_threads, evalue)), query_files))
+    for query_file in query_files:
+        os.remove(f"{out_dir}/{blast_db}/{query_file}")
+    return shard_outputs
+
+# iter_blast_hits() takes in 2 args: tabular BLAST output filepath and e-value cutoff.
+# Function: Stream the hit table one line at a time, skipping comment lines and hits above the e-value cutoff.
+# Output: Generator of hit rows as lists of strings.
+def iter_blast_hits(path, max_evalue):
+    with open(path, "r") as file:
+        for line in file:
+            if line.startswith("#") or not line.strip():
+                continue
+            row = line.rstrip("\n").split("\t")
+            if float(row[10]) <= max_evalue:
+                yield row
+
+# read_blast_hits() takes in 3 args: list of tabular BLAST output filepaths, e-value cutoff and rows converted per block.
+# Function: Parse the hits incrementally into a typed numpy table. Query and subject names are stored once, as indices into a name list,
+# and rows are converted block by block, so the whole output is never held as strings or as a DataFrame.
+# Output: Tuple of list of sequence names and numpy structured array of hits.
+def read_blast_hits(paths, max_evalue, block_size = 100000):
+    import numpy as np
+    names = {}
+    blocks = []
+    block = []
+    for path in paths:
+        for row in iter_blast_hits(path, max_evalue):
+            block.append((names.setdefault(row[0], len(names)), names.setdefault(row[1], len(names)), *row[2:12]))
+            if len(block) >= block_size:
+                blocks.append(np.array(block, dtype = BLAST_HIT_DTYPE))
+                block = []
+    blocks.append(np.array(block, dtype = BLAST_HIT_DTYPE))
+    return list(names), np.concatenate(blocks)
+
+# load_blast_hits() takes in an arg: hit table filepath, as written by parse_blast_hits() in either table format.
+# Function: Read a merged hit table back into the compact form, for reanalysis of an earlier run.
+# Output: Tuple of list of sequence names and numpy structured array of hits.
+def load_blast_hits(path):
+    import numpy as np
+    import pandas as pd
+    df = read_table(path)
+    names = list(pd.unique(pd.concat([df["query"].astype(str), df["subject"].astype(str)], ignore_index = True)))
+    hits = np.empty(len(df), dtype = BLAST_HIT_DTYPE)
+    for field in BLAST_FIELDS:
+        hits[field] = pd.Categorical(df[field].astype(str), categories = names).codes if field in ["query", "subject"] else df[field]
+    return names, hits
+
+# parse_blast_hits() takes in 7 args: out_dir, blast_db, list of shard hit table files, e-value cutoff, whether to show the plot, maximum points plotted and table format.
+# Function: Merge the shard outputs into one e-value filtered hit table ({out_dir}_blasthits.tsv, or .parquet with table format "parquet"),
+# and plot the hits as parse_blast_output() does. Large hit tables are randomly subsampled for the scatterplot only.
+# Output: Tuple of hit table filename, list of sequence names and numpy structured array of hits.
+def parse_blast_hits(out_dir, blast_db, shard_outputs, max_evalue = 1e-5, show = True, max_points = 100000, table_format = "tsv"):
+    import numpy as np
+    names, hits = read_blast_hits([f"{out_dir}/{blast_db}/{file}" for file in shard_outputs], max_evalue)
+    if table_format == "parquet":
+        hits_file = f"{out_dir}_blasthits.parquet"
+        write_hits_parquet(names, hits, f"{out_dir}/{blast_db}/{hits_file}")
+    else:
+        hits_file = f"{out_dir}_blasthits.tsv"
+        write_hits_tsv(names, hits, f"{out_dir}/{blast_db}/{hits_file}")
+    for shard_output in shard_outputs:
+        os.remove(f"{out_dir}/{blast_db}/{shard_output}")
+    print(f"Kept {len(hits)} BLAST hits with e-value <= {max_evalue}.")
+
+    plotted = hits
+    if len(hits) > max_points:
+        plotted = hits[np.random.default_rng(0).choice(len(hits), max_points, replace = False)]
+    plt = get_pyplot()
+    with PLOT_LOCK:
+        fig, ax = plt.subplots(figsize = (12, 6))
+        points = ax.scatter(plotted["pid"], plotted["length"], c = plotted["bitscore"], cmap = "Blues", s = 40, edgecolors = "black", linewidths = 0.5)
+        fig.colorbar(points, ax = ax, label = "bitscore")
+        ax.set_title("Scatterplot of BLAST Hits")
+        ax.set_xlabel("% Identity")
+        ax.set_ylabel("Alignment Length")
+        ax.grid(color = "lightgray", linestyle = "--")
+        fig.tight_layout()
+
+        print("Generating scatterplot_blast.png...")
+        fig.savefig(f"{out_dir}/{blast_db}/scatterplot_blast.png")
+        show_plot(plt, "Outputting Scatterplot of BLAST Hits to terminal. Check plot, and close to continue!", show)
+        plt.close(fig)
+    return hits_file, names, hits
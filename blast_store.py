@@ -0,0 +1,220 @@
+#!.venv/bin/python3
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import time
+from cache import DEFAULT_DATA_DIR
+from instrument import run_command, ToolError
+from blast_analysis import blast_db_arg
+
+DEFAULT_STORE_DIR = os.path.join(DEFAULT_DATA_DIR, "blastdb")
+DEFAULT_STORE_BYTES = 20 * 1024 ** 3
+
+# record_digests() takes in an arg: RecordStore.
+# Function: Hash each sequence, and hash the sorted (uid, sequence hash) pairs into one key for the whole record set.
+# Output: Tuple of record set key and dict of uid to sequence hash.
+def record_digests(store):
+    digests = {store.uid(i) : hashlib.sha1(store.field("sequence", i)).hexdigest() for i in range(len(store))}
+    key = hashlib.sha256("\n".join(f"{uid}\t{digest}" for uid, digest in sorted(digests.items())).encode()).hexdigest()
+    return key, digests
+
+# BlastStore takes in 2 args: store directory and maximum store size in bytes.
+# Function: Persistent BLAST databases shared across runs and jobs, keyed on a hash of the record set.
+# A record set seen before reuses its database. A record set that only adds sequences to a stored one gets a small extra volume
+# with just the new sequences, joined to the stored volumes through an alias database, with no full rebuild.
+# Databases are evicted least recently used when the store grows beyond its size cap; a volume is deleted once no database uses it.
+# A database in use is read locked (a shared flock on a lock file per volume and alias), from ensure() or reading() until release(),
+# and eviction leaves read locked files in place until a later eviction finds them free, so blastp never loses its database mid-search.
+class BlastStore:
+    def __init__(self, store_dir = DEFAULT_STORE_DIR, max_bytes = DEFAULT_STORE_BYTES):
+        self.store_dir = os.path.abspath(store_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(f"{self.store_dir}/volumes", exist_ok = True)
+        os.makedirs(f"{self.store_dir}/aliases", exist_ok = True)
+        os.makedirs(f"{self.store_dir}/locks", exist_ok = True)
+        self.index_path = f"{self.store_dir}/index.json"
+        self.readers = {}
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {"dbs" : {}}
+        with open(self.index_path, "r") as file:
+            return json.load(file)
+
+    def save_index(self, index):
+        with open(f"{self.index_path}.tmp", "w") as file:
+            json.dump(index, file, indent = 2)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+    def load_digests(self, key):
+        with gzip.open(f"{self.store_dir}/aliases/{key}.uids.json.gz", "rt") as file:
+            return json.load(file)
+
+    def volume_path(self, volume):
+        return f"{self.store_dir}/volumes/{volume}/{volume}"
+
+    # build_volume() takes in 3 args: volume name, RecordStore and record indices.
+    # Function: Write the records to FASTA and run makeblastdb into a new volume directory. If makeblastdb fails, the volume is removed and ToolError is raised.
+    def build_volume(self, volume, store, indices):
+        volume_dir = f"{self.store_dir}/volumes/{volume}"
+        os.makedirs(volume_dir, exist_ok = True)
+        store.write_fasta(f"{volume_dir}/{volume}.fasta", indices)
+        try:
+            run_command(f"makeblastdb -in {blast_db_arg(f'{volume_dir}/{volume}.fasta')} -dbtype prot -out {shlex.quote(f'{volume_dir}/{volume}')}", check = True, stdout = subprocess.DEVNULL)
+        except ToolError:
+            shutil.rmtree(volume_dir, ignore_errors = True)
+            raise
+        os.remove(f"{volume_dir}/{volume}.fasta")
+
+    # hold() takes in 2 args: database path and its list of volumes.
+    # Function: Read lock the database's volumes and alias, until release(). Called with the store locked, so eviction cannot run in between.
+    def hold(self, path, volumes):
+        if path in self.readers:
+            return
+        locks = []
+        for name in sorted(set(volumes) | {os.path.basename(path)}):
+            lock = open(f"{self.store_dir}/locks/{name}.lock", "w")
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            locks.append(lock)
+        self.readers[path] = locks
+
+    # release() takes in an optional arg: database path.
+    # Function: Drop the read locks of the database, or of every database held if no path is given.
+    def release(self, path = None):
+        for held in list(self.readers) if path is None else [path]:
+            for lock in self.readers.pop(held, []):
+                lock.close()
+
+    # reading() takes in an arg: database path, from ensure().
+    # Function: Context manager keeping the database read locked while it is searched. A database already held since ensure() is kept as is,
+    # and one reused from an earlier run (e.g. a checkpointed blast_db stage) is looked up and locked. Raises RuntimeError if it was evicted.
+    @contextlib.contextmanager
+    def reading(self, path):
+        if path not in self.readers:
+            with open(f"{self.store_dir}/.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                index = self.load_index()
+                entry = next((entry for entry in index["dbs"].values() if entry["path"] == path), None)
+                if not entry or not all(os.path.isdir(f"{self.store_dir}/volumes/{volume}") for volume in entry["volumes"]):
+                    raise RuntimeError(f"BLAST database {path} is no longer in the store. Run the pipeline again to rebuild it.")
+                entry["last_used"] = time.time()
+                self.save_index(index)
+                self.hold(path, entry["volumes"])
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    # unlocked() takes in an arg: volume or alias name.
+    # Output: True if no job holds a read lock on it. Called with the store locked.
+    def unlocked(self, name):
+        lock_path = f"{self.store_dir}/locks/{name}.lock"
+        if not os.path.exists(lock_path):
+            return True
+        with open(lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        os.remove(lock_path)
+        return True
+
+    # new_volume() takes in an arg: record set key.
+    # Output: Name for a new volume of the record set. A volume of the same name left by eviction while read locked keeps its files, and the new one is named apart.
+    def new_volume(self, key):
+        volume = key[:16]
+        if os.path.isdir(f"{self.store_dir}/volumes/{volume}") and not self.unlocked(volume):
+            volume = f"{volume}_{int(time.time())}"
+        return volume
+
+    # volume_size() takes in an arg: volume name.
+    # Output: Size in bytes of the volume directory.
+    def volume_size(self, volume):
+        volume_dir = f"{self.store_dir}/volumes/{volume}"
+        return sum(os.path.getsize(os.path.join(volume_dir, name)) for name in os.listdir(volume_dir)) if os.path.isdir(volume_dir) else 0
+
+    # ensure() takes in an arg: RecordStore.
+    # Function: Return a BLAST database for exactly this record set, reusing a stored one, extending the largest stored subset with a new volume, or building one from scratch.
+    # The store is locked while it is updated, so parallel jobs can share it. The database is returned read locked, until release().
+    # Output: BLAST database path (for blastp -db).
+    def ensure(self, store):
+        key, digests = record_digests(store)
+        with open(f"{self.store_dir}/.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.load_index()
+            entry = index["dbs"].get(key)
+            if entry and all(os.path.isdir(f"{self.store_dir}/volumes/{volume}") for volume in entry["volumes"]):
+                print(f"Reusing stored BLAST database {key[:12]} ({entry['n']} sequences).")
+                entry["last_used"] = time.time()
+                self.save_index(index)
+                self.hold(entry["path"], entry["volumes"])
+                return entry["path"]
+
+            base_key = None
+            for other_key, other in index["dbs"].items():
+                if other["n"] >= len(digests) or (base_key and other["n"] <= index["dbs"][base_key]["n"]):
+                    continue
+                if not all(os.path.isdir(f"{self.store_dir}/volumes/{volume}") for volume in other["volumes"]):
+                    continue
+                other_digests = self.load_digests(other_key)
+                if all(digests.get(uid) == digest for uid, digest in other_digests.items()):
+                    base_key = other_key
+
+            if base_key:
+                base = index["dbs"][base_key]
+                base_digests = self.load_digests(base_key)
+                new_indices = [i for i in range(len(store)) if store.uid(i) not in base_digests]
+                volumes = base["volumes"] + [self.new_volume(key)]
+                print(f"Extending stored BLAST database {base_key[:12]} with {len(new_indices)} new sequences.")
+            else:
+                new_indices = range(len(store))
+                volumes = [self.new_volume(key)]
+                print(f"Building stored BLAST database {key[:12]} ({len(store)} sequences).")
+            self.build_volume(volumes[-1], store, new_indices)
+
+            if len(volumes) > 1:
+                path = f"{self.store_dir}/aliases/{key}"
+                dblist = " ".join(f"\"{self.volume_path(volume)}\"" for volume in volumes)
+                run_command(f"blastdb_aliastool -dblist {shlex.quote(dblist)} -dbtype prot -out {shlex.quote(path)} -title {key[:12]}", check = True, stdout = subprocess.DEVNULL)
+            else:
+                path = self.volume_path(volumes[0])
+            with gzip.open(f"{self.store_dir}/aliases/{key}.uids.json.gz", "wt") as file:
+                json.dump(digests, file)
+            index["dbs"][key] = {"path" : path, "volumes" : volumes, "n" : len(digests), "last_used" : time.time()}
+            self.hold(path, volumes)
+            self.evict(index, keep = key)
+            self.save_index(index)
+            return path
+
+    # evict() takes in 2 args: store index and key of the database to keep.
+    # Function: Drop least recently used databases until the volumes still in use fit the size cap, then delete unused volumes and alias files,
+    # except those read locked by a job, which are left for a later eviction.
+    def evict(self, index, keep):
+        sizes = {}
+        def used_bytes():
+            volumes = {volume for entry in index["dbs"].values() for volume in entry["volumes"]}
+            for volume in volumes:
+                if volume not in sizes:
+                    sizes[volume] = self.volume_size(volume)
+            return sum(sizes[volume] for volume in volumes)
+
+        for key in sorted(index["dbs"], key = lambda x: index["dbs"][x]["last_used"]):
+            if used_bytes() <= self.max_bytes:
+                break
+            if key != keep:
+                del index["dbs"][key]
+
+        in_use = {volume for entry in index["dbs"].values() for volume in entry["volumes"]}
+        for volume in os.listdir(f"{self.store_dir}/volumes"):
+            if volume not in in_use and self.unlocked(volume):
+                shutil.rmtree(f"{self.store_dir}/volumes/{volume}", ignore_errors = True)
+        for name in os.listdir(f"{self.store_dir}/aliases"):
+            if name.split(".")[0] not in index["dbs"] and self.unlocked(name.split(".")[0]):
+                os.remove(f"{self.store_dir}/aliases/{name}")
@@ -0,0 +1,265 @@
+#!.venv/bin/python3
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import requests
+from compression import open_file, compression_of
+from http_client import get_client
+
+DEFAULT_CACHE_DIR = os.environ.get("PIPELINE_CACHE_DIR", os.path.expanduser("~/.cache/bpsm_pipeline"))
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# Persistent data shared across runs (the record catalogue and the BLAST database store) is kept outside the response cache, so cache eviction never touches it.
+DEFAULT_DATA_DIR = os.environ.get("PIPELINE_DATA_DIR", os.path.expanduser("~/.local/share/bpsm_pipeline"))
+# Seconds between full scans of the cache for eviction. In between, each process adds up the sizes of the entries it stores.
+EVICT_INTERVAL = 60
+
+# Time-to-live in seconds for each endpoint. Searches change as NCBI adds sequences, so they expire sooner than fetched sequences.
+# History server pages (efetch_history, efetch_acc) are keyed on the search term and page, not on the uids they hold, so they expire as soon as the search does.
+ENDPOINT_TTL = {
+    "pfam" : 7 * 24 * 3600,
+    "esearch" : 24 * 3600,
+    "esearch_history" : 3600,
+    "efetch_history" : 3600,
+    "efetch_acc" : 3600,
+    "esummary" : 30 * 24 * 3600,
+    "efetch" : 30 * 24 * 3600
+}
+DEFAULT_TTL = 24 * 3600
+
+# Parameters that identify the caller but do not change the response, left out of the cache key.
+IGNORED_PARAMS = {"email", "api_key", "tool"}
+
+# OfflineCacheMiss is raised in offline mode when a response is not in the cache.
+class OfflineCacheMiss(RuntimeError):
+    pass
+
+# CachedResponse takes in 2 args: HTTP status code and response body.
+# Function: Stand in for requests.Response, for the attributes the pipeline uses.
+class CachedResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+# ResponseCache takes in 4 args: cache directory, maximum cache size in bytes, offline flag and enabled flag.
+# Function: Content-addressed on-disk cache for REST lookups, keyed on endpoint plus normalized parameters.
+# Each entry is a gzip file, so large FASTA payloads are stored compressed. Entries expire after the endpoint's TTL,
+# and the least recently used entries are evicted when the cache grows beyond its size cap. The cache is scanned for eviction only when the size of the
+# entries stored since the last scan takes it over the cap, or EVICT_INTERVAL seconds after the last scan (as other processes may share the cache).
+# In offline mode, stale entries are still served and a missing entry raises OfflineCacheMiss instead of going to the network.
+class ResponseCache:
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_bytes = DEFAULT_MAX_BYTES, offline = False, enabled = True):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.enabled = enabled
+        self.total = None
+        self.scanned = 0.0
+        self.lock = threading.Lock()
+
+    # endpoint() takes in an arg: request URL.
+    # Output: Endpoint name, e.g. "esearch" for .../esearch.fcgi or "pfam" for the EBI Search Pfam domain.
+    @staticmethod
+    def endpoint(url):
+        return url.rstrip("/").rsplit("/", 1)[-1].replace(".fcgi", "")
+
+    # key() takes in 2 args: endpoint name and request parameters.
+    # Output: SHA-256 hex digest of the endpoint and sorted parameters, without identifying parameters.
+    @staticmethod
+    def key(endpoint, params):
+        normalized = sorted((str(k), str(v).strip()) for k, v in (params or {}).items() if k not in IGNORED_PARAMS)
+        return hashlib.sha256(json.dumps([endpoint, normalized]).encode()).hexdigest()
+
+    def path(self, key):
+        return f"{self.cache_dir}/{key[:2]}/{key}.gz"
+
+    # load() takes in 3 args: cache key, TTL in seconds and an optional binary file to copy the body to.
+    # Function: Read a cached response. With an output file, the body is streamed into it instead of read into memory.
+    # Output: CachedResponse (with an empty body if streamed), or None if missing or expired (expired entries are still returned in offline mode).
+    def load(self, key, ttl, out_file = None):
+        path = self.path(key)
+        try:
+            with gzip.open(path, "rb") as file:
+                meta = json.loads(file.readline())
+                if not self.offline and time.time() - meta["created"] > ttl:
+                    return None
+                if out_file is None:
+                    text = file.read().decode()
+                else:
+                    shutil.copyfileobj(file, out_file)
+                    text = ""
+        except (OSError, ValueError, KeyError):
+            return None
+        # The entry may have been evicted by another process since it was read.
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return CachedResponse(meta["status"], text)
+
+    # store() takes in 3 args: cache key, endpoint name and response.
+    # Function: Write the response atomically, then evict old entries if the cache is over its size cap.
+    def store(self, key, endpoint, response):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt") as file:
+            file.write(json.dumps({"endpoint" : endpoint, "created" : time.time(), "status" : response.status_code}))
+            file.write("\n")
+            file.write(response.text)
+        os.replace(tmp_path, path)
+        self.added(path)
+
+    # added() takes in an arg: filepath of an entry just stored.
+    # Function: Add the entry's size to the running total, and evict if the total is over the size cap or unknown, or the last scan is too old.
+    def added(self, path):
+        with self.lock:
+            if self.total is not None:
+                with contextlib.suppress(OSError):
+                    self.total += os.path.getsize(path)
+            due = self.total is None or self.total > self.max_bytes or time.time() - self.scanned > EVICT_INTERVAL
+        if due:
+            self.evict()
+
+    # evict() takes in no args.
+    # Function: Scan the cache entries and delete least recently used ones until the cache is below its size cap.
+    # Only the entry directories (the first two hex digits of each key) are scanned, and entries removed meanwhile by another process are skipped.
+    def evict(self):
+        entries = []
+        total = 0
+        with contextlib.suppress(FileNotFoundError):
+            for shard in os.scandir(self.cache_dir):
+                if len(shard.name) != 2 or not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".gz"):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+        if total > self.max_bytes:
+            total = self.remove_oldest(entries, total)
+        with self.lock:
+            self.total = total
+            self.scanned = time.time()
+
+    # remove_oldest() takes in 2 args: list of (mtime, size, filepath) entries and their total size.
+    # Function: Delete entries least recently used first, until the total is below 90% of the size cap, so the next few entries stored do not need another scan.
+    # Output: Total size left.
+    def remove_oldest(self, entries, total):
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= 0.9 * self.max_bytes:
+                break
+        return total
+
+    # request() takes in 5 args: HTTP method, URL, request parameters, cache key parameters (optional) and keyword arguments for HttpClient.request().
+    # Function: Serve the response from the cache if fresh, else send the request through the shared HttpClient and cache successful responses.
+    # key_params replaces params in the cache key, for requests whose parameters hold session state such as WebEnv.
+    # Output: CachedResponse or requests.Response.
+    def request(self, method, url, params = None, key_params = None, endpoint = None, **kwargs):
+        endpoint = endpoint or self.endpoint(url)
+        key = self.key(endpoint, key_params if key_params is not None else params)
+        if self.enabled:
+            cached = self.load(key, ENDPOINT_TTL.get(endpoint, DEFAULT_TTL))
+            if cached:
+                return cached
+        if self.offline:
+            raise OfflineCacheMiss(f"Offline mode: no cached response for {endpoint} {key_params or params}")
+
+        if method == "POST":
+            response = get_client().post(url, data = params, **kwargs)
+        else:
+            response = get_client().get(url, params = params, **kwargs)
+        if self.enabled and response.ok:
+            self.store(key, endpoint, response)
+        return response
+
+    # download() takes in 5 args: HTTP method, URL, output filepath, request parameters and cache key parameters (optional), and keyword arguments for HttpClient.request().
+    # Function: As request(), but the response body is streamed to the output file in chunks instead of held in memory,
+    # compressed after the output file's suffix (or the compression keyword). A response from the network is written to the cache entry as it arrives.
+    # The output file is only in place once complete, so an interrupted download leaves no partial file. HttpClient retries a request until its response starts.
+    # Only a body cut off mid-stream (ChunkedEncodingError or ConnectionError while reading) is downloaded again from the start, up to the same number of times with the same backoff.
+    # These requests are sent once each (no HttpClient retries), so a failing endpoint is never tried retries x retries times.
+    # Output: CachedResponse or requests.Response, without a body. On an error status, no output file is written.
+    # Raises the last requests.RequestException if the download still failed.
+    def download(self, method, url, out_path, params = None, key_params = None, endpoint = None, compression = None, chunk_size = 1024 ** 2, retries = None, **kwargs):
+        endpoint = endpoint or self.endpoint(url)
+        key = self.key(endpoint, key_params if key_params is not None else params)
+        compression = compression or compression_of(out_path)
+        if self.enabled:
+            with open_file(f"{out_path}.part", "wb", compression) as out_file:
+                cached = self.load(key, ENDPOINT_TTL.get(endpoint, DEFAULT_TTL), out_file)
+            if cached:
+                os.replace(f"{out_path}.part", out_path)
+                return cached
+            os.remove(f"{out_path}.part")
+        if self.offline:
+            raise OfflineCacheMiss(f"Offline mode: no cached response for {endpoint} {key_params or params}")
+
+        client = get_client()
+        retries = client.retries if retries is None else retries
+        cache_path = self.path(key)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if self.enabled:
+            os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        for attempt in range(retries + 1):
+            response = client.request(method, url, retries = retries if attempt == 0 else 0, **{"data" if method == "POST" else "params" : params}, stream = True, **kwargs)
+            try:
+                with response:
+                    if not response.ok:
+                        return response
+                    with open_file(f"{out_path}.part", "wb", compression) as out_file, (gzip.open(tmp_path, "wb") if self.enabled else contextlib.nullcontext()) as cache_file:
+                        if self.enabled:
+                            cache_file.write(json.dumps({"endpoint" : endpoint, "created" : time.time(), "status" : response.status_code}).encode() + b"\n")
+                        for chunk in response.iter_content(chunk_size):
+                            out_file.write(chunk)
+                            if self.enabled:
+                                cache_file.write(chunk)
+            except BaseException as e:
+                # Partial files are never left behind, whether the download is retried or not.
+                for path in [f"{out_path}.part", tmp_path]:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                if not isinstance(e, (requests.exceptions.ChunkedEncodingError, requests.ConnectionError)) or attempt == retries:
+                    raise
+                time.sleep(client.delay(attempt + 1))
+                continue
+            break
+        os.replace(f"{out_path}.part", out_path)
+        if self.enabled:
+            os.replace(tmp_path, cache_path)
+            self.added(cache_path)
+        return response
+
+    def get(self, url, params = None, **kwargs):
+        return self.request("GET", url, params, **kwargs)
+
+    def post(self, url, data = None, **kwargs):
+        return self.request("POST", url, data, **kwargs)
+
+_cache = ResponseCache()
+
+# configure_cache() takes in keyword arguments for ResponseCache.
+# Function: Replace the shared cache used by input_handler and fetch_sequence, e.g. from command line switches.
+# Output: The new shared cache.
+def configure_cache(**kwargs):
+    global _cache
+    _cache = ResponseCache(**kwargs)
+    return _cache
+
+def get_cache():
+    return _cache
@@ -0,0 +1,72 @@
+#!.venv/bin/python3
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from cache import DEFAULT_DATA_DIR
+from fetch_sequence import run_efetch_ids, NCBI_BASE_URL
+from parse_fasta import iter_fasta, header_accession
+from record_store import RecordStore
+
+DEFAULT_CATALOGUE_DIR = os.path.join(DEFAULT_DATA_DIR, "catalogue")
+
+# accession_index() takes in an arg: RecordStore.
+# Output: Dict of accession (from each header uid, through header_accession()) to record index, in store order.
+def accession_index(store):
+    return {header_accession(uid) : i for uid, i in store.index_map().items()}
+
+# Catalogue takes in an arg: catalogue directory.
+# Function: Local catalogue of the records already fetched for each search term (one per Pfam family and taxon), shared across runs and jobs.
+# Each term keeps a RecordStore of its records, in result set order. On refresh, the uids of the current result set are compared with the stored ones:
+# only new uids are downloaded, withdrawn ones are dropped, and the rest are copied from the stored records, so a refresh transfers the new records only.
+class Catalogue:
+    def __init__(self, catalogue_dir = DEFAULT_CATALOGUE_DIR):
+        self.catalogue_dir = os.path.abspath(catalogue_dir)
+
+    # term_dir() takes in an arg: search term.
+    # Output: Directory of the term's records, named after a hash of the term.
+    def term_dir(self, term):
+        return f"{self.catalogue_dir}/{hashlib.sha256(term.encode()).hexdigest()[:16]}"
+
+    # refresh() takes in 5 args: esearch history dict, list of current uids (from run_efetch_accessions()), email, output FASTA filepath and base URL (optional).
+    # Function: Bring the term's stored records up to date with the current uids, then write them as FASTA, in the order of the uids.
+    # The term is locked while it is updated, so parallel jobs can share the catalogue.
+    # Output: Tuple of numbers of new, withdrawn and kept records.
+    def refresh(self, search, uids, email, fasta_path, base_url = NCBI_BASE_URL):
+        term_dir = self.term_dir(search["term"])
+        os.makedirs(term_dir, exist_ok = True)
+        with open(f"{term_dir}/.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stored = RecordStore.load(f"{term_dir}/records") if os.path.exists(f"{term_dir}/records/offsets.npy") else RecordStore.build([])
+            # Records are matched to the uids on their accession, as efetch rettype=acc lists them, e.g. P04637.4 for a "sp|P04637.4|P53_HUMAN" header.
+            stored_index = accession_index(stored)
+            current = set(uids)
+            new_uids = [uid for uid in uids if uid not in stored_index]
+            withdrawn = sum(1 for uid in stored_index if uid not in current)
+            print(f"Catalogue holds {len(stored)} records for this search: {len(new_uids)} new, {withdrawn} withdrawn.")
+
+            if list(stored_index) != uids:
+                new = RecordStore.build([])
+                if new_uids:
+                    print(f"Fetching {len(new_uids)} new protein sequences in FASTA format...")
+                    run_efetch_ids(new_uids, f"{term_dir}/new.fasta", email, base_url = base_url)
+                    new = RecordStore.build(iter_fasta(f"{term_dir}/new.fasta"), f"{term_dir}/new_records")
+                new_index = accession_index(new)
+                # A uid fetched without a matching record would be left out of every refresh, so the catalogue would silently differ from a full fetch.
+                missing = [uid for uid in new_uids if uid not in new_index]
+                if missing:
+                    raise RuntimeError(f"{len(missing)} of the {len(new_uids)} fetched uids have no matching FASTA record (e.g. {', '.join(missing[:5])}). The catalogue was not updated.")
+                merged = (stored.record(stored_index[uid]) if uid in stored_index else new.record(new_index[uid]) for uid in uids)
+                RecordStore.build(merged, f"{term_dir}/records.tmp")
+                shutil.rmtree(f"{term_dir}/records", ignore_errors = True)
+                os.replace(f"{term_dir}/records.tmp", f"{term_dir}/records")
+                shutil.rmtree(f"{term_dir}/new_records", ignore_errors = True)
+                if os.path.exists(f"{term_dir}/new.fasta"):
+                    os.remove(f"{term_dir}/new.fasta")
+                with open(f"{term_dir}/catalogue.json", "w") as file:
+                    json.dump({"term" : search["term"], "count" : len(uids), "updated" : time.time()}, file, indent = 2)
+            RecordStore.load(f"{term_dir}/records").write_fasta(fasta_path)
+        return len(new_uids), withdrawn, len(uids) - len(new_uids)
@@ -0,0 +1,76 @@
+#!.venv/bin/python3
+
+import hashlib
+import json
+import os
+import threading
+import time
+from instrument import get_tracer, path_bytes
+
+# hash_file() takes in an arg: filepath.
+# Output: SHA-256 hex digest of the file contents, read in 1 MB blocks.
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Checkpoint takes in an arg: out_dir.
+# Function: Keep a manifest ({out_dir}_checkpoint.json) of completed stages. Each entry records a hash of the stage's input files and parameters,
+# the stage result and its output files. On rerun, a stage whose hash is unchanged and whose outputs still exist is skipped.
+# Since a stage's inputs are the outputs of the stages before it, a change only reruns the stages downstream of it.
+# Stages may run concurrently, so the manifest is updated and saved under a lock.
+class Checkpoint:
+    def __init__(self, out_dir):
+        self.path = f"{out_dir}/{out_dir}_checkpoint.json"
+        self.manifest = {}
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as file:
+                    self.manifest = json.load(file)
+            except ValueError:
+                self.manifest = {}
+
+    # key() takes in 2 args: list of input filepaths and dict of parameters.
+    # Output: SHA-256 hex digest of the input file contents and parameters.
+    def key(self, inputs, params):
+        file_hashes = []
+        for path in inputs:
+            stat = os.stat(path)
+            memo = (path, stat.st_size, stat.st_mtime_ns)
+            if memo not in self.file_hashes:
+                self.file_hashes[memo] = hash_file(path)
+            file_hashes.append(self.file_hashes[memo])
+        return hashlib.sha256(json.dumps([file_hashes, params], sort_keys = True, default = str).encode()).hexdigest()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(tmp_path, "w") as file:
+                json.dump(self.manifest, file, indent = 2)
+            os.replace(tmp_path, self.path)
+
+    # run() takes in 4 args: stage name, list of input filepaths, dict of parameters and stage function.
+    # Function: Skip the stage if its inputs and parameters are unchanged since it last completed, else run it and record it.
+    # The stage function takes no args and returns a tuple of its (JSON-serialisable) result and list of output filepaths.
+    # Every stage, run or skipped, is timed through the shared tracer.
+    # Output: Stage result.
+    def run(self, stage, inputs, params, func):
+        with get_tracer().stage(stage, inputs) as event:
+            key = self.key(inputs, params)
+            entry = self.manifest.get(stage)
+            if entry and entry["key"] == key and all(os.path.exists(path) for path in entry["outputs"]):
+                print(f"Skipping {stage} stage: inputs unchanged since the last run.")
+                event["status"] = "skipped"
+                event["output_bytes"] = path_bytes(entry["outputs"])
+                return entry["result"]
+
+            result, outputs = func()
+            event["output_bytes"] = path_bytes(outputs)
+            with self.lock:
+                self.manifest[stage] = {"key" : key, "params" : params, "result" : result, "outputs" : list(outputs), "completed" : time.time()}
+            self.save()
+            return result
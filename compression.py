@@ -0,0 +1,60 @@
+#!.venv/bin/python3
+
+import gzip
+import io
+
+# File suffix of each compression. zstd needs the optional zstandard package.
+COMPRESSIONS = {"none" : "", "gzip" : ".gz", "zstd" : ".zst"}
+MAGIC = {b"\x1f\x8b" : "gzip", b"\x28\xb5\x2f\xfd" : "zstd"}
+
+# import_zstandard() takes in no args.
+# Function: Import the optional zstandard package, needed only for zstd compression.
+# Output: zstandard module.
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression needs the optional zstandard package. Install it with: pip install zstandard")
+    return zstandard
+
+# compression_of() takes in an arg: filepath.
+# Output: Compression named by the file suffix ("gzip", "zstd" or "none").
+def compression_of(path):
+    for compression, suffix in COMPRESSIONS.items():
+        if suffix and path.endswith(suffix):
+            return compression
+    return "none"
+
+# sniff() takes in an arg: filepath.
+# Output: Compression of the file from its leading magic bytes ("gzip", "zstd" or "none").
+def sniff(path):
+    with open(path, "rb") as file:
+        head = file.read(4)
+    for magic, compression in MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return "none"
+
+# open_file() takes in 3 args: filepath, mode ("r", "w", "rb" or "wb") and compression (optional).
+# Function: Open a file that may be compressed, as a stream. Files read are decompressed after their magic bytes, whatever their name,
+# and files written are compressed as asked, else after their suffix. Concatenated gzip members or zstd frames read as one stream,
+# so compressed batch files can be joined with a plain byte copy.
+# Output: File object, text in "r"/"w" mode and bytes in "rb"/"wb" mode.
+def open_file(path, mode = "r", compression = None):
+    writing = "w" in mode
+    if compression is None:
+        compression = compression_of(path) if writing else sniff(path)
+    if compression == "gzip":
+        # Level 6 is zlib's default (gzip.open's is 9): most of the size saving of level 9 at several times the speed.
+        file = gzip.open(path, "wb" if writing else "rb", compresslevel = 6)
+    elif compression == "zstd":
+        zstandard = import_zstandard()
+        raw = open(path, "wb" if writing else "rb")
+        # The zstd streams are buffered, for the full file interface (writelines, readline) that gzip files have.
+        if writing:
+            file = io.BufferedWriter(zstandard.ZstdCompressor(level = 3).stream_writer(raw, closefd = True))
+        else:
+            file = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames = True, closefd = True))
+    else:
+        file = open(path, "wb" if writing else "rb")
+    return file if "b" in mode else io.TextIOWrapper(file)
@@ -1,41 +1,127 @@
 #!.venv/bin/python3
 
+import os
+import shlex
+import shutil
 import subprocess
+import numpy as np
+from plotting import has_display
+from instrument import run_command, available_cpus
 
-# build_clustalo_input() takes in 4 args: Parsed sequences to JSON, out_dir, out_clustalo and user's input for sample size.
+# build_clustalo_input() takes in 6 args: RecordStore of parsed sequences, out_dir, out_clustalo, user's input for sample size, selection mode and identity threshold.
 # Function: Prepare an input FASTA file for ClustalO.
-# As per user's input size, sort the sequences by length in descending order, and select top few longest sequences for conservation analysis.
+# In "longest" mode, as per user's input size, select top few longest sequences for conservation analysis, in descending order of length.
+# The selection is a vectorised sort of the store's sequence lengths, and the FASTA file is written straight from the store.
+# In "cluster" mode, cluster the sequences by k-mer similarity at the identity threshold and select up to size representatives through select_representatives(),
+# so near-identical isoforms and duplicates are aligned once. The cluster to member mapping is saved as {out_clustalo}_clusters.tsv.
 # Output: Input FASTA filename for Clustalo.
-def build_clustalo_input(records, out_dir, out_clustalo, size):
-    records_sorted = list(sorted(records, key = lambda x: x["length"], reverse = True))
-    if len(records_sorted) > size:
-        records_sorted = records_sorted[:size]
+def build_clustalo_input(store, out_dir, out_clustalo, size, mode = "longest", identity = 0.9):
+    if mode == "cluster":
+        from redundancy import select_representatives
+        selected, clusters = select_representatives(store, size, identity)
+        with open(f"{out_dir}/{out_clustalo}/{out_clustalo}_clusters.tsv", "w") as file:
+            file.write("Representative\tSelected\tMember\n")
+            selected_uids = {store.uid(i) for i in selected}
+            for representative, members in clusters.items():
+                for member in members:
+                    file.write(f"{representative}\t{representative in selected_uids}\t{member}\n")
+        print(f"Clustered {len(store)} sequences into {len(clusters)} clusters at {identity:.0%} identity.")
+        print(f"Alignment input reduced to {len(selected)} representatives, from {min(size, len(store))} sequences in longest mode ({len(store)} in total).")
+    else:
+        selected = store.length_order()[:size]
     clustalo_input = f"{out_clustalo}_in.fasta"
-    with open(f"{out_dir}/{out_clustalo}/{clustalo_input}", "w") as file:
-        for entry in records_sorted:
-            file.write(f">{entry['uid']} {entry['description']} [{entry['species']}]\n")
-            file.write(f"{entry['sequence']}\n\n")
+    store.write_fasta(f"{out_dir}/{out_clustalo}/{clustalo_input}", selected)
     return clustalo_input
 
-# run_clustalo() takes in 3 args: out_dir, out_clustalo and input FASTA filename for ClustalO.
-# Function: Run clustalo command line.
+# fasta_uids() takes in an arg: FASTA filepath.
+# Output: List of uids (first word of each header line), in file order.
+def fasta_uids(fasta_path):
+    with open(fasta_path, "r") as file:
+        return [line[1:].split(None, 1)[0] for line in file if line.startswith(">")]
+
+# write_fasta_subset() takes in 3 args: FASTA filepath, set of uids and output FASTA filepath.
+# Function: Copy the FASTA records of the given uids to a new file, unchanged.
+def write_fasta_subset(fasta_path, uids, subset_path):
+    with open(fasta_path, "r") as file, open(subset_path, "w") as subset:
+        keep = False
+        for line in file:
+            if line.startswith(">"):
+                keep = line[1:].split(None, 1)[0] in uids
+            if keep:
+                subset.write(line)
+
+# read_alignment() takes in an arg: Clustal (.clu) alignment filepath.
+# Output: Dict of sequence name to aligned row (residues and gaps), in alignment order.
+def read_alignment(clu_path):
+    blocks = {}
+    with open(clu_path, "r") as file:
+        for line in file:
+            if line.startswith("CLUSTAL") or not line.strip() or line[0].isspace():
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                blocks.setdefault(parts[0], []).append(parts[1])
+    return {name : "".join(block) for name, block in blocks.items()}
+
+# write_profile() takes in 3 args: dict of sequence name to aligned row, list of names kept and output filepath.
+# Function: Write the kept rows of an alignment as aligned FASTA, for clustalo --p1. Columns left with only gaps are dropped.
+def write_profile(rows, names, profile_path):
+    width = max(len(rows[name]) for name in names)
+    matrix = np.frombuffer("".join(rows[name].ljust(width, "-") for name in names).encode("ascii"), dtype = np.uint8).reshape(len(names), width)
+    matrix = matrix[:, ~np.all((matrix == ord("-")) | (matrix == ord(".")), axis = 0)]
+    with open(profile_path, "w") as file:
+        for name, row in zip(names, matrix):
+            file.write(f">{name}\n{row.tobytes().decode('ascii')}\n")
+
+# run_clustalo() takes in 6 args: out_dir, out_clustalo, input FASTA filename for ClustalO, number of threads, whether to update the alignment incrementally and realignment threshold.
+# Function: Run clustalo command line. The number of threads defaults to the cores available.
+# The input of the current alignment is kept as {out_clustalo}_aligned_in.fasta. In incremental mode, the new input is compared with it:
+# if no more than the threshold fraction of the sequences changed, sequences no longer selected are dropped from the stored alignment,
+# and only the new sequences are aligned onto it, with clustalo's profile mode (--p1). Else, or with no stored alignment, everything is realigned.
 # Output: Multi-Sequence Alignment(MSA) output file with .clu.
-def run_clustalo(out_dir, out_clustalo, clustalo_input_filename):
+def run_clustalo(out_dir, out_clustalo, clustalo_input_filename, threads = None, incremental = False, realign_fraction = 0.2):
     clustalo_output = f"{out_clustalo}_out.clu"
-    subprocess.call(f"clustalo -i {out_dir}/{out_clustalo}/{clustalo_input_filename} -o {out_dir}/{out_clustalo}/{clustalo_output} --threads=4 --outfmt=clu", shell = True, stdout = subprocess.DEVNULL)
+    clustalo_dir = f"{out_dir}/{out_clustalo}"
+    aligned_input = f"{clustalo_dir}/{out_clustalo}_aligned_in.fasta"
+    threads = threads or available_cpus()
+    if incremental and os.path.exists(aligned_input) and os.path.exists(f"{clustalo_dir}/{clustalo_output}"):
+        previous = fasta_uids(aligned_input)
+        current = fasta_uids(f"{clustalo_dir}/{clustalo_input_filename}")
+        added = set(current) - set(previous)
+        kept = [uid for uid in previous if uid in set(current)]
+        changed = len(added) + len(previous) - len(kept)
+        if changed == 0:
+            print("ClustalO input unchanged since the last alignment, keeping it.")
+            shutil.copy(f"{clustalo_dir}/{clustalo_input_filename}", aligned_input)
+            return clustalo_output
+        # Removals alone leave nothing to add with --p1, so they are realigned in full.
+        if added and kept and changed <= realign_fraction * len(current):
+            print(f"Adding {len(added)} new sequences to the alignment of {len(kept)} ({len(previous) - len(kept)} dropped) with a ClustalO profile alignment...")
+            write_profile(read_alignment(f"{clustalo_dir}/{clustalo_output}"), kept, f"{clustalo_dir}/{out_clustalo}_profile.fasta")
+            write_fasta_subset(f"{clustalo_dir}/{clustalo_input_filename}", added, f"{clustalo_dir}/{out_clustalo}_new.fasta")
+            run_command(f"clustalo -i {shlex.quote(f'{clustalo_dir}/{out_clustalo}_new.fasta')} --p1 {shlex.quote(f'{clustalo_dir}/{out_clustalo}_profile.fasta')} -o {shlex.quote(f'{clustalo_dir}/{clustalo_output}')} --threads={threads} --outfmt=clu --force", check = True, stdout = subprocess.DEVNULL)
+            os.remove(f"{clustalo_dir}/{out_clustalo}_new.fasta")
+            os.remove(f"{clustalo_dir}/{out_clustalo}_profile.fasta")
+            shutil.copy(f"{clustalo_dir}/{clustalo_input_filename}", aligned_input)
+            return clustalo_output
+        print(f"{changed} of {len(current)} sequences changed since the last alignment, realigning all of them...")
+    run_command(f"clustalo -i {shlex.quote(f'{clustalo_dir}/{clustalo_input_filename}')} -o {shlex.quote(f'{clustalo_dir}/{clustalo_output}')} --threads={threads} --outfmt=clu --force", check = True, stdout = subprocess.DEVNULL)
+    shutil.copy(f"{clustalo_dir}/{clustalo_input_filename}", aligned_input)
     return clustalo_output
 
-# run_plotcon() takes in 3 args: out_dir, out_clustalo and MSA output.
-# Function: Run plotcon command lines to generate Plotcon graph to terminal and save graph as .png file.
+# run_plotcon() takes in 4 args: out_dir, out_clustalo, MSA output and whether to show the graph.
+# Function: Run plotcon command lines to generate Plotcon graph to terminal (if show) and save graph as .png file.
 # Run plotcon command line to generate Plotcon raw data and save as .txt file.
 # Output: Plotcon graph and raw data files.
-def run_plotcon(out_dir, out_clustalo, clustalo_output_filename):
+def run_plotcon(out_dir, out_clustalo, clustalo_output_filename, show = True):
     plotcon_graph = f"{out_clustalo}_plotcon_graph"
     plotcon_data = f"{out_clustalo}_plotcon_data"
-    print(f"Outputting {plotcon_graph} to terminal. Check graph, and close to continue!")
-    subprocess.call(f"plotcon -sequence {out_dir}/{out_clustalo}/{clustalo_output_filename} -graph x11 -auto", shell = True, stdout = subprocess.DEVNULL)
-    subprocess.call(f"plotcon -sequence {out_dir}/{out_clustalo}/{clustalo_output_filename} -graph png -goutfile {out_dir}/{out_clustalo}/{plotcon_graph} -auto", shell = True, stdout = subprocess.DEVNULL)
-    subprocess.call(f"plotcon -sequence {out_dir}/{out_clustalo}/{clustalo_output_filename} -graph data -goutfile {out_dir}/{out_clustalo}/{plotcon_data} -auto", shell = True, stdout = subprocess.DEVNULL)
+    msa_path = shlex.quote(f"{out_dir}/{out_clustalo}/{clustalo_output_filename}")
+    if show and has_display():
+        print(f"Outputting {plotcon_graph} to terminal. Check graph, and close to continue!")
+        run_command(f"plotcon -sequence {msa_path} -graph x11 -auto", check = True, stdout = subprocess.DEVNULL)
+    run_command(f"plotcon -sequence {msa_path} -graph png -goutfile {shlex.quote(f'{out_dir}/{out_clustalo}/{plotcon_graph}')} -auto", check = True, stdout = subprocess.DEVNULL)
+    run_command(f"plotcon -sequence {msa_path} -graph data -goutfile {shlex.quote(f'{out_dir}/{out_clustalo}/{plotcon_data}')} -auto", check = True, stdout = subprocess.DEVNULL)
     return f"{plotcon_graph}.1.png", f"{plotcon_data}1.dat"
 
 # get_consensus() takes in 3 args: out_dir, out_clustalo and MSA output.
@@ -43,7 +129,7 @@ def run_plotcon(out_dir, out_clustalo, clustalo_output_filename):
 # Output: Consensus sequence stored in FASTA format.
 def get_consensus(out_dir, out_clustalo, clustalo_output_filename):
     consensus = f"{out_clustalo}_consensus.fasta"
-    subprocess.call(f"cons -sequence {out_dir}/{out_clustalo}/{clustalo_output_filename} -outseq {out_dir}/{out_clustalo}/{consensus} -auto", shell = True, stdout = subprocess.DEVNULL)
+    run_command(f"cons -sequence {shlex.quote(f'{out_dir}/{out_clustalo}/{clustalo_output_filename}')} -outseq {shlex.quote(f'{out_dir}/{out_clustalo}/{consensus}')} -auto", check = True, stdout = subprocess.DEVNULL)
     return consensus
 
 # get_infoalign() takes in 3 args: out_dir, out_clustalo and MSA output.
@@ -51,6 +137,6 @@ def get_consensus(out_dir, out_clustalo, clustalo_output_filename):
 # Output: infoalign results .txt file.
 def get_infoalign(out_dir, out_clustalo, clustalo_output_filename):
     infoalign_results = f"{out_clustalo}_infoalign.txt"
-    subprocess.call(f"infoalign {out_dir}/{out_clustalo}/{clustalo_output_filename} -outfile {out_dir}/{out_clustalo}/{infoalign_results} -only -name -change -auto", shell = True, stdout = subprocess.DEVNULL)
+    run_command(f"infoalign {shlex.quote(f'{out_dir}/{out_clustalo}/{clustalo_output_filename}')} -outfile {shlex.quote(f'{out_dir}/{out_clustalo}/{infoalign_results}')} -only -name -change -auto", check = True, stdout = subprocess.DEVNULL)
     return infoalign_results
 
@@ -0,0 +1,160 @@
+#!.venv/bin/python3
+
+import numpy as np
+from plotting import PLOT_LOCK, get_pyplot, show_plot
+
+BLOSUM62_ORDER = "ARNDCQEGHILKMFPSTWYVBZX*"
+BLOSUM62_ROWS = """
+ 4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+-1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+-2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+-2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+ 0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+-1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+-1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+ 0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+-2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+-1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+-1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+-1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+-1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+-2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+-1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+ 1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+ 0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+-3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+-2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+ 0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+-2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+-1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+ 0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+-4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+"""
+BLOSUM62 = np.array(BLOSUM62_ROWS.split(), dtype = np.float64).reshape(len(BLOSUM62_ORDER), len(BLOSUM62_ORDER))
+GAP = len(BLOSUM62_ORDER)
+
+# Lookup table from ASCII code to residue index. Unknown letters count as X, and "-" or "." as a gap.
+RESIDUE_INDEX = np.full(256, BLOSUM62_ORDER.index("X"), dtype = np.uint8)
+for i, residue in enumerate(BLOSUM62_ORDER):
+    RESIDUE_INDEX[ord(residue)] = i
+    RESIDUE_INDEX[ord(residue.lower())] = i
+RESIDUE_INDEX[ord("-")] = GAP
+RESIDUE_INDEX[ord(".")] = GAP
+
+# read_clustal() takes in an arg: Clustal (.clu) alignment filepath.
+# Function: Parse the alignment once into sequence names and a 2-D residue matrix (sequences x columns) of residue indices.
+# Output: Tuple of list of names and numpy uint8 matrix.
+def read_clustal(clu_path):
+    blocks = {}
+    with open(clu_path, "r") as file:
+        for line in file:
+            if line.startswith("CLUSTAL") or not line.strip() or line[0].isspace():
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                blocks.setdefault(parts[0], []).append(parts[1])
+    names = list(blocks)
+    rows = ["".join(blocks[name]) for name in names]
+    width = max(len(row) for row in rows)
+    matrix = np.frombuffer("".join(row.ljust(width, "-") for row in rows).encode("ascii"), dtype = np.uint8).reshape(len(rows), width)
+    return names, RESIDUE_INDEX[matrix]
+
+# column_counts() takes in an arg: residue matrix.
+# Output: Matrix (columns x residue types + gap) of residue counts per column.
+def column_counts(matrix):
+    n_seqs, n_cols = matrix.shape
+    flat = matrix.T.astype(np.int64) + np.arange(n_cols)[:, None] * (GAP + 1)
+    return np.bincount(flat.ravel(), minlength = n_cols * (GAP + 1)).reshape(n_cols, GAP + 1)
+
+# column_similarity() takes in 2 args: column counts and window size.
+# Function: plotcon-equivalent conservation. Each column scores the mean BLOSUM62 score over all pairs of residues in it (gaps excluded),
+# computed from the counts as (c.M.c - sum(c_k.M_kk)) / (n(n - 1)), then averaged over a sliding window.
+# Output: Tuple of column positions (1-based) and windowed similarity scores.
+def column_similarity(counts, window = 4):
+    residue_counts = counts[:, :GAP].astype(np.float64)
+    pair_sum = np.einsum("ij,jk,ik->i", residue_counts, BLOSUM62, residue_counts) - residue_counts @ np.diag(BLOSUM62)
+    n_residues = residue_counts.sum(axis = 1)
+    n_pairs = n_residues * (n_residues - 1)
+    score = np.divide(pair_sum, n_pairs, out = np.zeros_like(pair_sum), where = n_pairs > 0)
+    window = max(1, min(window, len(score)))
+    smoothed = np.convolve(score, np.ones(window) / window, mode = "valid")
+    positions = np.arange(len(smoothed)) + (window + 1) / 2
+    return positions, smoothed
+
+# consensus_row() takes in an arg: column counts.
+# Function: cons-equivalent plurality consensus. A column gets its most common residue if at least half of the sequences have it, else "x".
+# Columns where gaps are the most common state are left out of the consensus.
+# Output: Tuple of consensus residue index per column (GAP where left out) and consensus sequence string.
+def consensus_row(counts):
+    n_seqs = counts.sum(axis = 1)
+    best = counts[:, :GAP].argmax(axis = 1)
+    best_count = counts[np.arange(len(best)), best]
+    row = np.where(best_count * 2 >= n_seqs, best, BLOSUM62_ORDER.index("X")).astype(np.uint8)
+    row[counts[:, GAP] > best_count] = GAP
+    letters = np.frombuffer((BLOSUM62_ORDER + "-").encode("ascii"), dtype = np.uint8)[row]
+    consensus = letters[row != GAP].tobytes().decode("ascii").replace("X", "x")
+    return row, consensus
+
+# percent_change() takes in 2 args: residue matrix and consensus residue index per column.
+# Function: infoalign-equivalent % change of each sequence against the consensus, over the columns from its first to its last residue:
+# (span - identities) * 100 / span.
+# Output: numpy array of % change per sequence.
+def percent_change(matrix, consensus):
+    residue = matrix != GAP
+    n_cols = matrix.shape[1]
+    first = residue.argmax(axis = 1)
+    last = n_cols - 1 - residue[:, ::-1].argmax(axis = 1)
+    span = np.where(residue.any(axis = 1), last - first + 1, 0)
+    identities = ((matrix == consensus[None, :]) & residue & (consensus[None, :] != BLOSUM62_ORDER.index("X"))).sum(axis = 1)
+    return np.divide((span - identities) * 100.0, span, out = np.zeros(len(span)), where = span > 0)
+
+# write_plotcon_data() takes in 3 args: data filepath, column positions and similarity scores.
+# Function: Write the similarity plot as plotcon -graph data does: a "##" header followed by "x y" rows.
+def write_plotcon_data(data_path, positions, scores):
+    with open(data_path, "w") as file:
+        file.write("##Graphic\n##Title Similarity Plot of Aligned Sequences\n##Xtitle Relative Residue Position\n##Ytitle Similarity\n")
+        file.write(f"##Points {len(positions)}\n##Data\n")
+        for x, y in zip(positions, scores):
+            file.write(f"{x:.6f}\t{y:.6f}\n")
+
+# plot_similarity() takes in 4 args: PNG filepath, column positions, similarity scores and whether to show the graph.
+# Function: Draw the similarity plot with matplotlib, save it as .png and optionally show it.
+def plot_similarity(png_path, positions, scores, show):
+    plt = get_pyplot()
+    with PLOT_LOCK:
+        fig, ax = plt.subplots(figsize = (12, 6))
+        ax.plot(positions, scores, color = "black", linewidth = 1)
+        ax.set_title("Similarity Plot of Aligned Sequences")
+        ax.set_xlabel("Relative Residue Position")
+        ax.set_ylabel("Similarity")
+        ax.grid(color = "lightgray", linestyle = "--")
+        fig.tight_layout()
+        fig.savefig(png_path)
+        show_plot(plt, "Outputting Similarity Plot of Aligned Sequences to terminal. Check graph, and close to continue!", show)
+        plt.close(fig)
+
+# run_conservation_engine() takes in 5 args: out_dir, out_clustalo, MSA output, whether to show the graph and plotcon window size.
+# Function: Replace the plotcon, cons and infoalign calls. Parse the alignment once into a residue matrix, compute windowed column similarity,
+# the consensus sequence and each sequence's % change against it with vectorised numpy operations, and write the same files the EMBOSS tools write.
+# Output: Plotcon graph, plotcon raw data, consensus sequence FASTA and infoalign results filenames.
+def run_conservation_engine(out_dir, out_clustalo, clustalo_output_filename, show = True, window = 4):
+    plotcon_graph = f"{out_clustalo}_plotcon_graph.1.png"
+    plotcon_data = f"{out_clustalo}_plotcon_data1.dat"
+    consensus_fasta = f"{out_clustalo}_consensus.fasta"
+    infoalign_results = f"{out_clustalo}_infoalign.txt"
+
+    names, matrix = read_clustal(f"{out_dir}/{out_clustalo}/{clustalo_output_filename}")
+    counts = column_counts(matrix)
+    positions, scores = column_similarity(counts, window)
+    write_plotcon_data(f"{out_dir}/{out_clustalo}/{plotcon_data}", positions, scores)
+    plot_similarity(f"{out_dir}/{out_clustalo}/{plotcon_graph}", positions, scores, show)
+
+    consensus, consensus_seq = consensus_row(counts)
+    with open(f"{out_dir}/{out_clustalo}/{consensus_fasta}", "w") as file:
+        file.write(f">EMBOSS_001\n{consensus_seq}\n")
+
+    changes = percent_change(matrix, consensus)
+    with open(f"{out_dir}/{out_clustalo}/{infoalign_results}", "w") as file:
+        for name, change in zip(names, changes):
+            file.write(f"{name}\t{change:.6f}\n")
+    return plotcon_graph, plotcon_data, consensus_fasta, infoalign_results
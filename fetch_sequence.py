@@ -1,23 +1,31 @@
 #!.venv/bin/python3
 
-import requests
+import hashlib
+import json
+import os
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from cache import get_cache
+from compression import COMPRESSIONS, compression_of
+from http_client import NCBI_BASE_URL, ncbi_api_params
 
 # run_esearch() takes in 3 args: protein family name, taxon ID and email.
 # Function: Query NCBI Protein database using Entrez esearch REST API to get a list of unique IDs.
 # If query failure or no results, print error message and return an empty list.
 # Else, return a list of unique IDs.
 def run_esearch(protein_family, taxon_id, email):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+    base_url = NCBI_BASE_URL
     query = f"({protein_family}) AND txid{taxon_id}[organism] NOT partial"
     params_esearch = {
         "db" : "protein", 
         "term" : query, 
         "retmax" : 5000, 
         "retmode" : "json", 
-        "email" : email
+        **ncbi_api_params(email)
     }
-    response_esearch = requests.get(f"{base_url}/esearch.fcgi", params = params_esearch)
+    response_esearch = get_cache().get(f"{base_url}/esearch.fcgi", params = params_esearch)
     if not response_esearch.ok:
         print(f"Error querying NCBI Protein! Error: {response_esearch.status_code}")
         return []
@@ -32,26 +40,199 @@ def run_esearch(protein_family, taxon_id, email):
 
 # run_efetch() takes in 3 args: list of unique IDs, out_dir and email.
 # Function: With the list of unique IDs obtained from esearch, query NCBI Protein database using Entrez efetch REST API to get a raw FASTA file of all protein sequences.
+# The response is streamed to the file as it arrives.
 # If query failure, print error message and exit system.
 # Else, return the downloaded raw FASTA filename.
 def run_efetch(ids_list, out_dir, email):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+    base_url = NCBI_BASE_URL
     ids_str = ",".join(ids_list)
     params_efetch = {
         "db" : "protein", 
         "id" : ids_str, 
         "rettype" : "fasta", 
         "retmode" : "text", 
-        "email" : email
+        **ncbi_api_params(email)
     }
-    response_efetch = requests.post(f"{base_url}/efetch.fcgi", data = params_efetch)
+    out_filename = f"{out_dir}_rawsequences.fasta"
+    response_efetch = get_cache().download("POST", f"{base_url}/efetch.fcgi", f"./{out_dir}/{out_filename}", params_efetch)
     if not response_efetch.ok:
         print(f"Error fetching from NCBI Protein! Error: {response_efetch.status_code}")
         sys.exit("Please try again.")
 
     else:
-        out_filename = f"{out_dir}_rawsequences.fasta"
-        with open(f"./{out_dir}/{out_filename}", "w") as file:
-            file.write(response_efetch.text)
         return out_filename
 
+
+# run_esearch_history() takes in 4 args: protein family name, taxon ID, email and base URL (optional).
+# Function: Query NCBI Protein database using Entrez esearch with usehistory, so the full result set is stored on the Entrez history server instead of being truncated at retmax.
+# If query failure or no results, print error message and return None.
+# Output: Dict with the total count, WebEnv and query_key of the result set.
+def run_esearch_history(protein_family, taxon_id, email, base_url = NCBI_BASE_URL):
+    query = f"({protein_family}) AND txid{taxon_id}[organism] NOT partial"
+    params_esearch = {
+        "db" : "protein", 
+        "term" : query, 
+        "usehistory" : "y", 
+        "retmax" : 0, 
+        "retmode" : "json", 
+        **ncbi_api_params(email)
+    }
+    response_esearch = get_cache().get(f"{base_url}/esearch.fcgi", params = params_esearch, endpoint = "esearch_history")
+    if not response_esearch.ok:
+        print(f"Error querying NCBI Protein! Error: {response_esearch.status_code}")
+        return None
+
+    search_result = response_esearch.json().get("esearchresult", {})
+    count = int(search_result.get("count", 0))
+    if not count:
+        print(f"No result for {query} on NCBI Protein!")
+        return None
+
+    return {
+        "term" : query, 
+        "count" : count, 
+        "webenv" : search_result["webenv"], 
+        "query_key" : search_result["querykey"]
+    }
+
+# fetch_batch() takes in 7 args: esearch history dict, retstart, batch size, email, batch filepath, base URL, retries and compression.
+# Function: Download one page of the history result set with efetch and stream it to its own batch file, compressed as asked.
+# Batch files already on disk are kept, so an interrupted download resumes.
+# Output: Batch filepath.
+def fetch_batch(search, retstart, batch_size, email, batch_path, base_url, retries = 3, compression = "none"):
+    if os.path.exists(batch_path):
+        return batch_path
+
+    params_efetch = {
+        "db" : "protein", 
+        "WebEnv" : search["webenv"], 
+        "query_key" : search["query_key"], 
+        "retstart" : retstart, 
+        "retmax" : batch_size, 
+        "rettype" : "fasta", 
+        "retmode" : "text", 
+        **ncbi_api_params(email)
+    }
+    # WebEnv changes every session, so batches are cached on the search term and page instead, for an hour only (endpoint "efetch_history").
+    key_params = {key : params_efetch[key] for key in ["db", "retstart", "retmax", "rettype"]}
+    key_params.update({"term" : search["term"], "count" : search["count"]})
+    return post_efetch(params_efetch, base_url, retries, f"Batch at retstart={retstart}", key_params = key_params, endpoint = "efetch_history", out_path = batch_path, compression = compression)
+
+# post_efetch() takes in 4 args: efetch parameters, base URL, retries and a label for error messages, and optional cache key parameters, endpoint, output filepath and compression.
+# Function: Send one efetch request through the response cache. The shared HttpClient keeps to the NCBI rate limit and retries transient failures.
+# With an output filepath, the response is streamed to the file (compressed as asked) instead of read into memory.
+# Output: Response body text, or the output filepath. Raises RuntimeError if the request still fails after its retries.
+def post_efetch(params_efetch, base_url, retries, label, key_params = None, endpoint = None, out_path = None, compression = None):
+    try:
+        if out_path:
+            response_efetch = get_cache().download("POST", f"{base_url}/efetch.fcgi", out_path, params_efetch, key_params = key_params, endpoint = endpoint, compression = compression, retries = retries, timeout = 300)
+        else:
+            response_efetch = get_cache().post(f"{base_url}/efetch.fcgi", data = params_efetch, key_params = key_params, endpoint = endpoint, retries = retries, timeout = 300)
+    except requests.RequestException as e:
+        raise RuntimeError(f"{label} failed after {retries + 1} attempts: {e}")
+    if not response_efetch.ok:
+        raise RuntimeError(f"{label} failed after {retries + 1} attempts: HTTP {response_efetch.status_code}")
+    return out_path or response_efetch.text
+
+# run_efetch_paged() takes in 8 args: esearch history dict, out_dir, email, batch size, number of workers, retries, base URL (optional) and compression.
+# Function: Page through the whole history result set in fixed-size batches, downloading batches concurrently under the NCBI rate limit.
+# Each batch is streamed to disk as it arrives (gzip or zstd compressed if asked), then all batches are joined in order into the raw FASTA file.
+# Compressed batches are joined as they are, since concatenated gzip members or zstd frames read back as one stream.
+# The batch folder records a hash of the search term, count, batch size and compression it was paged for. A folder left by another search is wiped,
+# so only the batches of an interrupted run of the same search are resumed.
+# If any batch still fails after its retries, print error message and exit system.
+# Output: Downloaded raw FASTA filename.
+def run_efetch_paged(search, out_dir, email, batch_size = 500, workers = 3, retries = 3, base_url = NCBI_BASE_URL, compression = "none"):
+    batch_dir = f"./{out_dir}/{out_dir}_batches"
+    batch_key = hashlib.sha256(json.dumps([search["term"], search["count"], batch_size, compression]).encode()).hexdigest()
+    key_path = f"{batch_dir}/batches.key"
+    if os.path.isdir(batch_dir):
+        try:
+            with open(key_path, "r") as file:
+                stale = file.read() != batch_key
+        except OSError:
+            stale = True
+        if stale:
+            shutil.rmtree(batch_dir)
+    os.makedirs(batch_dir, exist_ok = True)
+    with open(key_path, "w") as file:
+        file.write(batch_key)
+
+    suffix = COMPRESSIONS[compression]
+    starts = list(range(0, search["count"], batch_size))
+    batch_paths = [f"{batch_dir}/batch_{i:05d}.fasta{suffix}" for i in range(len(starts))]
+    failed = []
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {
+            executor.submit(fetch_batch, search, start, batch_size, email, path, base_url, retries, compression): start
+            for start, path in zip(starts, batch_paths)
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(e)
+    if failed:
+        print(f"Error fetching from NCBI Protein! {len(failed)} of {len(starts)} batches failed.")
+        sys.exit("Please try again.")
+
+    out_filename = f"{out_dir}_rawsequences.fasta{suffix}"
+    with open(f"./{out_dir}/{out_filename}", "wb") as out_file:
+        for path in batch_paths:
+            with open(path, "rb") as batch_file:
+                shutil.copyfileobj(batch_file, out_file)
+    shutil.rmtree(batch_dir)
+    return out_filename
+
+# run_efetch_accessions() takes in 6 args: esearch history dict, email, batch size, number of workers, retries and base URL (optional).
+# Function: Page through the history result set with efetch rettype=acc, which returns only the accession.version of each record, one per line.
+# These are the uids of the FASTA headers, so the current result set can be compared with stored records before any sequence is downloaded.
+# Pages are cached on the search term for an hour only (endpoint "efetch_acc"), as the result set changes while its count may not.
+# Output: List of accession.version uids, in result set order.
+def run_efetch_accessions(search, email, batch_size = 10000, workers = 3, retries = 3, base_url = NCBI_BASE_URL):
+    def fetch_page(retstart):
+        params_efetch = {
+            "db" : "protein", 
+            "WebEnv" : search["webenv"], 
+            "query_key" : search["query_key"], 
+            "retstart" : retstart, 
+            "retmax" : batch_size, 
+            "rettype" : "acc", 
+            "retmode" : "text", 
+            **ncbi_api_params(email)
+        }
+        key_params = {"db" : "protein", "retstart" : retstart, "retmax" : batch_size, "rettype" : "acc", "term" : search["term"], "count" : search["count"]}
+        return post_efetch(params_efetch, base_url, retries, f"Accession page at retstart={retstart}", key_params = key_params, endpoint = "efetch_acc").split()
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        pages = list(executor.map(fetch_page, range(0, search["count"], batch_size)))
+    return [uid for page in pages for uid in page]
+
+# run_efetch_ids() takes in 7 args: list of uids, output FASTA filepath, email, batch size, number of workers, retries and base URL (optional).
+# Function: Download the FASTA records of the given uids only, posting them to efetch in batches, concurrently under the NCBI rate limit.
+# Each batch is streamed to its own file, compressed after the output file's suffix, then the batches are joined in order.
+# Batches are cached on their uid list, so records already downloaded are never requested again while the cache holds them.
+# Output: Output FASTA filepath.
+def run_efetch_ids(uids, fasta_path, email, batch_size = 500, workers = 3, retries = 3, base_url = NCBI_BASE_URL):
+    compression = compression_of(fasta_path)
+
+    def fetch_ids(start):
+        batch = uids[start:start + batch_size]
+        params_efetch = {
+            "db" : "protein", 
+            "id" : ",".join(batch), 
+            "rettype" : "fasta", 
+            "retmode" : "text", 
+            **ncbi_api_params(email)
+        }
+        return post_efetch(params_efetch, base_url, retries, f"Batch of {len(batch)} uids", out_path = f"{fasta_path}.{start // batch_size:05d}", compression = compression)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        batch_paths = list(executor.map(fetch_ids, range(0, len(uids), batch_size)))
+    with open(fasta_path, "wb") as out_file:
+        for path in batch_paths:
+            with open(path, "rb") as batch_file:
+                shutil.copyfileobj(batch_file, out_file)
+            os.remove(path)
+    return fasta_path
@@ -0,0 +1,169 @@
+#!.venv/bin/python3
+
+import email.utils
+import multiprocessing
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# E-utilities and EBI Search base URLs, overridable (e.g. NCBI_BASE_URL=http://127.0.0.1:8000) to run against local stand-in servers.
+NCBI_BASE_URL = os.environ.get("NCBI_BASE_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils")
+EBI_BASE_URL = os.environ.get("EBI_BASE_URL", "https://www.ebi.ac.uk/ebisearch/ws/rest")
+
+# Status codes worth retrying: rate limited, and transient server or gateway errors.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# ncbi_rate() takes in no args.
+# Output: Requests per second NCBI allows: 10 with NCBI_API_KEY set in the environment, else 3.
+def ncbi_rate():
+    return 10 if os.environ.get("NCBI_API_KEY") else 3
+
+# ncbi_api_params() takes in an arg: email.
+# Function: Build the identification parameters sent with every E-utilities request, adding NCBI_API_KEY from the environment if set.
+# The key also raises the request rate the shared HttpClient allows NCBI, from 3 to 10 per second, so every E-utilities request must send it:
+# one without the key is held to 3 per second by NCBI, and would be rate limited while the bucket runs at 10.
+# Output: Dict of parameters.
+def ncbi_api_params(email):
+    params = {"email" : email}
+    api_key = os.environ.get("NCBI_API_KEY")
+    if api_key:
+        params["api_key"] = api_key
+    return params
+
+# host_of() takes in an arg: URL.
+# Output: Host and port of the URL, e.g. "eutils.ncbi.nlm.nih.gov" (rate limits are kept per host).
+def host_of(url):
+    return urlsplit(url).netloc
+
+# TokenBucket takes in 3 args: tokens per second, bucket size and an optional shared multiprocessing.Value("d").
+# Function: Rate limiter shared between threads. A request takes a token, and waits for one if the bucket is empty.
+# The bucket keeps only the time the next token is due, so with a shared value (and its lock) the same bucket holds across worker processes.
+# A bucket size of 1 spaces requests evenly, which keeps within a requests-per-second limit over any one-second window.
+class TokenBucket:
+    def __init__(self, rate, burst = 1, state = None):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        if state is None:
+            self.state, self.lock = SimpleNamespace(value = 0.0), threading.Lock()
+        else:
+            self.state, self.lock = state, state.get_lock()
+
+    # acquire() takes in no args.
+    # Function: Take a token, sleeping until it is due.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            due = max(self.state.value, now - (self.burst - 1) * self.interval)
+            self.state.value = due + self.interval
+        if due > now:
+            time.sleep(due - now)
+
+    # pause() takes in an arg: seconds.
+    # Function: Hold every token back for the given time, e.g. after a 429 response with Retry-After.
+    def pause(self, seconds):
+        with self.lock:
+            self.state.value = max(self.state.value, time.monotonic() + seconds)
+
+# retry_after() takes in an arg: HTTP response.
+# Output: Seconds to wait from the Retry-After header (in seconds or as an HTTP date), or None if absent or invalid.
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# HttpClient takes in 5 args: dict of host to requests per second, number of retries, base backoff in seconds, connection pool size per host
+# and an optional dict of host to shared bucket state (from shared_rate_state()).
+# Function: Shared HTTP client for every EBI and NCBI lookup. One requests.Session keeps connections alive and pooled, so requests after the first skip
+# the TCP and TLS handshakes. Requests to a host with a rate take a token from the host's TokenBucket first. Connection errors, timeouts,
+# 429 and 5xx responses are retried with full-jitter exponential backoff, or after the server's Retry-After; a 429 also pauses the host's bucket,
+# so the other threads back off too.
+class HttpClient:
+    def __init__(self, rates = None, retries = 4, backoff = 0.5, pool_size = 16, shared = None):
+        self.rates = rates if rates is not None else {host_of(NCBI_BASE_URL) : ncbi_rate()}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = 30.0
+        # Requests are sent at 95% of the limit, so jitter in network delay cannot bunch them into more than the limit within a second at the server.
+        self.buckets = {host : TokenBucket(0.95 * rate, state = (shared or {}).get(host)) for host, rate in self.rates.items()}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # delay() takes in an arg: attempt number, from 1.
+    # Output: Random backoff between 0 and the exponential cap of the attempt, so retrying clients do not retry in step.
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    # request() takes in 3 args: HTTP method, URL and number of retries (optional), and keyword arguments for requests.
+    # Function: Send the request under the host's rate limit, retrying transient failures.
+    # Output: requests.Response (the last one if every attempt failed with a retryable status). Raises the last requests.RequestException if every attempt failed to connect.
+    def request(self, method, url, retries = None, **kwargs):
+        retries = self.retries if retries is None else retries
+        bucket = self.buckets.get(host_of(url))
+        for attempt in range(retries + 1):
+            if bucket:
+                bucket.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                time.sleep(self.delay(attempt + 1))
+                continue
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            wait = retry_after(response)
+            if wait is None:
+                wait = self.delay(attempt + 1)
+            if response.status_code == 429 and bucket:
+                bucket.pause(wait)
+            response.close()
+            time.sleep(wait)
+
+    def get(self, url, params = None, **kwargs):
+        return self.request("GET", url, params = params, **kwargs)
+
+    def post(self, url, data = None, **kwargs):
+        return self.request("POST", url, data = data, **kwargs)
+
+# shared_rate_state() takes in an optional arg: dict of host to requests per second.
+# Function: Create bucket state to share between worker processes (passed to them at start, as a process pool initializer argument),
+# so that all jobs of a batch together keep within each host's rate limit.
+# Output: Dict of host to multiprocessing.Value.
+def shared_rate_state(rates = None):
+    rates = rates if rates is not None else {host_of(NCBI_BASE_URL) : ncbi_rate()}
+    return {host : multiprocessing.Value("d", 0.0) for host in rates}
+
+_client = None
+_client_lock = threading.Lock()
+
+# configure_client() takes in keyword arguments for HttpClient.
+# Function: Replace the shared client used by the response cache, e.g. in a batch worker process with shared bucket state.
+# Output: The new shared client.
+def configure_client(**kwargs):
+    global _client
+    _client = HttpClient(**kwargs)
+    return _client
+
+# get_client() takes in no args.
+# Output: The shared client, created on first use.
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+    return _client
@@ -1,19 +1,21 @@
 #!.venv/bin/python3
 
 import subprocess
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from cache import get_cache
+from http_client import NCBI_BASE_URL, EBI_BASE_URL, ncbi_api_params
 
 # validate_protein() takes in an arg: a protein family string name.
 # Function: Query EBI search with search term using REST API.
 # If query failure or no results, raise an error.
 # Else, return the first Pfam ID and Pfam name.
 def validate_protein(protein_family):
-    base_url = "https://www.ebi.ac.uk/ebisearch/ws/rest/pfam"
+    base_url = f"{EBI_BASE_URL}/pfam"
     params = {
         "query" : protein_family
     }
     headers = {"Accept" : "application/json"}
-    response = requests.get(base_url, params = params, headers = headers)
+    response = get_cache().get(base_url, params = params, headers = headers)
     if not response.ok:
         raise ValueError("Error querying EBI Search! Error: {response.status_code}")
 
@@ -31,15 +33,15 @@ def validate_protein(protein_family):
 # If query failure or no results, raise an error.
 # Else, return the first taxon ID and taxon group name.
 def validate_taxon(taxon_group, email):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+    base_url = NCBI_BASE_URL
     params_esearch = {
         "db" : "taxonomy", 
         "term" : taxon_group, 
         "retmax" : 20, 
         "retmode" : "json", 
-        "email" : email
+        **ncbi_api_params(email)
     }
-    response_esearch = requests.get(f"{base_url}/esearch.fcgi", params = params_esearch)
+    response_esearch = get_cache().get(f"{base_url}/esearch.fcgi", params = params_esearch)
     if not response_esearch.ok:
         raise ValueError("Error querying NCBI Taxonomy through esearch! Error: {response_esearch.status_code}")
 
@@ -53,9 +55,9 @@ def validate_taxon(taxon_group, email):
         "db" : "taxonomy", 
         "id" : taxon_id, 
         "retmode" : "json", 
-        "email" : email
+        **ncbi_api_params(email)
     }
-    response_esummary = requests.get(f"{base_url}/esummary.fcgi", params = params_esummary)
+    response_esummary = get_cache().get(f"{base_url}/esummary.fcgi", params = params_esummary)
     if not response_esummary.ok:
         raise ValueError("Error querying NCBI Taxonomy through esummary! Error: {response_esummary.status_code}")
 
@@ -66,3 +68,12 @@ def validate_taxon(taxon_group, email):
 
     return taxon_id, taxon_name
 
+# validate_inputs() takes in 3 args: a protein family string name, a taxon group string name and email.
+# Function: Run validate_protein() and validate_taxon() concurrently, as the EBI and NCBI lookups do not depend on each other.
+# Raise the error of the protein family first, if both fail.
+# Output: Tuple of (Pfam ID, Pfam name) and (taxon ID, taxon group name).
+def validate_inputs(protein_family, taxon_group, email):
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        protein = executor.submit(validate_protein, protein_family)
+        taxon = executor.submit(validate_taxon, taxon_group, email)
+        return protein.result(), taxon.result()
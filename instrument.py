@@ -0,0 +1,261 @@
+#!.venv/bin/python3
+
+import contextlib
+import contextvars
+import glob
+import json
+import os
+import resource
+import shlex
+import subprocess
+import threading
+import time
+
+# Name of the stage running in the current thread or asyncio task, so concurrent stages attribute their processes correctly.
+current_stage = contextvars.ContextVar("current_stage", default = None)
+
+# ToolError takes in 3 args: command line, exit code and stage name.
+# Function: Raised by run_command(check = True) when an external tool exits with a non-zero code, or is not started because the run was aborted.
+class ToolError(RuntimeError):
+    def __init__(self, cmd, exit_code, stage = None):
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.stage = stage
+        tool = os.path.basename(cmd.split(None, 1)[0]) if cmd.strip() else cmd
+        if exit_code is None:
+            message = f"{tool} not started, the run was aborted"
+        else:
+            message = f"{tool} failed with exit code {exit_code}"
+        super().__init__(f"{message}{f' in stage {stage}' if stage else ''}: {cmd}")
+
+# carry_context() takes in an arg: function.
+# Function: Wrap the function to run in a copy of the caller's context, so worker threads started inside a stage (thread pools)
+# keep the stage name for their process events.
+# Output: Wrapped function.
+def carry_context(func):
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+# available_cpus() takes in no args.
+# Output: Number of CPU cores this process may run on (its affinity mask where the platform has one).
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# cpu_seconds() takes in no args.
+# Output: User + system CPU seconds used so far by this process and its waited-for child processes.
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+# path_bytes() takes in an arg: list of filepaths.
+# Output: Total size in bytes of the files that exist.
+def path_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+# path_state() takes in an arg: path or path prefix from a command line.
+# Output: Dict of filepath to (size, mtime) for the file itself, or for prefix.* files (e.g. a BLAST database name).
+def path_state(path):
+    paths = [path] if os.path.isfile(path) else glob.glob(f"{glob.escape(path)}.*")
+    state = {}
+    for file in paths:
+        stat = os.stat(file)
+        state[file] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+# command_paths() takes in an arg: shell command line.
+# Output: List of tokens of the command that look like filepaths (contain "/"), including values of --key=value options.
+# A token is taken both whole (a quoted path with spaces) and split on spaces (a quoted list of paths), without BLAST's inner double quotes.
+def command_paths(cmd):
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        tokens = cmd.split()
+    paths = []
+    for token in tokens:
+        for part in dict.fromkeys([token, *token.split()]):
+            part = part.split("=", 1)[-1].strip("\"")
+            if "/" in part:
+                paths.append(part)
+    return paths
+
+# Tracer takes in no args.
+# Function: Collect timing and resource events of pipeline stages and external processes for one run.
+# Stage events record wall time, CPU time (of the pipeline and its child processes), peak RSS, input/output sizes and status.
+# Process events record the command, wall time, the CPU time and peak RSS of the process itself (from os.wait4) and its exit code.
+# The kernel reports a child's peak RSS from the fork, so it is never below the pipeline's own size at that point.
+# CPU time is process-wide, so when stages run concurrently each is charged the CPU time of everything running beside it.
+# abort() stops the run: live processes are terminated and no new ones are started.
+# An optional listener is called with every event as it is recorded, and with a "stage_start" event as each stage starts, e.g. to stream progress.
+class Tracer:
+    def __init__(self, listener = None):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.aborted = False
+        self.listener = listener
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+        if self.listener:
+            self.listener(event)
+
+    # stage() takes in 2 args: stage name and list of input filepaths.
+    # Function: Context manager timing one stage. The caller may set "status" ("skipped") and "output_bytes" on the yielded event.
+    # Peak RSS is the larger of this process's high-water mark and the peak of the external processes run during the stage.
+    @contextlib.contextmanager
+    def stage(self, name, inputs = ()):
+        event = {"type" : "stage", "name" : name, "status" : "ok", "input_bytes" : path_bytes(inputs), "output_bytes" : 0}
+        token = current_stage.set(name)
+        start = time.perf_counter()
+        if self.listener:
+            self.listener({"type" : "stage_start", "name" : name, "start" : round(start - self.origin, 6)})
+        cpu = cpu_seconds()
+        try:
+            yield event
+        except BaseException:
+            event["status"] = "failed"
+            raise
+        finally:
+            current_stage.reset(token)
+            children_rss = [e["peak_rss_mb"] for e in self.events if e["type"] == "process" and e["stage"] == name]
+            event.update({
+                "start" : round(start - self.origin, 6),
+                "wall" : round(time.perf_counter() - start, 6),
+                "cpu" : round(cpu_seconds() - cpu, 6),
+                "peak_rss_mb" : round(max([resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024] + children_rss), 1)
+            })
+            self.add(event)
+
+    # run() takes in a shell command line, whether to raise on failure and keyword arguments for subprocess.Popen.
+    # Function: Run the command like subprocess.call(cmd, shell = True), and record a process event.
+    # Filepaths on the command line are sized before and after the call: files created or changed count as outputs, the rest as inputs.
+    # With check, a non-zero exit code raises ToolError. After abort(), no command is started and ToolError is raised.
+    # Output: Exit code.
+    def run(self, cmd, check = False, **kwargs):
+        if self.aborted:
+            raise ToolError(cmd, None, current_stage.get())
+        paths = command_paths(cmd)
+        before = {}
+        for path in paths:
+            before.update(path_state(path))
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, shell = True, **kwargs)
+        with self.lock:
+            self.processes.add(process)
+            if self.aborted:
+                process.terminate()
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.perf_counter() - start
+
+        after = {}
+        for path in paths:
+            after.update(path_state(path))
+        outputs = {file : state for file, state in after.items() if before.get(file) != state}
+        self.add({
+            "type" : "process",
+            "name" : os.path.basename(cmd.split(None, 1)[0]) if cmd.strip() else "",
+            "cmd" : cmd,
+            "stage" : current_stage.get(),
+            "thread" : threading.get_ident(),
+            "start" : round(start - self.origin, 6),
+            "wall" : round(wall, 6),
+            "cpu" : round(usage.ru_utime + usage.ru_stime, 6),
+            "peak_rss_mb" : round(usage.ru_maxrss / 1024, 1),
+            "input_bytes" : sum(state[0] for file, state in before.items() if file not in outputs),
+            "output_bytes" : sum(state[0] for state in outputs.values()),
+            "exit_code" : process.returncode
+        })
+        if check and process.returncode != 0:
+            raise ToolError(cmd, process.returncode, current_stage.get())
+        return process.returncode
+
+    # abort() takes in no args.
+    # Function: Terminate every external process still running and refuse to start new ones, so a failed run stops quickly.
+    # The shell execs a single command in place, so the signal reaches the tool itself.
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            for process in self.processes:
+                process.terminate()
+
+    # write() takes in 2 args: out_dir and whether to also write a Chrome trace.
+    # Function: Write the events as {out_dir}_trace.json, and optionally as {out_dir}_trace.chrome.json for chrome://tracing or Perfetto.
+    # Output: List of trace filenames.
+    def write(self, out_dir, chrome = False):
+        trace_files = [f"{out_dir}_trace.json"]
+        with open(f"{out_dir}/{trace_files[0]}", "w") as file:
+            json.dump({"events" : self.events}, file, indent = 2)
+        if chrome:
+            trace_files.append(f"{out_dir}_trace.chrome.json")
+            threads = {}
+            chrome_events = []
+            for event in self.events:
+                tid = 0 if event["type"] == "stage" else threads.setdefault(event["thread"], len(threads) + 1)
+                args = {key : value for key, value in event.items() if key not in ["type", "name", "start", "wall", "thread"]}
+                chrome_events.append({"name" : event["name"], "cat" : event["type"], "ph" : "X", "ts" : event["start"] * 1e6, "dur" : event["wall"] * 1e6, "pid" : os.getpid(), "tid" : tid, "args" : args})
+            with open(f"{out_dir}/{trace_files[1]}", "w") as file:
+                json.dump({"traceEvents" : chrome_events, "displayTimeUnit" : "ms"}, file)
+        return trace_files
+
+    # summary() takes in no args.
+    # Output: End-of-run timing table as a string, one row per stage, then one row per external tool (calls summed).
+    def summary(self):
+        rows = [["Stage", "Status", "Wall s", "CPU s", "Peak RSS MB", "In MB", "Out MB"]]
+        for event in sorted((e for e in self.events if e["type"] == "stage"), key = lambda x: x["start"]):
+            rows.append([event["name"], event["status"], f"{event['wall']:.2f}", f"{event['cpu']:.2f}", f"{event['peak_rss_mb']:.1f}", f"{event['input_bytes'] / 1e6:.2f}", f"{event['output_bytes'] / 1e6:.2f}"])
+        rows.append(["Tool", "Calls (failed)", "Wall s", "CPU s", "Peak RSS MB", "In MB", "Out MB"])
+        tools = {}
+        for event in (e for e in self.events if e["type"] == "process"):
+            tool = tools.setdefault(event["name"], {"calls" : 0, "failed" : 0, "wall" : 0.0, "cpu" : 0.0, "peak_rss_mb" : 0.0, "input_bytes" : 0, "output_bytes" : 0})
+            tool["calls"] += 1
+            tool["failed"] += event["exit_code"] != 0
+            tool["peak_rss_mb"] = max(tool["peak_rss_mb"], event["peak_rss_mb"])
+            for key in ["wall", "cpu", "input_bytes", "output_bytes"]:
+                tool[key] += event[key]
+        for name, tool in sorted(tools.items(), key = lambda x: -x[1]["wall"]):
+            rows.append([name, f"{tool['calls']} ({tool['failed']})", f"{tool['wall']:.2f}", f"{tool['cpu']:.2f}", f"{tool['peak_rss_mb']:.1f}", f"{tool['input_bytes'] / 1e6:.2f}", f"{tool['output_bytes'] / 1e6:.2f}"])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = []
+        for row in rows:
+            if row[0] in ["Stage", "Tool"]:
+                lines.append("")
+            lines.append("  ".join(cell.ljust(width) if i < 2 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))))
+        return "\n".join(lines).strip("\n")
+
+_tracer = Tracer()
+_listener = None
+
+# set_trace_listener() takes in an arg: function of an event dict, or None.
+# Function: Set the listener given to every tracer start_trace() creates from now on, e.g. by a service worker streaming the progress of its jobs.
+def set_trace_listener(listener):
+    global _listener
+    _listener = listener
+
+# start_trace() takes in no args.
+# Function: Replace the shared tracer with an empty one, at the start of a pipeline run.
+# Output: The new shared tracer.
+def start_trace():
+    global _tracer
+    _tracer = Tracer(_listener)
+    return _tracer
+
+def get_tracer():
+    return _tracer
+
+# run_command() takes in a shell command line, whether to raise on failure and keyword arguments for subprocess.Popen.
+# Function: Run an external tool through the shared tracer, in place of subprocess.call(cmd, shell = True).
+# With check, a non-zero exit code raises ToolError.
+# Output: Exit code.
+def run_command(cmd, check = False, **kwargs):
+    return _tracer.run(cmd, check, **kwargs)
@@ -1,161 +1,86 @@
 #!.venv/bin/python3
 
+import argparse
+import contextlib
 import glob
-import json
-import subprocess
+import hashlib
+import os
 import re
+import shutil
 import sys
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import Checkpoint
+from cache import configure_cache, DEFAULT_CACHE_DIR
 from input_handler import validate_protein, validate_taxon
-from fetch_sequence import run_esearch, run_efetch
-from parse_fasta import parse_fasta
+from fetch_sequence import run_esearch_history, run_efetch_paged, run_efetch_accessions
+from catalogue import Catalogue, DEFAULT_CATALOGUE_DIR
+from parse_fasta import iter_fasta, write_records_jsonl
+from record_store import RecordStore
 from conservation_analysis import build_clustalo_input, run_clustalo, run_plotcon, get_consensus, get_infoalign
+from prosite_engine import run_native_prosite_scan, DEFAULT_PROSITE_DAT
 from scan_prosite import parse_clu_results, build_prosite_input, run_prosite_scan, parse_prosite_output
-from blast_analysis import make_blast_db, select_blast_ref, run_blast_search, parse_blast_output
+from blast_store import BlastStore, DEFAULT_STORE_DIR, DEFAULT_STORE_BYTES
+from blast_analysis import make_blast_db, select_blast_ref, run_blast_search, parse_blast_output, run_blast_multi, parse_blast_hits
+from instrument import start_trace, carry_context, available_cpus, ToolError
+from scheduler import Scheduler
+from plotting import has_display
+from tables import import_pyarrow, write_records_parquet, TABLE_FORMATS
+from compression import import_zstandard, COMPRESSIONS
 
-# main() runs the pipeline.
-def main():
-    
-    # This while loop prompts the user for an email. If the email is invalid, reprompt the user, until a valid email is inputted.
-    while True:
-        email = input("Your email (needed for NCBI URL request): ").strip()
-        if re.search(
-            r"^[a-zA-Z0-9.!#$%&'*+\/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*$", 
-            email, re.IGNORECASE
-        ):
-            break
-        else:
-            print("\nPlease input a valid email.")
-    
-    # This while loop prompts the user for a protein family, which is to be validated by validate_protein().
-    # If input is invalid, raise an error and reprompt user, until a valid protein family is inputted.
-    while True:
-        try:
-            pfam_input = input("Protein family: ").strip()
-            pfam_id, pfam_name = validate_protein(pfam_input)
-            break
-        except Exception as e:
-            print(f"\nPlease input a valid protein family. {e}")
-    
-    # This while loop prompts user for a taxonomic group, which is to be validated by validate_taxon().
-    # If input is invalid, raise an error and reprompt user, until a valid taxon group is inputted.
+EMAIL_PATTERN = r"^[a-zA-Z0-9.!#$%&'*+\/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*$"
+
+# valid_email() takes in an arg: email string.
+# Output: True if the email is valid, else False.
+def valid_email(email):
+    return bool(re.search(EMAIL_PATTERN, email, re.IGNORECASE))
+
+# confirm() takes in an arg: yes/no question.
+# Function: This while loop prompts user for yes/no. If invalid input, raise an error and reprompt user, until valid.
+# Output: True for yes, False for no.
+def confirm(question):
     while True:
         try:
-            taxon_input = input("Taxon group: ").strip()
-            taxon_id, taxon_name = validate_taxon(taxon_input, email)
+            answer = input(question).strip().lower()
+            if answer not in ["y", "n", "yes", "no"]:
+                raise ValueError
             break
+        except EOFError:
+            sys.exit("\nNo input left to read. Pipeline stopped!")
         except Exception as e:
-            print(f"\nPlease input a valid taxon group. {e}")
-    
-    # When all inputs are valid, print these statements.
-    print(f"\nSuccess! Your protein family: {pfam_name}\tPfam ID: {pfam_id}")
-    print(f"Success! Your taxon group: {taxon_name}\tTaxon ID: {taxon_id}\n")
-    
-    # Query NCBI Protein database using Entrez esearch to get a list of unique IDs, through run_esearch().
-    # run_esearch() takes in 3 args: protein family name, taxon ID and email. Output: List of unique IDs.
-    # If list of unique IDs is empty, exit system with "no result" message.
-    print("Searching NCBI Protein...")
-    ids_list = run_esearch(pfam_name, taxon_id, email)
-    if not ids_list:
-        sys.exit("\nNo UIDs could be retrieved from NCBI Protein! Please try again.")
-    
-    # If there are more than 1000 entries in the dataset, prompt user for confirmation.
-    # This while loop prompts user for yes/no. If invalid input, raise an error and reprompt user, until valid.
-    # If no, exit system. Else, continue.
-    elif len(ids_list) > 1000:
-        while True:
-            try:
-                warner = input("Your dataset contains more than 1000 protein sequences!\nAre you sure you want to continue? (y/n) ").strip().lower()
-                if warner not in ["y", "n", "yes", "no"]:
-                    raise ValueError
-                break
-            except Exception as e:
-                print("\nInvalid input.")
-        if warner in ["n", "no"]:
-            sys.exit("\nPipeline stopped!")
-    
-    # Make an output directory named after protein family and taxon group. Store directory name as out_dir.
-    print("Protein UIDs successfully retrieved!\n")
-    out_dir = f"{pfam_name}_{taxon_name}"
-    subprocess.call(f"rm -rf {out_dir}", shell = True)
-    subprocess.call(f"mkdir -p {out_dir}", shell = True)
-    
-    # With the list of unique IDs obtained from esearch, query NCBI Protein database using Entrez efetch to get a raw FASTA file of all protein sequences, through run_efetch().
-    # run_efetch() takes in 3 args: list of unique IDs, out_dir and email. Output: Raw FASTA filename.
-    print("Fetching all protein sequences in FASTA format...")
-    out_fasta = run_efetch(ids_list, out_dir, email)
-    print(f"FASTA sequences successfully downloaded to {out_fasta}\n")
-    
-    # Parse raw FASTA file into JSON format, through parse_fasta().
-    # parse_fasta() takes in 2 args: out_dir and raw FASTA filename. Output: All protein sequences in JSON format.
-    print(f"Parsing {out_fasta}...")
-    records = parse_fasta(out_dir, out_fasta)
-    with open(f"{out_dir}/{out_dir}_records.json", "w") as file:
-        json.dump(records, file, indent = 2)
-    print(f"Successfully parsed {out_fasta}\n")
-    
-    # This while loop prompts user for an integer, for the number of sequences to be analysed with ClustalO.
-    # Input needs to be an integer <= Total number of sequences. If invalid, raise an error and reprompt user, until valid.
-    # If input > 2000 and exceeds recommended range, prompt user for a confirmation (yes/no). If invalid input, raise an error and reprompt user, until valid.
-    # If no, reprompt user for another integer. Else, continue.
+            print("\nInvalid input.")
+    return answer in ["y", "yes"]
+
+# prompt_sample_size() takes in an arg: total number of sequences.
+# Function: This while loop prompts user for an integer, for the number of sequences to be analysed with ClustalO.
+# Input needs to be an integer <= Total number of sequences. If invalid, raise an error and reprompt user, until valid.
+# If input > 1000 and exceeds recommended range, prompt user for a confirmation (yes/no). If no, reprompt user for another integer.
+# Output: Sample size.
+def prompt_sample_size(n_records):
     while True:
         try:
-            print(f"Please input a number for the number of sequences to be analysed with ClustalO. Maximum: {len(records)}")
+            print(f"Please input a number for the number of sequences to be analysed with ClustalO. Maximum: {n_records}")
             print("The top few sequences with the largest lengths will be used for conservation analysis.")
             print("Note: The larger the number, the slower the analysis. Recommended: 500-1000")
             conservation_analysis_size = int(input(f"Sample size: ").strip())
-            if conservation_analysis_size > len(records):
+            if conservation_analysis_size > n_records:
                 raise ValueError("Invalid input exceeds maximum size.")
 
             if conservation_analysis_size > 1000:
-                while True:
-                    try:
-                        warner2 = input("\nYour input exceeds the recommended range. Are you sure you want to continue? (y/n) ").strip().lower()
-                        if warner2 not in ["y", "n", "yes", "no"]:
-                            raise ValueError
-                        break
-                    except Exception as e:
-                        print("\nInvalid input.")
-                if warner2 in ["n", "no"]:
+                if not confirm("\nYour input exceeds the recommended range. Are you sure you want to continue? (y/n) "):
                     print("\nRetrying...")
                     continue
-            
-            break
+
+            return conservation_analysis_size
+        except EOFError:
+            sys.exit("\nNo input left to read. Pipeline stopped!")
         except Exception as e:
             print(f"\nInvalid input. {e}")
-    
-    # Show user's input by printing these statements.
-    print(f"\nYour sample size: {conservation_analysis_size}")
-    print(f"The {conservation_analysis_size} longest protein sequences will be used for conservation analysis.\n")
-    
-    # Perform conservation analysis with ClustalO, through build_clustalo_input() and run_clustalo().
-    # Make an output directory for ClustalO and store the directory name as out_clustalo.
-    # build_clustalo_input() takes in 4 args: Parsed sequences to JSON, out_dir, out_clustalo and user's input for sample size. Output: Input FASTA filename for ClustalO.
-    # run_clustalo() takes in 3 args: out_dir, out_clustalo and input FASTA filename for ClustalO. Output: Multi-Sequence Alignment(MSA) output filename with .clu.
-    print("Performing conservation analysis with ClustalO and Plotcon...")
-    out_clustalo = f"{out_dir}_clustalo"
-    subprocess.call(f"mkdir -p {out_dir}/{out_clustalo}", shell = True)
-    clustalo_input = build_clustalo_input(records, out_dir, out_clustalo, conservation_analysis_size)
-    clustalo_output = run_clustalo(out_dir, out_clustalo, clustalo_input)
-    print(f"ClustalO output successfully generated! Generated {clustalo_output}")
 
-    # With the Multi-Sequence Alignment(MSA) output, visualise data with Plotcon, through run_plotcon().
-    # run_plotcon() takes in 3 args: out_dir, out_clustalo and MSA output. Output: Plotcon graph and raw data filenames.
-    # Obtain consensus sequence with cons, through get_consensus().
-    # get_consensus() takes in 3 args: out_dir, out_clustalo and MSA output. Output: Consensus sequence FASTA filename.
-    # Obtain % similarity of sequences to consensus sequence with infoalign, through get_infoalign().
-    # get_infoalign() takes in 3 args: out_dir, out_clustalo and MSA output. Output: infoalign results .txt filename.
-    plotcon_graph, plotcon_text = run_plotcon(out_dir, out_clustalo, clustalo_output)
-    print(f"Plotcon output successfully generated! Generated {plotcon_graph}, {plotcon_text}")
-    consensus = get_consensus(out_dir, out_clustalo, clustalo_output)
-    print(f"Successfully obtained consensus sequence! Generated {consensus}")
-    infoalign_results = get_infoalign(out_dir, out_clustalo, clustalo_output)
-    print(f"Successfully obtained infoalign results for {clustalo_output}! Generated {infoalign_results}\n")
-    
-    # This while loop prompts user for an integer, for the number of sequences to be scanned for PROSITE motifs.
-    # Input needs to be an integer <= Number of selected sequences for conservation analysis. If invalid, raise an error and reprompt user, until valid.
+# prompt_scan_size() takes in an arg: sample size used for conservation analysis.
+# Function: This while loop prompts user for an integer, for the number of sequences to be scanned for PROSITE motifs.
+# Input needs to be an integer <= Number of selected sequences for conservation analysis. If invalid, raise an error and reprompt user, until valid.
+# Output: Scan size.
+def prompt_scan_size(conservation_analysis_size):
     while True:
         try:
             print(f"Please input a number for the number of sequences to be scanned for PROSITE motifs. Maximum: {conservation_analysis_size}")
@@ -163,60 +88,431 @@ def main():
             scan_size = int(input(f"Scan size: ").strip())
             if scan_size > conservation_analysis_size:
                 raise ValueError("Invalid input exceeds maximum size.")
-            break
+            return scan_size
+        except EOFError:
+            sys.exit("\nNo input left to read. Pipeline stopped!")
         except Exception as e:
             print(f"\nInvalid input. {e}")
-    
+
+# Tuning options of run_pipeline(), set from the command line through add_pipeline_arguments().
+PIPELINE_OPTIONS = {
+    "catalogue" : False,
+    "catalogue_dir" : DEFAULT_CATALOGUE_DIR,
+    "compression" : "none",
+    "threads" : 0,
+    "cpu_budget" : available_cpus(),
+    "scan_chunk" : 1,
+    "incremental_msa" : False,
+    "realign_fraction" : 0.2,
+    "selection" : "longest",
+    "identity" : 0.9,
+    "conservation_engine" : "emboss",
+    "prosite_engine" : "patmatmotifs",
+    "prosite_dat" : DEFAULT_PROSITE_DAT,
+    "scan_all" : False,
+    "blast_store" : False,
+    "blast_store_dir" : DEFAULT_STORE_DIR,
+    "blast_store_gb" : DEFAULT_STORE_BYTES / 1024 ** 3,
+    "blast_mode" : "reference",
+    "blast_evalue" : 1e-5,
+    "chrome_trace" : False,
+    "table_format" : "tsv",
+    "fresh" : False
+}
+
+# run_pipeline() takes in 7 args and tuning options: email, Pfam name, taxon ID, taxon name, sample size, scan size, interactive flag and any of PIPELINE_OPTIONS.
+# Function: Run every stage of the pipeline from esearch to BLAST in the current working directory.
+# If sample size or scan size is None, prompt the user for it. In non-interactive mode, both sizes are needed (raises ValueError), sizes larger than the data are capped,
+# no confirmation is asked, and plots are saved without being shown.
+# Output: out_dir.
+def run_pipeline(email, pfam_name, taxon_id, taxon_name, sample_size = None, scan_size = None, interactive = True, **options):
+    if not interactive and (sample_size is None or scan_size is None):
+        raise ValueError("Non-interactive runs need both a sample size and a scan size.")
+    options = {**PIPELINE_OPTIONS, **options}
+    # Tool threads default to half the cores in the CPU budget, so a multithreaded stage (ClustalO, BLAST, the PROSITE scan) leaves CPUs
+    # for the stages the scheduler runs beside it, e.g. the BLAST database build during ClustalO.
+    threads = options["threads"] or max(1, min(available_cpus(), options["cpu_budget"]) // 2)
+    if options["table_format"] == "parquet":
+        import_pyarrow()
+    if options["compression"] == "zstd":
+        import_zstandard()
+    tracer = start_trace()
+
+    # Query NCBI Protein database using Entrez esearch with usehistory, so the full result set is kept on the Entrez history server, through run_esearch_history().
+    # run_esearch_history() takes in 3 args: protein family name, taxon ID and email. Output: Dict with total count, WebEnv and query_key.
+    # If there are no results, exit system with "no result" message.
+    print("Searching NCBI Protein...")
+    with tracer.stage("esearch"):
+        search = run_esearch_history(pfam_name, taxon_id, email)
+    if not search:
+        sys.exit("\nNo UIDs could be retrieved from NCBI Protein! Please try again.")
+
+    # If there are more than 1000 entries in the dataset, prompt user for confirmation. If no, exit system. Else, continue.
+    elif interactive and search["count"] > 1000:
+        if not confirm("Your dataset contains more than 1000 protein sequences!\nAre you sure you want to continue? (y/n) "):
+            sys.exit("\nPipeline stopped!")
+
+    # Make an output directory named after protein family and taxon group. Store directory name as out_dir.
+    # The directory is kept between runs so completed stages can be skipped, unless a fresh run is asked for.
+    # Stages are checkpointed through Checkpoint.run(), which skips a stage if the hash of its input files and parameters is unchanged since it last completed.
+    print("Protein UIDs successfully retrieved!\n")
+    out_dir = f"{pfam_name}_{taxon_name}"
+    if options["fresh"]:
+        shutil.rmtree(out_dir, ignore_errors = True)
+    os.makedirs(out_dir, exist_ok = True)
+    checkpoint = Checkpoint(out_dir)
+
+    # With the esearch result set on the history server, page through it with concurrent efetch batches to get a raw FASTA file of all protein sequences, through run_efetch_paged().
+    # run_efetch_paged() takes in 3 args: esearch history dict, out_dir and email. Output: Raw FASTA filename.
+    # With the catalogue, only the uids of the result set are listed, through run_efetch_accessions(), and the records are brought up to date from the catalogue,
+    # downloading new uids only, through Catalogue.refresh(). The fetch stage is then skipped only if the uids are unchanged.
+    # run_efetch_accessions() takes in 2 args: esearch history dict and email. Output: List of uids.
+    # Catalogue.refresh() takes in 4 args: esearch history dict, list of uids, email and output FASTA filepath. Output: Numbers of new, withdrawn and kept records.
+    fetch_params = {"term" : search["term"], "count" : search["count"]}
+    if options["catalogue"]:
+        with tracer.stage("esearch_uids"):
+            uids = run_efetch_accessions(search, email)
+        fetch_params["uids"] = hashlib.sha256("\n".join(uids).encode()).hexdigest()
+    # The raw FASTA file is streamed to disk, gzip or zstd compressed with the compression option, and read back decompressed as a stream by iter_fasta().
+    if options["compression"] != "none":
+        fetch_params["compression"] = options["compression"]
+    def fetch_stage():
+        out_fasta = f"{out_dir}_rawsequences.fasta{COMPRESSIONS[options['compression']]}"
+        if options["catalogue"]:
+            Catalogue(options["catalogue_dir"]).refresh(search, uids, email, f"{out_dir}/{out_fasta}")
+        else:
+            print(f"Fetching all {search['count']} protein sequences in FASTA format...")
+            out_fasta = run_efetch_paged(search, out_dir, email, compression = options["compression"])
+        return out_fasta, [f"{out_dir}/{out_fasta}"]
+    out_fasta = checkpoint.run("fetch", [], fetch_params, fetch_stage)
+    print(f"FASTA sequences successfully downloaded to {out_fasta}\n")
+
+    # Stream raw FASTA file into a record store, through iter_fasta() and RecordStore.build().
+    # iter_fasta() takes in an arg: raw FASTA filepath. Output: Generator of protein sequence dicts.
+    # RecordStore.build() takes in 2 args: records and store directory. Output: RecordStore.
+    # The store keeps every column in one contiguous buffer on disk, memory-mapped on load, with O(1) lookup by uid. Every later stage reads it, and writes FASTA from it.
+    # The records are also written as JSON Lines from the store, through write_records_jsonl(), for use outside the pipeline.
+    # write_records_jsonl() takes in 2 args: records and JSON Lines filepath. Output: Number of records written.
+    # With the parquet table format, the records are also exported as a typed table, through write_records_parquet().
+    # write_records_parquet() takes in 2 args: RecordStore and Parquet filepath.
+    table_format = options["table_format"]
+    records_path = f"{out_dir}/{out_dir}_records"
+    records_files = RecordStore.files(records_path)
+    records_json = f"{records_path}.json"
+    def parse_stage():
+        print(f"Parsing {out_fasta}...")
+        n_records = write_records_jsonl(RecordStore.build(iter_fasta(f"{out_dir}/{out_fasta}"), records_path), records_json)
+        if table_format == "parquet":
+            write_records_parquet(RecordStore.load(records_path), f"{records_path}.parquet")
+            return n_records, records_files + [records_json, f"{records_path}.parquet"]
+        return n_records, records_files + [records_json]
+    n_records = checkpoint.run("parse", [f"{out_dir}/{out_fasta}"], {"table_format" : table_format} if table_format != "tsv" else {}, parse_stage)
+    store = RecordStore.load(records_path)
+    print(f"Successfully parsed {out_fasta}\n")
+
+    # Prompt user for the number of sequences to be analysed with ClustalO, through prompt_sample_size(), unless given.
+    if sample_size is None:
+        sample_size = prompt_sample_size(n_records)
+    conservation_analysis_size = min(sample_size, n_records)
+
+    # Show user's input by printing these statements.
+    print(f"\nYour sample size: {conservation_analysis_size}")
+    print(f"The {conservation_analysis_size} longest protein sequences will be used for conservation analysis.\n")
+
+    # Prompt user for the number of sequences to be scanned for PROSITE motifs, through prompt_scan_size(), unless given.
+    # Both sizes are asked for before any analysis starts, so the stages below can run without waiting on input.
+    if scan_size is None:
+        scan_size = prompt_scan_size(conservation_analysis_size)
+    scan_size = min(scan_size, conservation_analysis_size)
+
     # Show user's input by printing these statements.
     print(f"\nYour scan size: {scan_size}")
     print(f"The {scan_size} protein sequences with the highest similarity to the consensus sequence will be scanned for PROSITE motifs.\n")
-    
-    # Make an output directory for PROSITE scan and store the directory name as out_prosite.
+
+    # Make output directories for ClustalO, PROSITE scan and BLAST analysis, and store the directory names as out_clustalo, out_prosite and blast_db.
+    out_clustalo = f"{out_dir}_clustalo"
+    out_prosite = f"{out_dir}_prosite"
+    blast_db = f"{out_dir}_blast"
+    for directory in [out_clustalo, out_prosite, blast_db]:
+        os.makedirs(f"{out_dir}/{directory}", exist_ok = True)
+
+    # The analysis stages form a dependency graph, run through Scheduler.
+    # Scheduler takes in 2 args: CPU budget and whether to run independent stages concurrently.
+    # Each stage is added with the stages it depends on and the CPUs it uses, and starts once they have finished and the CPUs are free,
+    # so independent stages overlap: the BLAST database is built while ClustalO aligns, and BLAST runs beside the PROSITE scan.
+    # When plots are shown on screen, stages run one at a time instead. Stage results are read from scheduler.results.
+    # If an external tool fails, the other stages are stopped and the pipeline exits with the tool's error.
+    scheduler = Scheduler(options["cpu_budget"], concurrent = not (interactive and has_display()))
+    results = scheduler.results
+
+    # Perform conservation analysis with ClustalO, through build_clustalo_input() and run_clustalo().
+    # build_clustalo_input() takes in 6 args: RecordStore of parsed sequences, out_dir, out_clustalo, user's input for sample size, selection mode and identity threshold. Output: Input FASTA filename for ClustalO.
+    # run_clustalo() takes in 6 args: out_dir, out_clustalo, input FASTA filename for ClustalO, number of threads, whether to update the alignment incrementally and realignment threshold.
+    # Output: Multi-Sequence Alignment(MSA) output filename with .clu.
+    # With incremental_msa, only sequences new since the last alignment are profile-aligned onto it, unless more than realign_fraction of them changed.
+    def clustalo_stage():
+        clustalo_input = build_clustalo_input(store, out_dir, out_clustalo, conservation_analysis_size, options["selection"], options["identity"])
+        clustalo_output = run_clustalo(out_dir, out_clustalo, clustalo_input, threads, options["incremental_msa"], options["realign_fraction"])
+        return clustalo_output, [f"{out_dir}/{out_clustalo}/{clustalo_input}", f"{out_dir}/{out_clustalo}/{clustalo_output}"]
+    clustalo_params = {"sample_size" : conservation_analysis_size, "selection" : options["selection"]}
+    if options["selection"] == "cluster":
+        clustalo_params["identity"] = options["identity"]
+    if options["incremental_msa"]:
+        clustalo_params.update({"incremental" : True, "realign_fraction" : options["realign_fraction"]})
+    def clustalo_task():
+        print("Performing conservation analysis with ClustalO and Plotcon...")
+        clustalo_output = checkpoint.run("clustalo", records_files, clustalo_params, clustalo_stage)
+        print(f"ClustalO output successfully generated! Generated {clustalo_output}")
+        return clustalo_output
+    scheduler.add("clustalo", clustalo_task, cpus = threads)
+
+    # With the Multi-Sequence Alignment(MSA) output, visualise data with Plotcon, through run_plotcon().
+    # run_plotcon() takes in 4 args: out_dir, out_clustalo, MSA output and whether to show the graph. Output: Plotcon graph and raw data filenames.
+    # Obtain consensus sequence with cons, through get_consensus().
+    # get_consensus() takes in 3 args: out_dir, out_clustalo and MSA output. Output: Consensus sequence FASTA filename.
+    # Obtain % similarity of sequences to consensus sequence with infoalign, through get_infoalign().
+    # get_infoalign() takes in 3 args: out_dir, out_clustalo and MSA output. Output: infoalign results .txt filename.
+    # The three EMBOSS tools only read the MSA, so they run concurrently.
+    # With the numpy engine, compute all three from one parse of the alignment instead, through run_conservation_engine().
+    # run_conservation_engine() takes in 4 args: out_dir, out_clustalo, MSA output and whether to show the graph. Output: The same four filenames.
+    def conservation_task():
+        clustalo_output = results["clustalo"]
+        def conservation_stage():
+            if options["conservation_engine"] == "numpy":
+                from conservation_engine import run_conservation_engine
+                plotcon_graph, plotcon_text, consensus, infoalign_results = run_conservation_engine(out_dir, out_clustalo, clustalo_output, interactive)
+            else:
+                with ThreadPoolExecutor(max_workers = 3) as executor:
+                    plotcon = executor.submit(carry_context(run_plotcon), out_dir, out_clustalo, clustalo_output, interactive)
+                    consensus = executor.submit(carry_context(get_consensus), out_dir, out_clustalo, clustalo_output)
+                    infoalign_results = executor.submit(carry_context(get_infoalign), out_dir, out_clustalo, clustalo_output)
+                    (plotcon_graph, plotcon_text), consensus, infoalign_results = plotcon.result(), consensus.result(), infoalign_results.result()
+            outputs = [f"{out_dir}/{out_clustalo}/{file}" for file in [plotcon_graph, plotcon_text, consensus, infoalign_results]]
+            return [plotcon_graph, plotcon_text, consensus, infoalign_results], outputs
+        plotcon_graph, plotcon_text, consensus, infoalign_results = checkpoint.run("conservation", [f"{out_dir}/{out_clustalo}/{clustalo_output}"], {"engine" : options["conservation_engine"]}, conservation_stage)
+        print(f"Plotcon output successfully generated! Generated {plotcon_graph}, {plotcon_text}")
+        print(f"Successfully obtained consensus sequence! Generated {consensus}")
+        print(f"Successfully obtained infoalign results for {clustalo_output}! Generated {infoalign_results}\n")
+        return infoalign_results
+    scheduler.add("conservation", conservation_task, ["clustalo"], cpus = 1 if options["conservation_engine"] == "numpy" else 3)
+
     # Filter for the top sequences with high similarities to the consensus sequence, through parse_clu_results().
-    # parse_clu_results() takes in 6 args: Parsed sequences to JSON, out_dir, out_clustalo, infoalign results file, out_prosite and user's input for scan size.
+    # parse_clu_results() takes in 7 args: RecordStore of parsed sequences, out_dir, out_clustalo, infoalign results file, out_prosite, user's input for scan size and table format.
     # Output: The top sequences in JSON and infoalign results.
-    out_prosite = f"{out_dir}_prosite"
-    subprocess.call(f"mkdir -p {out_dir}/{out_prosite}", shell = True)
-    top_records, top_df = parse_clu_results(records, out_dir, out_clustalo, infoalign_results, out_prosite, scan_size)
-    
-    # Scan protein sequences for PROSITE motifs using patmatmotifs, through build_prosite_input() and run_prosite_scan().
-    # build_prosite_input() takes in 3 args: Top sequences in JSON, out_dir, out_prosite. Output: List of input FASTA files(filepaths) for patmatmotifs.
-    # run_prosite_scan() takes in 3 args: out_dir, out_prosite and list of input FASTA files(filepaths) for patmatmotifs. Output: List of output patmatmotifs files.
-    print("Scanning protein sequences for PROSITE motifs...")
-    prosite_input = build_prosite_input(top_records, out_dir, out_prosite)
-    run_prosite_scan(out_dir, out_prosite, prosite_input)
-    prosite_output = list(map(lambda x: x + ".patmatmotifs", prosite_input))
-    print(f"PROSITE output successfully generated! Generated {len(prosite_output)} .patmatmotifs files.")
+    def select_top_task():
+        infoalign_results = results["conservation"]
+        with tracer.stage("select_top", [f"{out_dir}/{out_clustalo}/{infoalign_results}"]):
+            return parse_clu_results(store, out_dir, out_clustalo, infoalign_results, out_prosite, scan_size, table_format)
+    scheduler.add("select_top", select_top_task, ["conservation"])
 
+    # Scan protein sequences for PROSITE motifs.
+    # With the native engine, scan the records in-process with compiled patterns, through run_native_prosite_scan(). With scan_all, every fetched record is scanned instead of the top few.
+    # run_native_prosite_scan() takes in 4 args: records, out_dir, out_prosite and PROSITE data file. Output: List with one report file.
+    # Else, scan using patmatmotifs, through build_prosite_input() and run_prosite_scan().
+    # build_prosite_input() takes in 3 args: Top sequences in JSON, out_dir, out_prosite. Output: List of input FASTA files(filepaths) for patmatmotifs.
+    # run_prosite_scan() takes in 5 args: out_dir, out_prosite, list of input FASTA files(filepaths) for patmatmotifs, number of workers and sequences per call. Output: List of output patmatmotifs files.
     # Parse output patmatmotifs files into a summary table, and plot a count plot of PROSITE motifs found, through parse_prosite_output().
-    # parse_prosite_output() takes in 3 args: out_dir, out_prosite and list of output patmatmotifs files.
+    # parse_prosite_output() takes in 5 args: out_dir, out_prosite, list of output patmatmotifs files, whether to show the plot and table format.
     # Output: Summary table of PROSITE motif locations per sequence, count plot of PROSITE motifs found, and list of unique PROSITE motifs found.
-    prosite_summary_df, prosite_motifs = parse_prosite_output(out_dir, out_prosite, prosite_output)
-    print(f"Generated prosite_scan_summary.tsv! PROSITE motifs found:\n{prosite_motifs}\n")
-    
-    # Make an output directory for BLAST analysis and store the directory name as blast_db.
-    # Construct a BLAST database using makeblastdb, through make_blast_db().
-    # make_blast_db() takes in 3 args: out_dir, raw FASTA file of all protein sequences and blast_db. Output: Custom BLAST database name.
-    print("Running BLAST on protein sequences...")
-    blast_db = f"{out_dir}_blast"
-    subprocess.call(f"mkdir -p {out_dir}/{blast_db}", shell = True)
-    make_blast_db(out_dir, records, blast_db)
+    def prosite_task():
+        infoalign_results = results["conservation"]
+        top_records, top_df = results["select_top"]
+        def prosite_stage():
+            print("Scanning protein sequences for PROSITE motifs...")
+            if options["prosite_engine"] == "native":
+                scan_records = store if options["scan_all"] else top_records
+                prosite_output = run_native_prosite_scan(scan_records, out_dir, out_prosite, options["prosite_dat"])
+            else:
+                prosite_input = build_prosite_input(top_records, out_dir, out_prosite)
+                prosite_output = run_prosite_scan(out_dir, out_prosite, prosite_input, threads, options["scan_chunk"])
+            print(f"PROSITE output successfully generated! Generated {len(prosite_output)} .patmatmotifs files.")
+            prosite_summary_df, prosite_motifs = parse_prosite_output(out_dir, out_prosite, prosite_output, interactive, table_format)
+            outputs = [f"{out_dir}/{out_prosite}/{file}" for file in [f"prosite_scan_summary.{table_format}", f"prosite_locations.{table_format}", "count_plot_motifs.png"]]
+            return prosite_motifs, outputs
+        prosite_inputs = records_files + [f"{out_dir}/{out_clustalo}/{infoalign_results}"]
+        prosite_params = {"scan_size" : scan_size, "engine" : options["prosite_engine"]}
+        if table_format != "tsv":
+            prosite_params["table_format"] = table_format
+        if options["prosite_engine"] == "native":
+            prosite_inputs.append(options["prosite_dat"])
+            prosite_params["scan_all"] = options["scan_all"]
+        prosite_motifs = checkpoint.run("prosite", prosite_inputs, prosite_params, prosite_stage)
+        print(f"Generated prosite_scan_summary.{table_format}! PROSITE motifs found:\n{prosite_motifs}\n")
+        return prosite_motifs
+    scheduler.add("prosite", prosite_task, ["select_top"], cpus = 1 if options["prosite_engine"] == "native" else threads)
+
+    # Construct a BLAST database using makeblastdb, through make_blast_db(). It depends only on the records, so it runs beside ClustalO.
+    # make_blast_db() takes in 4 args: out_dir, RecordStore of all protein sequences, blast_db and an optional BlastStore. Output: BLAST database path.
+    # With blast_store, the database comes from the persistent store shared across runs and jobs, keyed on the record set.
+    # It is read locked in the store until BLAST has finished with it, so other jobs cannot evict it in between.
+    blast_store = BlastStore(options["blast_store_dir"], int(options["blast_store_gb"] * 1024 ** 3)) if options["blast_store"] else None
+    def blast_db_stage():
+        db_path = make_blast_db(out_dir, store, blast_db, blast_store)
+        return db_path, glob.glob(f"{db_path}.*")
+    blast_db_params = {"store" : options["blast_store_dir"]} if options["blast_store"] else {}
+    def blast_db_task():
+        print("Building the BLAST database...")
+        return checkpoint.run("blast_db", records_files, blast_db_params, blast_db_stage)
+    scheduler.add("blast_db", blast_db_task)
 
     # Select and construct a BLAST reference sequence FASTA file using the sequence with the highest similarity to the consensus sequence from ClustalO, through select_blast_ref().
-    # select_blast_ref() takes in 4 args: Top sequences in JSON, top sequences in infoalign results, out_dir and blast_db. Output: BLAST reference sequence FASTA file.
+    # select_blast_ref() takes in 4 args: RecordStore of parsed sequences, top sequences in infoalign results, out_dir and blast_db. Output: BLAST reference sequence FASTA file.
     # Run BLAST analysis with blastp, through run_blast_search().
-    # run_blast_search takes in 3 args: out_dir, BLAST reference sequence FASTA file and blast_db. Output: BLAST output file.
-    blast_ref = select_blast_ref(top_records, top_df, out_dir, blast_db)
-    print(f"Using {blast_ref} as BLAST reference sequence...")
-    blast_output = run_blast_search(out_dir, blast_ref, blast_db)
-    print(f"Successfully completed BLAST analysis! Generated {blast_output}")
-
+    # run_blast_search takes in 5 args: out_dir, BLAST reference sequence FASTA file, blast_db, number of threads and BLAST database path. Output: BLAST output file.
     # Visualise BLAST output by plotting a scatterplot of BLAST hits (Alignment Length against % Identity), through parse_blast_output().
-    # parse_blast_output() takes in 3 args: out_dir, blast_db and BLAST output file. Output: Scatterplot of BLAST hits and parsed BLAST output to pandas dataframe.
-    blast_df = parse_blast_output(out_dir, blast_db, blast_output)
+    # parse_blast_output() takes in 5 args: out_dir, blast_db, BLAST output file, whether to show the plot and table format. Output: Scatterplot of BLAST hits and parsed BLAST output to pandas dataframe.
+    # In "top" or "all" BLAST mode, BLAST the top sequences or every record against the database instead, through run_blast_multi(), with the queries sharded across concurrent blastp processes.
+    # run_blast_multi() takes in 7 args: out_dir, RecordStore, query record indices, blast_db, BLAST database path, number of threads and e-value cutoff. Output: List of shard hit table files.
+    # Merge the shards into one e-value filtered hit table and plot it, through parse_blast_hits().
+    # parse_blast_hits() takes in 7 args: out_dir, blast_db, list of shard hit table files, e-value cutoff, whether to show the plot, maximum points plotted and table format. Output: Hit table filename, sequence names and typed hit array.
+    blast_mode = options["blast_mode"]
+    if blast_mode == "reference":
+        def blast_ref_task():
+            top_records, top_df = results["select_top"]
+            with tracer.stage("blast_ref"):
+                blast_ref = select_blast_ref(store, top_df, out_dir, blast_db)
+            print(f"Using {blast_ref} as BLAST reference sequence...")
+            return blast_ref
+        scheduler.add("blast_ref", blast_ref_task, ["select_top"])
+    def blast_task():
+        db_path = results["blast_db"]
+        top_records, top_df = results["select_top"]
+        if blast_mode == "reference":
+            blast_ref = results["blast_ref"]
+            blast_inputs = [f"{out_dir}/{blast_db}/{blast_ref}"] + records_files
+        else:
+            print(f"BLASTing {'the top ' + str(scan_size) if blast_mode == 'top' else 'all ' + str(n_records)} sequences against the database...")
+            blast_inputs = records_files + [f"{out_dir}/{out_clustalo}/{results['conservation']}"]
+        def blast_stage():
+            with blast_store.reading(db_path) if blast_store else contextlib.nullcontext():
+                print("Running BLAST on protein sequences...")
+                if blast_mode == "reference":
+                    blast_output = run_blast_search(out_dir, blast_ref, blast_db, threads, db_path)
+                    blast_df = parse_blast_output(out_dir, blast_db, blast_output, interactive, table_format)
+                    if table_format == "parquet":
+                        return blast_output, [f"{out_dir}/{blast_db}/{file}" for file in [blast_output, blast_output.replace(".out", ".parquet"), "scatterplot_blast.png"]]
+                else:
+                    query_indices = [store.index(entry["uid"]) for entry in top_records] if blast_mode == "top" else range(len(store))
+                    shard_outputs = run_blast_multi(out_dir, store, query_indices, blast_db, db_path, threads, options["blast_evalue"])
+                    blast_output, hit_names, hits = parse_blast_hits(out_dir, blast_db, shard_outputs, options["blast_evalue"], interactive, table_format = table_format)
+                return blast_output, [f"{out_dir}/{blast_db}/{blast_output}", f"{out_dir}/{blast_db}/scatterplot_blast.png"]
+        blast_params = {"db" : db_path, "mode" : blast_mode}
+        if blast_mode != "reference":
+            blast_params.update({"scan_size" : scan_size, "evalue" : options["blast_evalue"]})
+        if table_format != "tsv":
+            blast_params["table_format"] = table_format
+        blast_output = checkpoint.run("blast", blast_inputs, blast_params, blast_stage)
+        print(f"Successfully completed BLAST analysis! Generated {blast_output}")
+        return blast_output
+    scheduler.add("blast", blast_task, ["blast_db", "blast_ref" if blast_mode == "reference" else "select_top"], cpus = threads)
 
+    try:
+        scheduler.run()
+    except ToolError as e:
+        tracer.write(out_dir, options["chrome_trace"])
+        sys.exit(f"\nPipeline stopped! {e}")
+    except Exception:
+        tracer.write(out_dir, options["chrome_trace"])
+        raise
+    finally:
+        if blast_store:
+            blast_store.release()
+
+    # Write the timing and resource trace of every stage and external tool call, and print the end-of-run timing table.
+    trace_files = tracer.write(out_dir, options["chrome_trace"])
+    print(f"\n{tracer.summary()}\n")
+    print(f"Timing trace written to {', '.join(trace_files)}")
     print(f"\nFull analysis successfully completed! Check {out_dir} for all outputs.\n")
-    
+    return out_dir
+
+# add_pipeline_arguments() takes in an arg: argparse parser.
+# Function: Add the command line switches shared by interactive and batch mode.
+def add_pipeline_arguments(parser):
+    parser.add_argument("--offline", action = "store_true", help = "Serve EBI/NCBI lookups from the response cache only, without network access.")
+    parser.add_argument("--no-cache", action = "store_true", help = "Do not read or write the response cache.")
+    parser.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR, help = "Response cache directory (default: %(default)s).")
+    parser.add_argument("--catalogue", action = "store_true", help = "Keep the fetched records of each search in a local catalogue, and download only the records new since the last run.")
+    parser.add_argument("--catalogue-dir", default = PIPELINE_OPTIONS["catalogue_dir"], help = "Record catalogue directory (default: %(default)s).")
+    parser.add_argument("--compression", choices = list(COMPRESSIONS), default = PIPELINE_OPTIONS["compression"], help = "Compress the downloaded FASTA file as it is streamed to disk, zstd needs the optional zstandard package (default: %(default)s).")
+    parser.add_argument("--threads", type = int, default = PIPELINE_OPTIONS["threads"], help = "CPU threads given to clustalo, blastp and parallel patmatmotifs calls, 0 for half the cores in the CPU budget (default: %(default)s).")
+    parser.add_argument("--cpu-budget", type = int, default = PIPELINE_OPTIONS["cpu_budget"], help = "CPUs shared by stages running at the same time, each stage's tool threads count against it (default: %(default)s).")
+    parser.add_argument("--incremental-msa", action = "store_true", help = "Profile-align only the sequences new since the last ClustalO alignment onto it, instead of realigning all of them.")
+    parser.add_argument("--realign-fraction", type = float, default = PIPELINE_OPTIONS["realign_fraction"], help = "With --incremental-msa, realign from scratch when more than this fraction of the sequences changed (default: %(default)s).")
+    parser.add_argument("--selection", choices = ["longest", "cluster"], default = PIPELINE_OPTIONS["selection"], help = "Pick the longest sequences for ClustalO, or one representative per k-mer similarity cluster (default: %(default)s).")
+    parser.add_argument("--identity", type = float, default = PIPELINE_OPTIONS["identity"], help = "Identity threshold (0-1) for clustering with --selection cluster (default: %(default)s).")
+    parser.add_argument("--conservation-engine", choices = ["emboss", "numpy"], default = PIPELINE_OPTIONS["conservation_engine"], help = "Compute plotcon/cons/infoalign outputs with the EMBOSS tools or in-process with numpy (default: %(default)s).")
+    parser.add_argument("--scan-chunk", type = int, default = PIPELINE_OPTIONS["scan_chunk"], help = "Sequences packed into each patmatmotifs call (default: %(default)s).")
+    parser.add_argument("--prosite-engine", choices = ["patmatmotifs", "native"], default = PIPELINE_OPTIONS["prosite_engine"], help = "PROSITE scanner: EMBOSS patmatmotifs or the in-process engine (default: %(default)s).")
+    parser.add_argument("--prosite-dat", default = PIPELINE_OPTIONS["prosite_dat"], help = "PROSITE data file for the native engine (default: %(default)s).")
+    parser.add_argument("--scan-all", action = "store_true", help = "With the native engine, scan every fetched sequence instead of the top scan size.")
+    parser.add_argument("--blast-store", action = "store_true", help = "Reuse BLAST databases from a persistent store shared across runs, adding only new sequences.")
+    parser.add_argument("--blast-store-dir", default = PIPELINE_OPTIONS["blast_store_dir"], help = "BLAST database store directory (default: %(default)s).")
+    parser.add_argument("--blast-store-gb", type = float, default = PIPELINE_OPTIONS["blast_store_gb"], help = "Size cap of the BLAST database store in GB, least recently used databases are evicted beyond it (default: %(default)s).")
+    parser.add_argument("--blast-mode", choices = ["reference", "top", "all"], default = PIPELINE_OPTIONS["blast_mode"], help = "BLAST the reference sequence, the top scan size sequences, or every record against the database (default: %(default)s).")
+    parser.add_argument("--blast-evalue", type = float, default = PIPELINE_OPTIONS["blast_evalue"], help = "E-value cutoff of the hit table in top/all BLAST mode (default: %(default)s).")
+    parser.add_argument("--table-format", choices = TABLE_FORMATS, default = PIPELINE_OPTIONS["table_format"], help = "Write tabular outputs as TSV, or as typed Parquet, which needs the optional pyarrow package (default: %(default)s).")
+    parser.add_argument("--chrome-trace", action = "store_true", help = "Also write the timing trace in Chrome trace format, for chrome://tracing or Perfetto.")
+    parser.add_argument("--fresh", action = "store_true", help = "Delete previous outputs instead of resuming from completed stages.")
+
+# pipeline_options() takes in an arg: parsed command line arguments.
+# Output: Dict of tuning options for run_pipeline().
+def pipeline_options(args):
+    return {key : getattr(args, key) for key in PIPELINE_OPTIONS}
+
+# build_parser() takes in no args.
+# Function: Define the command line switches of the pipeline.
+# Output: argparse parser.
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Protein family conservation, PROSITE motif and BLAST pipeline.")
+    add_pipeline_arguments(parser)
+    return parser
+
+# main() takes in an optional arg: list of command line arguments.
+# Function: Prompts the user for inputs and runs the pipeline.
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    configure_cache(cache_dir = args.cache_dir, offline = args.offline, enabled = not args.no_cache)
+
+    # This while loop prompts the user for an email. If the email is invalid, reprompt the user, until a valid email is inputted.
+    while True:
+        email = input("Your email (needed for NCBI URL request): ").strip()
+        if valid_email(email):
+            break
+        else:
+            print("\nPlease input a valid email.")
+
+    # Prompt the user for a protein family and a taxonomic group. Each is validated in the background as soon as it is inputted,
+    # by validate_protein() and validate_taxon(), so the EBI lookup runs while the taxon group is typed, and alongside the NCBI lookups.
+    executor = ThreadPoolExecutor(max_workers = 2)
+    protein = executor.submit(validate_protein, input("Protein family: ").strip())
+    taxon = executor.submit(validate_taxon, input("Taxon group: ").strip(), email)
+
+    # This while loop waits for the protein family to be validated. If input is invalid, raise an error and reprompt user, until a valid protein family is inputted.
+    while True:
+        try:
+            pfam_id, pfam_name = protein.result()
+            break
+        except Exception as e:
+            print(f"\nPlease input a valid protein family. {e}")
+            protein = executor.submit(validate_protein, input("Protein family: ").strip())
+
+    # This while loop waits for the taxon group to be validated. If input is invalid, raise an error and reprompt user, until a valid taxon group is inputted.
+    while True:
+        try:
+            taxon_id, taxon_name = taxon.result()
+            break
+        except Exception as e:
+            print(f"\nPlease input a valid taxon group. {e}")
+            taxon = executor.submit(validate_taxon, input("Taxon group: ").strip(), email)
+    executor.shutdown()
+
+    # When all inputs are valid, print these statements.
+    print(f"\nSuccess! Your protein family: {pfam_name}\tPfam ID: {pfam_id}")
+    print(f"Success! Your taxon group: {taxon_name}\tTaxon ID: {taxon_id}\n")
+
+    # Run the pipeline, prompting for sample size and scan size along the way, through run_pipeline().
+    run_pipeline(email, pfam_name, taxon_id, taxon_name, **pipeline_options(args))
+
 
 if __name__ == "__main__":
     main()
@@ -1,41 +1,104 @@
 #!.venv/bin/python3
 
-# parse_fasta() takes in 2 args: out_dir and raw FASTA filename.
-# Function: Parse the downloaded raw FASTA file with all sequences into JSON format.
-# Output: All protein sequences in JSON format.
-def parse_fasta(out_dir, fasta_filename):
-    with open(f"{out_dir}/{fasta_filename}", "r") as file:
-        fasta_text = file.read()
-    fasta_list = [entry.strip() for entry in fasta_text.split(">") if entry.strip()]
-    
-    def mapper(entry):
-        entry = entry.replace("\n", "")
-        parts = entry.split("]", 1)
-        if len(parts) != 2:
-            return None
+import json
+from compression import open_file
 
-        header, sequence = parts
-        sequence = sequence.strip()
-        header_parts = header.split("[")
-        if len(header_parts) != 2:
-            return None
-        
-        header_info, species = header_parts
-        species = species.strip()
-        info_parts = header_info.strip().split()
-        if not info_parts:
+# parse_header() takes in an arg: a FASTA header line without the leading ">".
+# Function: Split a NCBI header into uid, description and species.
+# The species is the last bracketed group at the end of the header, matched with balanced brackets so nested brackets (e.g. "[Escherichia coli [strain K12]]") stay intact.
+# If the header has no trailing [species], species is an empty string.
+# Output: Tuple of uid, description and species, or None if the header is empty.
+def parse_header(header):
+    header = header.strip()
+    info_parts = header.split(None, 1)
+    if not info_parts:
+        return None
+
+    uid = info_parts[0]
+    rest = info_parts[1] if len(info_parts) == 2 else ""
+    species = ""
+    if rest.endswith("]"):
+        depth = 0
+        for i in range(len(rest) - 1, -1, -1):
+            if rest[i] == "]":
+                depth += 1
+            elif rest[i] == "[":
+                depth -= 1
+                if depth == 0:
+                    species = rest[i + 1:-1].strip()
+                    rest = rest[:i]
+                    break
+    description = " ".join(rest.split())
+    return uid, description, species
+
+# header_accession() takes in an arg: uid from a FASTA header.
+# Function: Get the accession of a record, as efetch rettype=acc lists it, from its header uid.
+# Headers of most records start with the accession itself (e.g. "XP_012345678.1"), but Swiss-Prot, PDB and a few other sources
+# use NCBI's "db|accession|name" form, e.g. "sp|P04637.4|P53_HUMAN" for P04637.4 and "pdb|1ABC|A" for 1ABC_A.
+# Output: Accession string.
+def header_accession(uid):
+    if "|" not in uid:
+        return uid
+    parts = uid.split("|")
+    if parts[0] == "pdb" and len(parts) > 2 and parts[2]:
+        return f"{parts[1]}_{parts[2]}"
+    # Fields may be empty, e.g. "pir||S12345" or "prf||1234567A", so the first non-empty one after the source is taken.
+    return next((part for part in parts[1:] if part), uid)
+
+# iter_fasta() takes in an arg: path to a FASTA file.
+# Function: Read the FASTA file line by line, joining multi-line sequences, and yield one record at a time.
+# Only the current record is held in memory. gzip or zstd compressed files are decompressed as they are read.
+# Output: Generator of protein sequence dicts.
+def iter_fasta(fasta_path):
+    def make_record(header, chunks):
+        parsed = parse_header(header)
+        sequence = "".join(chunks)
+        if not parsed or not sequence:
             return None
-        
-        uid = info_parts[0]
-        description = " ".join(info_parts[1:])
+        uid, description, species = parsed
         return {
-            "uid": uid, 
-            "species": species, 
-            "description": description, 
-            "sequence": sequence, 
+            "uid": uid,
+            "species": species,
+            "description": description,
+            "sequence": sequence,
             "length": len(sequence)
         }
-    
-    records = list(map(lambda x: mapper(x), fasta_list))
-    records = [record for record in records if record]
-    return records
+
+    header = None
+    chunks = []
+    with open_file(fasta_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                if header is not None:
+                    record = make_record(header, chunks)
+                    if record:
+                        yield record
+                header = line[1:]
+                chunks = []
+            elif header is not None:
+                chunks.append("".join(line.split()))
+    if header is not None:
+        record = make_record(header, chunks)
+        if record:
+            yield record
+
+# parse_fasta() takes in 2 args: out_dir and raw FASTA filename.
+# Function: Parse the downloaded raw FASTA file with all sequences into JSON format.
+# Output: All protein sequences in JSON format.
+def parse_fasta(out_dir, fasta_filename):
+    return list(iter_fasta(f"{out_dir}/{fasta_filename}"))
+
+# write_records_jsonl() takes in 2 args: an iterable of protein sequence dicts and output JSON Lines filepath.
+# Function: Stream records to a JSON Lines file, one record per line.
+# Output: Number of records written.
+def write_records_jsonl(records, jsonl_path):
+    count = 0
+    with open(jsonl_path, "w") as file:
+        for record in records:
+            file.write(json.dumps(record))
+            file.write("\n")
+            count += 1
+    return count
@@ -0,0 +1,30 @@
+#!.venv/bin/python3
+
+import os
+import sys
+import threading
+
+# pyplot keeps one current figure per process, so stages that plot in parallel worker threads draw one at a time.
+PLOT_LOCK = threading.Lock()
+
+# has_display() takes in no args.
+# Output: True if plots can be shown on screen (a desktop platform, or DISPLAY/WAYLAND_DISPLAY set), else False.
+def has_display():
+    return sys.platform in ["darwin", "win32"] or bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+# get_pyplot() takes in no args.
+# Function: Import matplotlib.pyplot only when a plotting stage runs, using the non-interactive Agg backend when there is no display.
+# Output: matplotlib.pyplot module.
+def get_pyplot():
+    import matplotlib
+    if not has_display() and "MPLBACKEND" not in os.environ:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+# show_plot() takes in 3 args: pyplot module, message and whether to show the plot.
+# Function: Show the current figure and wait for the user to close it, only if asked to and a display is available.
+def show_plot(plt, message, show = True):
+    if show and has_display():
+        print(message)
+        plt.show()
@@ -0,0 +1,123 @@
+#!.venv/bin/python3
+
+import functools
+import os
+import re
+
+DEFAULT_PROSITE_DAT = os.environ.get("PROSITE_DAT", "prosite.dat")
+REPORT_HEADER = "SeqName\tStart\tEnd\tScore\tStrand\tMotif\n"
+
+# read_prosite_dat() takes in an arg: PROSITE data filepath (prosite.dat).
+# Function: Read the pattern entries of the PROSITE data file. Entries without a PA line (profiles, rules) are skipped.
+# Output: List of dicts with motif name, accession, pattern and skip flag.
+def read_prosite_dat(prosite_dat):
+    entries = []
+    entry = {}
+    with open(prosite_dat, "r") as file:
+        for line in file:
+            code, value = line[:2], line[5:].rstrip("\n")
+            if code == "ID":
+                entry = {"name" : value.split(";")[0].strip(), "type" : value.split(";")[1].strip(" ."), "pattern" : "", "skip" : False}
+            elif code == "AC":
+                entry["accession"] = value.strip(" ;")
+            elif code == "PA":
+                entry["pattern"] += value.strip()
+            elif code == "CC" and "/SKIP-FLAG=TRUE" in value:
+                entry["skip"] = True
+            elif code == "//":
+                if entry.get("type") == "PATTERN" and entry.get("pattern"):
+                    entries.append(entry)
+                entry = {}
+    return entries
+
+# translate_pattern() takes in an arg: PROSITE pattern string, e.g. "[AG]-x(4)-G-K-[ST]."
+# Function: Translate the pattern syntax into a Python regex, and collect the longest run of fixed residues as a prefilter.
+# x is any residue, [..] any of, {..} none of, (n) or (n,m) a repeat, < and > the N- and C-terminus.
+# Output: Tuple of regex string and the longest fixed-residue substring ("" if there is none).
+def translate_pattern(pattern):
+    pattern = pattern.strip().rstrip(".")
+    regex = []
+    literal = ""
+    run = ""
+    for element in pattern.split("-"):
+        element = element.strip()
+        # Anchors are stripped first, as a C-terminal > follows a repeat or a closing bracket, e.g. x(2)> or [LIVMAFY]>.
+        prefix = suffix = ""
+        if element.startswith("<"):
+            prefix, element = "^", element[1:]
+        if element.endswith(">"):
+            suffix, element = "$", element[:-1]
+        repeat = ""
+        match = re.fullmatch(r"(.+?)\((\d+)(?:,(\d+))?\)", element)
+        if match:
+            element = match.group(1)
+            repeat = f"{{{match.group(2)}}}" if match.group(3) is None else f"{{{match.group(2)},{match.group(3)}}}"
+
+        if element.startswith("["):
+            residues = element[1:-1]
+            if ">" in residues:
+                body = f"(?:[{residues.replace('>', '')}]|$)"
+            else:
+                body = f"[{residues}]"
+        elif element.startswith("{"):
+            body = f"[^{element[1:-1]}]"
+        elif element.lower() == "x":
+            body = "."
+        else:
+            body = element
+
+        fixed = re.fullmatch(r"[A-Z]", element) is not None
+        if fixed and (not repeat or match.group(3) is None):
+            run += element * (int(match.group(2)) if repeat else 1)
+        else:
+            run = ""
+        if len(run) > len(literal):
+            literal = run
+        regex.append(f"{prefix}{body}{repeat}{suffix}")
+    return "".join(regex), literal
+
+# load_prosite_patterns() takes in 2 args: PROSITE data filepath and prune flag.
+# Function: Load and compile every pattern once. Like patmatmotifs -prune, patterns flagged /SKIP-FLAG=TRUE (frequent post-translational sites) are left out unless prune is False.
+# Compiled patterns are kept per process, so repeated scans do not re-read the file.
+# Output: Tuple of motif dicts, each with name, compiled regex and prefilter literal.
+@functools.lru_cache(maxsize = 4)
+def load_prosite_patterns(prosite_dat = DEFAULT_PROSITE_DAT, prune = True):
+    motifs = []
+    for entry in read_prosite_dat(prosite_dat):
+        if prune and entry["skip"]:
+            continue
+        regex, literal = translate_pattern(entry["pattern"])
+        motifs.append({
+            "name" : entry["name"],
+            "accession" : entry.get("accession", ""),
+            "pattern" : entry["pattern"],
+            "regex" : re.compile(f"(?=({regex}))"),
+            "literal" : literal
+        })
+    return tuple(motifs)
+
+# scan_sequence() takes in 2 args: protein sequence and compiled motifs.
+# Function: Find every (including overlapping) match of every motif, skipping the regex when the motif's fixed residues are absent.
+# Output: Generator of (start, end, motif name) tuples, 1-based and inclusive.
+def scan_sequence(sequence, motifs):
+    for motif in motifs:
+        if motif["literal"] and motif["literal"] not in sequence:
+            continue
+        for match in motif["regex"].finditer(sequence):
+            start = match.start() + 1
+            yield start, start + len(match.group(1)) - 1, motif["name"]
+
+# run_native_prosite_scan() takes in 5 args: records to scan, out_dir, out_prosite, PROSITE data filepath and prune flag.
+# Function: Scan every record in one pass with the compiled motifs, directly from the record dicts, with no per-sequence FASTA files or patmatmotifs processes.
+# Writes one excel-format report with the same columns as patmatmotifs (SeqName, Start, End, Score, Strand, Motif).
+# Output: List with the report filename, for parse_prosite_output().
+def run_native_prosite_scan(records, out_dir, out_prosite, prosite_dat = DEFAULT_PROSITE_DAT, prune = True):
+    motifs = load_prosite_patterns(prosite_dat, prune)
+    prosite_output = f"{out_prosite}_native.patmatmotifs"
+    with open(f"{out_dir}/{out_prosite}/{prosite_output}", "w") as file:
+        file.write(REPORT_HEADER)
+        for entry in records:
+            sequence = entry["sequence"].upper()
+            for start, end, name in scan_sequence(sequence, motifs):
+                file.write(f"{entry['uid']}\t{start}\t{end}\t0.000\t+\t{name}\n")
+    return [prosite_output]
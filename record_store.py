@@ -0,0 +1,168 @@
+#!.venv/bin/python3
+
+import mmap
+import os
+from array import array
+import numpy as np
+from compression import open_file
+
+COLUMNS = ["uid", "description", "species", "sequence"]
+
+# fasta_entry() takes in 4 args: uid, description, species and sequence, as bytes.
+# Output: FASTA record bytes, in the header format every stage writes, without a blank line after the record.
+def fasta_entry(uid, description, species, sequence):
+    return b">" + uid + b" " + description + b" [" + species + b"]\n" + sequence + b"\n"
+
+# write_fasta() takes in 2 args: iterable of protein sequence dicts and output FASTA filepath.
+# Function: Write the records as FASTA, for record dicts that do not come from a RecordStore. A .gz or .zst filepath is compressed.
+# Output: Number of records written.
+def write_fasta(records, fasta_path):
+    count = 0
+    with open_file(fasta_path, "wb") as file:
+        for entry in records:
+            file.write(fasta_entry(*(entry[column].encode() for column in COLUMNS)))
+            count += 1
+    return count
+
+# RecordStore takes in 2 args: dict of column name to byte buffer and offset matrix (columns x records + 1).
+# Function: Compact, indexed store of the parsed records. Each column (uid, description, species, sequence) is one contiguous byte buffer,
+# and record i of a column is buffer[offsets[column, i]:offsets[column, i + 1]]. The uid to index hash map is built on first lookup.
+# A store saved to disk is a directory of one .bin file per column and offsets.npy, and is loaded memory-mapped,
+# so a record costs its bytes plus 32 bytes of offsets instead of a dict of Python strings.
+class RecordStore:
+    def __init__(self, buffers, offsets):
+        self.buffers = buffers
+        self.offsets = offsets
+        self.uid_index = None
+
+    # build() takes in 2 args: iterable of protein sequence dicts and an optional store directory.
+    # Function: Stream the records into the column buffers, one record at a time. With a store directory the buffers are written straight to disk
+    # and the store is loaded back memory-mapped, else they are kept in memory.
+    # Output: RecordStore.
+    @classmethod
+    def build(cls, records, store_path = None):
+        offsets = [array("q", [0]) for column in COLUMNS]
+        if store_path:
+            os.makedirs(store_path, exist_ok = True)
+            buffers = [open(f"{store_path}/{column}.bin", "wb") for column in COLUMNS]
+        else:
+            buffers = [bytearray() for column in COLUMNS]
+        try:
+            for entry in records:
+                for j, column in enumerate(COLUMNS):
+                    value = entry[column].encode()
+                    if store_path:
+                        buffers[j].write(value)
+                    else:
+                        buffers[j] += value
+                    offsets[j].append(offsets[j][-1] + len(value))
+        finally:
+            if store_path:
+                for file in buffers:
+                    file.close()
+        offsets = np.array(offsets, dtype = np.int64)
+        if not store_path:
+            return cls({column : bytes(buffer) for column, buffer in zip(COLUMNS, buffers)}, offsets)
+        np.save(f"{store_path}/offsets.npy", offsets)
+        return cls.load(store_path)
+
+    # load() takes in an arg: store directory.
+    # Function: Memory-map the column buffers and offsets of a saved store.
+    # Output: RecordStore.
+    @classmethod
+    def load(cls, store_path):
+        buffers = {}
+        for column in COLUMNS:
+            with open(f"{store_path}/{column}.bin", "rb") as file:
+                buffers[column] = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+        return cls(buffers, np.load(f"{store_path}/offsets.npy", mmap_mode = "r"))
+
+    # files() takes in an arg: store directory.
+    # Output: List of the filepaths making up a saved store (for checkpoint inputs and outputs).
+    @staticmethod
+    def files(store_path):
+        return [f"{store_path}/{column}.bin" for column in COLUMNS] + [f"{store_path}/offsets.npy"]
+
+    def __len__(self):
+        return self.offsets.shape[1] - 1
+
+    def __iter__(self):
+        return (self.record(i) for i in range(len(self)))
+
+    def __contains__(self, uid):
+        return uid in self.index_map()
+
+    # field() takes in 2 args: column name and record index.
+    # Output: Raw bytes of the field.
+    def field(self, column, i):
+        j = COLUMNS.index(column)
+        return self.buffers[column][self.offsets[j, i]:self.offsets[j, i + 1]]
+
+    def uid(self, i):
+        return self.field("uid", i).decode()
+
+    def sequence(self, i):
+        return self.field("sequence", i).decode()
+
+    # lengths() takes in no args.
+    # Output: numpy array of sequence lengths, from the offsets without reading any sequence.
+    def lengths(self):
+        return np.diff(self.offsets[COLUMNS.index("sequence")])
+
+    # length_order() takes in no args.
+    # Output: Record indices sorted by descending sequence length, ties kept in file order.
+    def length_order(self):
+        return np.argsort(-self.lengths(), kind = "stable")
+
+    # index_map() takes in no args.
+    # Output: Dict of uid to record index, built once.
+    def index_map(self):
+        if self.uid_index is None:
+            buffer = self.buffers["uid"]
+            bounds = self.offsets[0].tolist()
+            self.uid_index = {buffer[bounds[i]:bounds[i + 1]].decode() : i for i in range(len(self))}
+        return self.uid_index
+
+    # index() takes in an arg: uid.
+    # Output: Record index of the uid. Raises KeyError if the uid is not in the store.
+    def index(self, uid):
+        return self.index_map()[uid]
+
+    # record() takes in an arg: record index.
+    # Output: Protein sequence dict, as iter_fasta() yields.
+    def record(self, i):
+        uid, description, species, sequence = (self.field(column, i).decode() for column in COLUMNS)
+        return {
+            "uid": uid,
+            "species": species,
+            "description": description,
+            "sequence": sequence,
+            "length": len(sequence)
+        }
+
+    # get() takes in an arg: uid.
+    # Output: Protein sequence dict of the uid.
+    def get(self, uid):
+        return self.record(self.index(uid))
+
+    # take() takes in an arg: iterable of uids.
+    # Output: List of protein sequence dicts, in the order given. Uids not in the store are skipped.
+    def take(self, uids):
+        index = self.index_map()
+        return [self.record(index[uid]) for uid in uids if uid in index]
+
+    # write_fasta() takes in 3 args: output FASTA filepath, optional record indices and records per write.
+    # Function: Write the records (all, or the given indices in order) as FASTA straight from the column buffers, without building record dicts.
+    # Offsets are read for one block of indices at a time, so writing a few records costs only their own offsets.
+    # A .gz or .zst filepath is compressed as it is written.
+    # Output: Number of records written.
+    def write_fasta(self, fasta_path, indices = None, block_size = 10000):
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype = np.int64)
+        buffers = [self.buffers[column] for column in COLUMNS]
+        with open_file(fasta_path, "wb") as file:
+            for first in range(0, len(indices), block_size):
+                block = indices[first:first + block_size]
+                starts = self.offsets[:, block].T.tolist()
+                ends = self.offsets[:, block + 1].T.tolist()
+                file.writelines(fasta_entry(*(buffer[start:end] for buffer, start, end in zip(buffers, row_starts, row_ends))) for row_starts, row_ends in zip(starts, ends))
+        return len(indices)
@@ -0,0 +1,112 @@
+#!.venv/bin/python3
+
+import numpy as np
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# Lookup table from ASCII code to amino acid index. Anything outside the 20 standard residues maps to 20 and breaks k-mers.
+AA_INDEX = np.full(256, 20, dtype = np.int64)
+for i, residue in enumerate(AMINO_ACIDS):
+    AA_INDEX[ord(residue)] = i
+    AA_INDEX[ord(residue.lower())] = i
+
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+# jaccard_threshold() takes in 2 args: identity threshold (0-1) and k-mer size.
+# Function: Convert a sequence identity threshold into the k-mer Jaccard similarity expected at that identity,
+# by inverting the Mash distance D = -1/k * ln(2J / (1 + J)) with D = 1 - identity.
+# Output: Jaccard threshold.
+def jaccard_threshold(identity, k):
+    x = np.exp(-k * (1.0 - identity))
+    return float(x / (2.0 - x))
+
+EMPTY = np.iinfo(np.uint64).max
+
+# minhash_signatures() takes in 4 args: list of sequences, k-mer size, number of signature bins and random seed.
+# Function: Compute a one-permutation MinHash signature per sequence. A chunk of sequences is joined into one residue array,
+# every k-mer is encoded as a base-20 integer and hashed once, the hash picks one of num_hashes bins and the minimum per (sequence, bin) is kept with np.minimum.at.
+# There is no Python loop over sequences, k-mers or hash functions. Bins a sequence never fills stay EMPTY.
+# Output: numpy uint64 matrix (sequences x num_hashes).
+def minhash_signatures(sequences, k = 5, num_hashes = 64, seed = 1, chunk_residues = 1 << 22):
+    salt = np.uint64(np.random.default_rng(seed).integers(1, np.iinfo(np.int64).max))
+    powers = 20 ** np.arange(k - 1, -1, -1, dtype = np.int64)
+    signatures = np.full((len(sequences), num_hashes), EMPTY, dtype = np.uint64)
+
+    start = 0
+    while start < len(sequences):
+        stop = start
+        total = 0
+        while stop < len(sequences) and (total < chunk_residues or stop == start):
+            total += len(sequences[stop]) + 1
+            stop += 1
+        joined = "*".join(sequences[start:stop]) + "*"
+        codes = AA_INDEX[np.frombuffer(joined.encode("ascii", "replace"), dtype = np.uint8)]
+        if len(codes) >= k:
+            windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+            valid = np.flatnonzero((windows < 20).all(axis = 1))
+            ends = np.cumsum([len(sequence) + 1 for sequence in sequences[start:stop]])
+            seq_index = np.searchsorted(ends, valid, side = "right")
+            with np.errstate(over = "ignore"):
+                hashed = (windows[valid] @ powers).astype(np.uint64) ^ salt
+                hashed *= MIX
+                hashed ^= hashed >> np.uint64(31)
+                hashed *= MIX
+                hashed ^= hashed >> np.uint64(29)
+            bins = (hashed % np.uint64(num_hashes)).astype(np.int64)
+            block = signatures[start:stop].reshape(-1)
+            np.minimum.at(block, seq_index * num_hashes + bins, hashed)
+            signatures[start:stop] = block.reshape(stop - start, num_hashes)
+        start = stop
+    return signatures
+
+# cluster_signatures() takes in 3 args: MinHash signatures ordered by priority (longest first), Jaccard threshold and rows per LSH band.
+# Function: Greedy leader clustering. Each sequence joins the first representative whose estimated Jaccard similarity reaches the threshold,
+# else it becomes a new representative. Candidate representatives come from LSH band buckets, so each sequence is only compared with a few of them.
+# Output: numpy array with the representative index of each sequence.
+def cluster_signatures(signatures, threshold, rows_per_band = 2):
+    n, num_hashes = signatures.shape
+    bands = num_hashes // rows_per_band
+    with np.errstate(over = "ignore"):
+        band_keys = signatures[:, :bands * rows_per_band].reshape(n, bands, rows_per_band)
+        keys = band_keys[:, :, 0].copy()
+        for r in range(1, rows_per_band):
+            keys = keys * MIX + band_keys[:, :, r]
+    keys = keys.tolist()
+
+    buckets = [{} for band in range(bands)]
+    assignment = np.empty(n, dtype = np.int64)
+    for i in range(n):
+        candidates = set()
+        for band in range(bands):
+            candidates.update(buckets[band].get(keys[i][band], ()))
+        best = -1
+        if candidates:
+            candidates = np.fromiter(candidates, dtype = np.int64)
+            similarity = ((signatures[candidates] == signatures[i]) & (signatures[i] != EMPTY)).mean(axis = 1)
+            if similarity.max() >= threshold:
+                best = int(candidates[similarity.argmax()])
+        if best < 0:
+            best = i
+            for band in range(bands):
+                buckets[band].setdefault(keys[i][band], []).append(i)
+        assignment[i] = best
+    return assignment
+
+# select_representatives() takes in 5 args: RecordStore, maximum number of representatives, identity threshold, k-mer size and number of hash functions.
+# Function: Cluster records by k-mer (MinHash) similarity at the identity threshold, and pick one representative per cluster, the longest member.
+# Up to size representatives are kept, from the largest clusters first, so the selection covers the diversity of the family instead of near-identical isoforms.
+# Output: Tuple of selected record indices (longest first) and dict of representative uid to list of member uids for every cluster, largest first.
+def select_representatives(store, size, identity = 0.9, k = 5, num_hashes = 64):
+    order = store.length_order()
+    if not len(order):
+        return [], {}
+    signatures = minhash_signatures([store.sequence(i) for i in order], k, num_hashes)
+    assignment = cluster_signatures(signatures, jaccard_threshold(identity, k))
+
+    leaders, cluster_sizes = np.unique(assignment, return_counts = True)
+    rank = np.lexsort((leaders, -cluster_sizes))
+    chosen = np.sort(leaders[rank][:size])
+    clusters = {store.uid(order[leader]) : [] for leader in leaders[rank]}
+    for i, leader in enumerate(assignment):
+        clusters[store.uid(order[leader])].append(store.uid(order[i]))
+    return order[chosen].tolist(), clusters
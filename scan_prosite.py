@@ -1,20 +1,30 @@
 #!.venv/bin/python3
 
+import os
+import shlex
 import subprocess
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ThreadPoolExecutor
+from plotting import PLOT_LOCK, get_pyplot, show_plot
+from record_store import write_fasta
+from instrument import run_command, carry_context
+from tables import read_table, write_parquet, write_locations_parquet
 
-# parse_clu_results() takes in 6 args: Parsed sequences to JSON, out_dir, out_clustalo, infoalign results file, out_prosite and user's input for scan size.
+# parse_clu_results() takes in 7 args: RecordStore of parsed sequences, out_dir, out_clustalo, infoalign results file, out_prosite, user's input for scan size and table format.
 # Function: As per user's input, filter and select the top few sequences with high % similarity to the consensus sequence from infoalign results.
+# The top sequences are looked up by uid in the store, and kept in the order they were fetched.
+# The top table is written as TSV, or as Parquet with table format "parquet".
 # Output: The top sequences in JSON and infoalign results.
-def parse_clu_results(records, out_dir, out_clustalo, infoalign_results, out_prosite, size):
+def parse_clu_results(store, out_dir, out_clustalo, infoalign_results, out_prosite, size, table_format = "tsv"):
+    import pandas as pd
     infoalign_df = pd.read_csv(f"{out_dir}/{out_clustalo}/{infoalign_results}", sep = "\t", na_values = [""], header = None, names = ["Name", "% Change"])
     infoalign_df = infoalign_df.sort_values("% Change", ascending = False).reset_index(drop = True)
     top_df = infoalign_df.iloc[:size]
-    top_df.to_csv(f"{out_dir}/{out_prosite}/top_{size}_from_clustalo.tsv", sep = "\t", header = True, index = False)
+    if table_format == "parquet":
+        write_parquet(top_df, f"{out_dir}/{out_prosite}/top_{size}_from_clustalo.parquet", {"Name" : "string", "% Change" : "float64"})
+    else:
+        top_df.to_csv(f"{out_dir}/{out_prosite}/top_{size}_from_clustalo.tsv", sep = "\t", header = True, index = False)
     list_top = top_df["Name"].tolist()
-    top_records = list(filter(lambda x: x["uid"] in list_top, records))
+    top_records = [store.record(i) for i in sorted(store.index(uid) for uid in list_top if uid in store)]
     return top_records, top_df
 
 # build_prosite_input() takes in 3 args: Top sequences in JSON, out_dir, out_prosite.
@@ -23,50 +33,186 @@ def parse_clu_results(records, out_dir, out_clustalo, infoalign_results, out_pro
 def build_prosite_input(records_top, out_dir, out_prosite):
     prosite_input = []
     for entry in records_top:
-        with open(f"{out_dir}/{out_prosite}/{entry['uid']}.fasta", "w") as file:
-            file.write(f">{entry['uid']} {entry['description']} [{entry['species']}]\n")
-            file.write(f"{entry['sequence']}\n\n")
+        write_fasta([entry], f"{out_dir}/{out_prosite}/{entry['uid']}.fasta")
         prosite_input.append(f"{entry['uid']}")
     return prosite_input
 
-# run_prosite_scan() takes in 3 args: out_dir, out_prosite and list of input FASTA files(filepaths) for patmatmotifs.
+# patmatmotifs_cmd() takes in 2 args: input FASTA filepath and output patmatmotifs filepath.
+# Output: patmatmotifs command line.
+def patmatmotifs_cmd(prosite_input_path, prosite_output_path):
+    return f"patmatmotifs -sequence {shlex.quote(prosite_input_path)} -outfile {shlex.quote(prosite_output_path)} -rformat excel -auto"
+
+# split_patmatmotifs() takes in 3 args: patmatmotifs output filepath of a multi-sequence scan, list of uids scanned and output directory.
+# Function: Split an excel-format report covering many sequences into one .patmatmotifs file per uid, each with the header row.
+# Sequences without hits get a header-only file, so parse_prosite_output() sees the same files as after a per-sequence scan.
+def split_patmatmotifs(chunk_output_path, uids, prosite_dir):
+    header = "SeqName\tStart\tEnd\tScore\tStrand\tMotif\n"
+    rows = {uid : [] for uid in uids}
+    with open(chunk_output_path, "r") as file:
+        for line in file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line.startswith("SeqName"):
+                header = line
+                continue
+            rows.setdefault(line.split("\t", 1)[0].strip(), []).append(line)
+    for uid in uids:
+        with open(f"{prosite_dir}/{uid}.patmatmotifs", "w") as file:
+            file.write(header)
+            file.writelines(rows[uid])
+
+# scan_chunk() takes in 3 args: out_dir, out_prosite and list of uids.
+# Function: Pack the input FASTA files of the uids into one file, scan it with a single patmatmotifs call, and split the report per uid.
+def scan_chunk(out_dir, out_prosite, uids):
+    prosite_dir = f"{out_dir}/{out_prosite}"
+    chunk_name = f"chunk_{uids[0]}"
+    with open(f"{prosite_dir}/{chunk_name}.fasta", "w") as chunk_file:
+        for uid in uids:
+            with open(f"{prosite_dir}/{uid}.fasta", "r") as file:
+                chunk_file.write(file.read())
+    run_command(patmatmotifs_cmd(f"{prosite_dir}/{chunk_name}.fasta", f"{prosite_dir}/{chunk_name}.report"), check = True, stdout = subprocess.DEVNULL)
+    split_patmatmotifs(f"{prosite_dir}/{chunk_name}.report", uids, prosite_dir)
+    os.remove(f"{prosite_dir}/{chunk_name}.fasta")
+    os.remove(f"{prosite_dir}/{chunk_name}.report")
+
+# run_prosite_scan() takes in 5 args: out_dir, out_prosite, list of input FASTA files(filepaths) for patmatmotifs, number of workers and number of sequences per patmatmotifs call.
 # Function: Run patmatmotifs command line for each input FASTA file, to scan for PROSITE motifs.
+# With workers > 1, patmatmotifs calls run concurrently on a worker pool. With chunk_size > 1, each call scans chunk_size sequences and the report is split per sequence.
+# Either way, one .patmatmotifs file is written per uid.
 # Output: List of output patmatmotifs files.
-def run_prosite_scan(out_dir, out_prosite, prosite_input_list):
-    for uid in prosite_input_list:
+def run_prosite_scan(out_dir, out_prosite, prosite_input_list, workers = 1, chunk_size = 1):
+    def scan_one(uid):
         prosite_input = f"{uid}.fasta"
         prosite_output = f"{uid}.patmatmotifs"
-        subprocess.call(f"patmatmotifs -sequence {out_dir}/{out_prosite}/{prosite_input} -outfile {out_dir}/{out_prosite}/{prosite_output} -rformat excel -auto", shell = True, stdout = subprocess.DEVNULL)
+        run_command(patmatmotifs_cmd(f"{out_dir}/{out_prosite}/{prosite_input}", f"{out_dir}/{out_prosite}/{prosite_output}"), check = True, stdout = subprocess.DEVNULL)
+
+    if chunk_size > 1:
+        chunks = [prosite_input_list[i:i + chunk_size] for i in range(0, len(prosite_input_list), chunk_size)]
+        task = lambda chunk: scan_chunk(out_dir, out_prosite, chunk)
+    else:
+        chunks = prosite_input_list
+        task = scan_one
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(carry_context(task), chunks))
+    else:
+        for chunk in chunks:
+            task(chunk)
+    return [f"{uid}.patmatmotifs" for uid in prosite_input_list]
+
+# read_prosite_reports() takes in an arg: list of patmatmotifs report filepaths.
+# Function: Read every excel-format report in one pass. The leading comment lines and the header row of each report are cut off,
+# the remaining rows are joined into one buffer, and the buffer is parsed with a single pandas.read_csv call into contiguous columns.
+# Every report has the same columns (SeqName, Start, End, Score, Strand, Motif), so the header is taken from the first one.
+# Output: Summary table of PROSITE hits, in report order.
+def read_prosite_reports(paths):
+    import io
+    import pandas as pd
+    header = None
+    chunks = []
+    for path in paths:
+        with open(path, "r") as file:
+            text = file.read()
+        while text.startswith("#") or text.startswith("\n"):
+            text = text.partition("\n")[2]
+        line, _, body = text.partition("\n")
+        if not line.strip():
+            continue
+        if header is None:
+            header = [column.strip() for column in line.split("\t")]
+        if body and not body.endswith("\n"):
+            body += "\n"
+        chunks.append(body)
+    body = "".join(chunks)
+    if not body.strip():
+        return pd.DataFrame(columns = header or [])
+    return pd.read_csv(io.StringIO(body), sep = "\t", comment = "#", na_values = [""], header = None, names = header)
 
-# parse_prosite_output() takes in 3 args: out_dir, out_prosite and list of output patmatmotifs files.
+# count_motifs() takes in an arg: summary table of PROSITE hits.
+# Function: Count the hits of each motif from integer motif codes (in order of first appearance) with one bincount.
+# Output: pandas Series of hit counts indexed by motif, most frequent first, ordered as Series.value_counts() orders them.
+def count_motifs(summary_df):
+    import numpy as np
+    import pandas as pd
+    codes, motifs = pd.factorize(summary_df["Motif"])
+    counts = np.bincount(codes[codes >= 0], minlength = len(motifs))
+    return pd.Series(counts, index = pd.Index(motifs, name = "Motif"), name = "count").sort_values(ascending = False)
+
+# MotifMatrix takes in an arg: summary table of PROSITE hits.
+# Function: Sparse sequence x motif matrix of hit locations. Sequence names and motifs are factorized to sorted integer codes,
+# and the hits are stably sorted by (sequence, motif), so the hits of each non-empty cell are one contiguous run, in report order.
+# Only the non-empty cells are stored: their sequence and motif codes, and cell_ptr, the offset of each cell's run (plus the end).
+class MotifMatrix:
+    def __init__(self, summary_df):
+        import numpy as np
+        import pandas as pd
+        hits = summary_df.dropna(subset = ["SeqName", "Motif"])
+        seq_codes, self.seq_names = pd.factorize(hits["SeqName"], sort = True)
+        motif_codes, self.motifs = pd.factorize(hits["Motif"], sort = True)
+        n_motifs = max(1, len(self.motifs))
+        keys = seq_codes.astype(np.int64) * n_motifs + motif_codes
+        order = np.argsort(keys, kind = "stable")
+        self.starts = hits["Start"].to_numpy()[order]
+        self.ends = hits["End"].to_numpy()[order]
+        self.scores = hits["Score"].to_numpy()[order]
+        self.hit_motifs = motif_codes[order]
+        cell_keys, cell_ptr = np.unique(keys[order], return_index = True)
+        self.cell_seq, self.cell_motif = np.divmod(cell_keys, n_motifs)
+        self.cell_ptr = np.append(cell_ptr, len(order))
+
+    # location_table() takes in no args.
+    # Function: Render the matrix as the prosite_locations table: one row per sequence (sorted), one column per motif (sorted),
+    # each cell the list of [Start, End, Score] of its hits, or "x" where the motif was not found.
+    # Output: pandas dataframe.
+    def location_table(self):
+        import numpy as np
+        import pandas as pd
+        cells = np.full((len(self.seq_names), len(self.motifs)), "x", dtype = object)
+        hits = [f"[{start}, {end}, {score!r}]" for start, end, score in zip(self.starts.tolist(), self.ends.tolist(), self.scores.tolist())]
+        ptr = self.cell_ptr.tolist()
+        for cell, (i, j) in enumerate(zip(self.cell_seq.tolist(), self.cell_motif.tolist())):
+            cells[i, j] = "[" + ", ".join(hits[ptr[cell]:ptr[cell + 1]]) + "]"
+        return pd.DataFrame(cells, columns = pd.Index(self.motifs, name = "Motif"))
+
+# parse_prosite_output() takes in 5 args: out_dir, out_prosite, list of output patmatmotifs files, whether to show the plot and table format.
 # Function: Parse output patmatmotifs files into a summary table, and plot a count plot of PROSITE motifs found.
+# The reports are read in one pass through read_prosite_reports(), the motif counts come from count_motifs(),
+# and the locations table is rendered from the sparse MotifMatrix of the hits.
+# Files ending in .parquet are read as summary tables of an earlier run, so a run written as Parquet can be reanalysed.
+# With table format "parquet", the summary and locations tables are written as typed Parquet instead of TSV, the locations as one list of (start, end, score) per sequence and motif.
 # Output: Summary table of PROSITE motif locations per sequence, count plot of PROSITE motifs found, and list of unique PROSITE motifs found.
-def parse_prosite_output(out_dir, out_prosite, prosite_output_list):
-    df_list = []
-    for file in prosite_output_list:
-        df = pd.read_csv(f"{out_dir}/{out_prosite}/{file}", sep = "\t", comment = "#", na_values = [""])
-        df.columns = df.columns.str.strip()
-        df_list.append(df)
-    summary_df = pd.concat(df_list, join = "outer", ignore_index = True)
-    summary_df.to_csv(f"{out_dir}/{out_prosite}/prosite_scan_summary.tsv", sep = "\t", header = True, index = False)
+def parse_prosite_output(out_dir, out_prosite, prosite_output_list, show = True, table_format = "tsv"):
+    import pandas as pd
+    import seaborn as sns
+    plt = get_pyplot()
+    reports = [f"{out_dir}/{out_prosite}/{file}" for file in prosite_output_list if not file.endswith(".parquet")]
+    tables = [read_table(f"{out_dir}/{out_prosite}/{file}") for file in prosite_output_list if file.endswith(".parquet")]
+    if reports or not tables:
+        tables.insert(0, read_prosite_reports(reports))
+    summary_df = pd.concat(tables, ignore_index = True) if len(tables) > 1 else tables[0]
+    if table_format == "parquet":
+        write_parquet(summary_df, f"{out_dir}/{out_prosite}/prosite_scan_summary.parquet", {"SeqName" : "string", "Start" : "int32", "End" : "int32", "Score" : "float32", "Strand" : "string", "Motif" : "string"})
+    else:
+        summary_df.to_csv(f"{out_dir}/{out_prosite}/prosite_scan_summary.tsv", sep = "\t", header = True, index = False)
     
-    motif_counts = summary_df["Motif"].value_counts()
-    plt.figure(figsize = (12, 6))
-    ax = sns.countplot(x = "Motif", data = summary_df, hue = "Motif", order = motif_counts.index)
-    plt.title("Count Plot of PROSITE Motifs Found")
-    for container in ax.containers:
-        ax.bar_label(container, fmt = "%d")
-    plt.tight_layout()
-    
-    print("Generating count_plot_motifs.png...")
-    plt.savefig(f"{out_dir}/{out_prosite}/count_plot_motifs.png")
-    print("Outputting Count Plot of PROSITE Motifs Found to terminal. Check plot, and close to continue!")
-    plt.show()
-    plt.close()
+    motif_counts = count_motifs(summary_df)
+    with PLOT_LOCK:
+        fig, ax = plt.subplots(figsize = (12, 6))
+        sns.barplot(x = "Motif", y = "count", data = motif_counts.reset_index(), hue = "Motif", order = motif_counts.index, ax = ax)
+        ax.set_title("Count Plot of PROSITE Motifs Found")
+        for container in ax.containers:
+            ax.bar_label(container, fmt = "%d")
+        fig.tight_layout()
+
+        print("Generating count_plot_motifs.png...")
+        fig.savefig(f"{out_dir}/{out_prosite}/count_plot_motifs.png")
+        show_plot(plt, "Outputting Count Plot of PROSITE Motifs Found to terminal. Check plot, and close to continue!", show)
+        plt.close(fig)
     
-    temp_df = summary_df.copy()
-    temp_df["Start, End, Score"] = temp_df.apply(lambda x: [x["Start"], x["End"], x["Score"]], axis = 1)
-    prosite_df = temp_df.pivot_table(index = "SeqName", columns = "Motif", values = "Start, End, Score", aggfunc = list, fill_value = "x")
-    prosite_df.to_csv(f"{out_dir}/{out_prosite}/prosite_locations.tsv", sep = "\t", header = True, index = False)
+    matrix = MotifMatrix(summary_df)
+    if table_format == "parquet":
+        write_locations_parquet(matrix, f"{out_dir}/{out_prosite}/prosite_locations.parquet")
+    else:
+        matrix.location_table().to_csv(f"{out_dir}/{out_prosite}/prosite_locations.tsv", sep = "\t", header = True, index = False)
     return summary_df, motif_counts.index.tolist()
-
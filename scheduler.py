@@ -0,0 +1,84 @@
+#!.venv/bin/python3
+
+import asyncio
+from instrument import get_tracer
+
+# Scheduler takes in 2 args: CPU budget and whether to run independent stages concurrently.
+# Function: Run pipeline stages as a dependency graph on an asyncio event loop. Each stage is a function of no args, added with the stages it depends on
+# and the number of CPUs it keeps busy. A stage starts as soon as its dependencies have finished and enough of the CPU budget is free,
+# and runs in a worker thread, so its external tools run alongside other stages. Stage results are kept in results, by stage name.
+# If a stage fails, the run fails fast: stages not yet started are cancelled, the tools of running stages are terminated through the tracer,
+# and the first error is raised once the running stages have stopped.
+# Without concurrency, stages run one at a time on the calling thread, in the order they were added (so plots can be shown and prompts answered).
+class Scheduler:
+    def __init__(self, cpu_budget, concurrent = True):
+        self.cpu_budget = max(1, cpu_budget)
+        self.concurrent = concurrent
+        self.stages = {}
+        self.results = {}
+        self.free = self.cpu_budget
+        self.failed = None
+
+    # add() takes in 4 args: stage name, stage function, list of stage names it depends on and CPUs it uses.
+    # Function: Add a stage to the graph. Dependencies must be added first, so the graph cannot have cycles. CPUs are capped at the budget.
+    def add(self, name, func, deps = (), cpus = 1):
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already scheduled")
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unscheduled stages: {', '.join(missing)}")
+        self.stages[name] = (func, list(deps), min(max(1, cpus), self.cpu_budget))
+
+    # run() takes in no args.
+    # Function: Run every stage added, concurrently where the graph and the CPU budget allow.
+    # Output: Dict of stage results, by stage name.
+    def run(self):
+        if not self.concurrent:
+            for name, (func, deps, cpus) in self.stages.items():
+                if name not in self.results:
+                    self.results[name] = func()
+            return self.results
+        return asyncio.run(self.run_graph())
+
+    async def run_graph(self):
+        budget = asyncio.Condition()
+        started = set()
+        tasks = {}
+
+        async def run_stage(name):
+            func, deps, cpus = self.stages[name]
+            for dep in deps:
+                await tasks[dep]
+            async with budget:
+                await budget.wait_for(lambda: self.free >= cpus or self.failed)
+                if self.failed:
+                    raise asyncio.CancelledError()
+                self.free -= cpus
+            started.add(name)
+            try:
+                self.results[name] = await asyncio.to_thread(func)
+            except Exception as e:
+                # Stop the tools of the other running stages at once, before the failed stage's CPUs are handed on.
+                if not self.failed:
+                    self.failed = name
+                    print(f"\nStage {name} failed: {e}\nStopping the other stages...")
+                    get_tracer().abort()
+                raise
+            finally:
+                async with budget:
+                    self.free += cpus
+                    budget.notify_all()
+
+        for name in self.stages:
+            if name not in self.results:
+                tasks[name] = asyncio.ensure_future(run_stage(name))
+        pending = set(tasks.values())
+        while pending and not self.failed:
+            done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_EXCEPTION)
+        if self.failed:
+            for name, task in tasks.items():
+                if name not in started:
+                    task.cancel()
+            await asyncio.gather(*pending, return_exceptions = True)
+            raise tasks[self.failed].exception()
+        return self.results
@@ -0,0 +1,347 @@
+#!.venv/bin/python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from batch import run_job, normalize_job, worker_options
+from cache import configure_cache
+from http_client import configure_client, shared_rate_state
+from instrument import set_trace_listener
+from main import add_pipeline_arguments, pipeline_options, valid_email, PIPELINE_OPTIONS
+from record_store import RecordStore
+
+# Job API, served on a local TCP port or Unix socket. Request and response bodies are JSON.
+#   POST   /jobs                      Submit a job: {"family", "taxon", "sample_size", "scan_size", and optionally "name", "email", "options" : {any of PIPELINE_OPTIONS}}.
+#   GET    /jobs                      List the jobs, without their events.
+#   GET    /jobs/<id>                 Job status, timing and per-stage results.
+#   GET    /jobs/<id>/events          Stream the job's progress as JSON lines (stage starts, stage and process events, job status) until it ends.
+#   GET    /jobs/<id>/records/<uid>   One record of a finished job, from its record store.
+#   DELETE /jobs/<id>                 Cancel a queued job.
+# e.g. curl --unix-socket pipeline.sock -d '{"family" : "Pkinase", "taxon" : "Homo sapiens", "sample_size" : 500, "scan_size" : 50}' http://localhost/jobs
+DONE_STATUS = {"ok", "failed", "cancelled"}
+
+# Options the service sets for every job: the CPU share of each worker, and shared paths, made absolute by worker_options().
+SERVICE_OPTIONS = {"threads", "cpu_budget", "prosite_dat", "blast_store_dir", "catalogue_dir"}
+
+# JobConflict is raised when a job is submitted while another job of the same name (and so the same directory) is queued or running.
+class JobConflict(RuntimeError):
+    pass
+
+_events = None
+_job_id = None
+
+# init_service_worker() takes in 3 args: progress queue, dict of host to shared rate limiter state and response cache settings.
+# Function: Set up a long-lived worker process: share the HTTP rate limiters with the other workers, send the trace events of the running job
+# to the progress queue, and import the tabular and plotting libraries once, so no job pays for them.
+# Compiled PROSITE patterns (load_prosite_patterns) and the response cache also stay warm in the worker from one job to the next.
+def init_service_worker(events, shared, cache_kwargs):
+    global _events
+    _events = events
+    configure_client(shared = shared)
+    configure_cache(**cache_kwargs)
+    set_trace_listener(lambda event: _events.put((_job_id, event)))
+    import pandas, seaborn
+    from plotting import get_pyplot
+    get_pyplot()
+
+# run_service_job() takes in 6 args: job id, job dict, service output directory, email, pipeline tuning options and response cache settings.
+# Function: Run one job in a worker process through run_job(), reporting its start to the progress queue.
+# Output: Dict of job status and timing.
+def run_service_job(job_id, job, out_dir, email, options, cache_kwargs):
+    global _job_id
+    _job_id = job_id
+    _events.put((job_id, {"type" : "job", "status" : "running"}))
+    try:
+        return run_job(job, out_dir, email, options, cache_kwargs)
+    finally:
+        _job_id = None
+
+# PipelineService takes in 6 args: service output directory, default email, number of worker processes, CPU thread cap, pipeline tuning options and response cache settings.
+# Function: Queue submitted jobs and run them on a pool of long-lived worker processes, one job directory per job name as in batch mode.
+# A job submitted again reuses its directory, so with the workers warm, stages already completed are skipped in well under a second.
+# Trace events sent by the workers are collected per job by a pump thread, for job status and progress streams.
+# A finished job's events are dropped once no stream is reading them, keeping only its final status event, so the service does not grow with every job it runs.
+# Record stores of finished jobs are kept loaded (memory-mapped), for record lookups.
+class PipelineService:
+    def __init__(self, out_dir, email, workers, max_threads, options, cache_kwargs):
+        self.out_dir = os.path.abspath(out_dir)
+        os.makedirs(self.out_dir, exist_ok = True)
+        self.email = email
+        # At least one thread per worker, so no more workers than the thread cap.
+        workers = self.workers = max(1, min(workers, max_threads))
+        self.options = worker_options(options, workers, max_threads)
+        self.cache_kwargs = cache_kwargs
+        self.jobs = {}
+        self.stores = {}
+        self.condition = threading.Condition()
+        # A manager queue, so a worker's events are delivered before its job's result, and the final job event is always last.
+        self.manager = multiprocessing.Manager()
+        self.events = self.manager.Queue()
+        self.executor = ProcessPoolExecutor(max_workers = workers, initializer = init_service_worker, initargs = (self.events, shared_rate_state(), cache_kwargs))
+        # Start the workers now, so they are warm for the first job.
+        self.executor.submit(int).result()
+        self.pump_thread = threading.Thread(target = self.pump, daemon = True)
+        self.pump_thread.start()
+
+    # submit() takes in an arg: job request dict.
+    # Function: Check the request and queue the job. Raises ValueError for a bad request, and JobConflict if a job of the same name is not finished.
+    # Output: Job dict.
+    def submit(self, request):
+        if not request.get("family") or not request.get("taxon"):
+            raise ValueError("A job needs both a family and a taxon.")
+        overrides = request.get("options") or {}
+        unknown = sorted(set(overrides) - set(PIPELINE_OPTIONS))
+        if unknown:
+            raise ValueError(f"Unknown pipeline options: {', '.join(unknown)}")
+        fixed = sorted(set(overrides) & SERVICE_OPTIONS)
+        if fixed:
+            raise ValueError(f"Pipeline options set by the service cannot be changed by a job: {', '.join(fixed)}")
+        email = request.get("email") or self.email
+        if not valid_email(email):
+            raise ValueError("Please input a valid email.")
+        job = normalize_job({key : request.get(key) for key in ["family", "taxon", "sample_size", "scan_size", "name"]})
+        # Jobs run without a terminal, so the sizes cannot be prompted for.
+        if job["sample_size"] is None or job["scan_size"] is None:
+            raise ValueError("A job needs both a sample_size and a scan_size.")
+        options = {**self.options, **overrides}
+
+        with self.condition:
+            if any(other["name"] == job["name"] and other["status"] not in DONE_STATUS for other in self.jobs.values()):
+                raise JobConflict(f"Job {job['name']} is already queued or running.")
+            job_id = str(len(self.jobs) + 1)
+            self.jobs[job_id] = {**job, "id" : job_id, "status" : "queued", "submitted" : time.time(), "seconds" : None, "out_dir" : "", "error" : "", "stages" : {}, "events" : [], "streams" : 0}
+            future = self.executor.submit(run_service_job, job_id, job, self.out_dir, email, options, self.cache_kwargs)
+            self.jobs[job_id]["future"] = future
+        future.add_done_callback(lambda future: self.finish(job_id, future))
+        return self.view(job_id)
+
+    # finish() takes in 2 args: job id and its future.
+    # Function: Send the job's final status through the progress queue, behind the events of its worker.
+    def finish(self, job_id, future):
+        if future.cancelled():
+            result = {"status" : "cancelled"}
+        else:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status" : "failed", "error" : str(e) or type(e).__name__}
+        self.events.put((job_id, {"type" : "job", **result}))
+
+    # pump() takes in no args.
+    # Function: Collect progress events from the workers into their jobs, until the None sentinel.
+    def pump(self):
+        while True:
+            item = self.events.get()
+            if item is None:
+                return
+            job_id, event = item
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                if event["type"] == "job":
+                    job["status"] = event["status"]
+                    for key in ["seconds", "out_dir", "error"]:
+                        if key in event:
+                            job[key] = event[key]
+                elif event["type"] == "stage_start":
+                    job["stages"][event["name"]] = {"status" : "running"}
+                elif event["type"] == "stage":
+                    job["stages"][event["name"]] = {key : event[key] for key in ["status", "wall", "cpu", "peak_rss_mb"]}
+                job["events"].append(event)
+                self.trim(job)
+                self.condition.notify_all()
+
+    # trim() takes in an arg: job dict.
+    # Function: Drop the events of a finished job no stream is reading, keeping its final status event. Called with the condition held.
+    def trim(self, job):
+        if job["status"] in DONE_STATUS and job["streams"] == 0:
+            job["events"] = job["events"][-1:]
+
+    # view() takes in an arg: job id.
+    # Output: Copy of the job dict for a response, without its events and future. Raises KeyError for an unknown job.
+    def view(self, job_id):
+        with self.condition:
+            job = self.jobs[job_id]
+            return {key : value for key, value in job.items() if key not in ["events", "future", "streams"]}
+
+    def list_jobs(self):
+        with self.condition:
+            return [self.view(job_id) for job_id in self.jobs]
+
+    # cancel() takes in an arg: job id.
+    # Output: True if the job was still queued and is cancelled, else False.
+    def cancel(self, job_id):
+        return self.jobs[job_id]["future"].cancel()
+
+    # stream() takes in 2 args: job id and function writing a line.
+    # Function: Write the job's events as JSON lines, those already collected first, then each as it arrives, until the job has finished.
+    # For a finished job no longer streamed, only its final status event is left.
+    def stream(self, job_id, write):
+        with self.condition:
+            job = self.jobs[job_id]
+            job["streams"] += 1
+        sent = 0
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: len(job["events"]) > sent or job["status"] in DONE_STATUS, timeout = 30)
+                    events = job["events"][sent:]
+                    done = job["status"] in DONE_STATUS
+                for event in events:
+                    write(json.dumps(event) + "\n")
+                sent += len(events)
+                if done:
+                    return
+        finally:
+            with self.condition:
+                job["streams"] -= 1
+                self.trim(job)
+
+    # record() takes in 2 args: job id and uid.
+    # Function: Look up a record of a finished job. The job's record store is loaded on first use and kept, and reloaded if the job rebuilt it.
+    # Output: Protein sequence dict. Raises KeyError for an unknown job or uid, and ValueError if the job has no record store yet.
+    def record(self, job_id, uid):
+        out_dir = self.view(job_id)["out_dir"]
+        records_path = f"{out_dir}/{os.path.basename(out_dir)}_records"
+        if not out_dir or not os.path.exists(f"{records_path}/offsets.npy"):
+            raise ValueError(f"Job {job_id} has no records yet.")
+        mtime = os.path.getmtime(f"{records_path}/offsets.npy")
+        with self.condition:
+            if records_path not in self.stores or self.stores[records_path][0] != mtime:
+                self.stores[records_path] = (mtime, RecordStore.load(records_path))
+            store = self.stores[records_path][1]
+        return store.get(uid)
+
+    # close() takes in no args.
+    # Function: Cancel queued jobs, wait for running ones, and stop the workers and the pump thread.
+    def close(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
+        self.events.put(None)
+        self.pump_thread.join()
+        self.manager.shutdown()
+
+# make_handler() takes in an arg: PipelineService.
+# Function: Build the HTTP request handler of the job API.
+# Output: HTTP request handler class.
+def make_handler(service):
+    class ServiceHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self):
+            return urlsplit(self.path).path.strip("/").split("/")
+
+        def do_GET(self):
+            parts = self.route()
+            try:
+                if parts == ["jobs"]:
+                    self.reply(200, service.list_jobs())
+                elif len(parts) == 2 and parts[0] == "jobs":
+                    self.reply(200, service.view(parts[1]))
+                elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+                    service.view(parts[1])
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.end_headers()
+                    def write(line):
+                        self.wfile.write(line.encode())
+                        self.wfile.flush()
+                    service.stream(parts[1], write)
+                elif len(parts) == 4 and parts[0] == "jobs" and parts[2] == "records":
+                    self.reply(200, service.record(parts[1], parts[3]))
+                else:
+                    self.reply(404, {"error" : f"No such endpoint: {self.path}"})
+            except KeyError as e:
+                self.reply(404, {"error" : f"Not found: {e}"})
+            except ValueError as e:
+                self.reply(409, {"error" : str(e)})
+
+        def do_POST(self):
+            if self.route() != ["jobs"]:
+                self.reply(404, {"error" : f"No such endpoint: {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                self.reply(202, service.submit(request))
+            except JobConflict as e:
+                self.reply(409, {"error" : str(e)})
+            except (ValueError, TypeError, AttributeError) as e:
+                self.reply(400, {"error" : str(e)})
+
+        def do_DELETE(self):
+            parts = self.route()
+            if len(parts) != 2 or parts[0] != "jobs":
+                self.reply(404, {"error" : f"No such endpoint: {self.path}"})
+            elif parts[1] not in service.jobs:
+                self.reply(404, {"error" : f"Not found: {parts[1]}"})
+            elif service.cancel(parts[1]):
+                self.reply(200, service.view(parts[1]))
+            else:
+                self.reply(409, {"error" : f"Job {parts[1]} is not queued, only queued jobs can be cancelled."})
+    return ServiceHandler
+
+# UnixHTTPServer: HTTP server on a Unix socket, one thread per request like ThreadingHTTPServer.
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# build_parser() takes in no args.
+# Function: Define the command line switches of service mode.
+# Output: argparse parser.
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Run the pipeline as a long-lived service, taking jobs over a local HTTP API.")
+    parser.add_argument("--email", required = True, help = "Email sent with NCBI requests, unless a job gives its own.")
+    parser.add_argument("--port", type = int, default = 8765, help = "Listen on 127.0.0.1 at this port (default: %(default)s).")
+    parser.add_argument("--socket", help = "Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--out", default = "service_runs", help = "Service output directory, one subdirectory per job name (default: %(default)s).")
+    parser.add_argument("--workers", type = int, default = max(1, (os.cpu_count() or 1) // 4), help = "Number of jobs run at once.")
+    parser.add_argument("--max-threads", type = int, default = os.cpu_count() or 1, help = "Total CPU threads given to external tools across all jobs.")
+    add_pipeline_arguments(parser)
+    return parser
+
+# main() takes in an optional arg: list of command line arguments.
+# Function: Start the workers and serve the job API until interrupted.
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    if not valid_email(args.email):
+        sys.exit("Please input a valid email.")
+
+    cache_kwargs = {"cache_dir" : os.path.abspath(args.cache_dir), "offline" : args.offline, "enabled" : not args.no_cache}
+    service = PipelineService(args.out, args.email, args.workers, args.max_threads, pipeline_options(args), cache_kwargs)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, make_handler(service))
+        print(f"Pipeline service listening on {args.socket} with {service.workers} workers.")
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(service))
+        print(f"Pipeline service listening on http://127.0.0.1:{server.server_address[1]} with {service.workers} workers.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping the pipeline service...")
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
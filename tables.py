@@ -0,0 +1,79 @@
+#!.venv/bin/python3
+
+import numpy as np
+from record_store import COLUMNS
+
+TABLE_FORMATS = ["tsv", "parquet"]
+
+# import_pyarrow() takes in no args.
+# Function: Import the optional pyarrow package, needed only for Parquet output.
+# Output: pyarrow module.
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet tables need the optional pyarrow package. Install it with: pip install pyarrow")
+    return pyarrow
+
+# write_parquet() takes in 3 args: pandas dataframe, Parquet filepath and optional dict of column name to dtype.
+# Function: Write the dataframe as a Parquet file, with the columns cast to the given dtypes first.
+def write_parquet(df, parquet_path, dtypes = None):
+    import_pyarrow()
+    if dtypes:
+        df = df.astype({column : dtype for column, dtype in dtypes.items() if column in df.columns})
+    df.to_parquet(parquet_path, index = False)
+
+# read_table() takes in an arg: table filepath, and keyword arguments for pandas.read_csv.
+# Function: Read a table written by the pipeline, as Parquet if the filename ends in .parquet, else as tab-separated text.
+# Output: pandas dataframe.
+def read_table(path, **kwargs):
+    import pandas as pd
+    if path.endswith(".parquet"):
+        import_pyarrow()
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep = "\t", **kwargs)
+
+# write_records_parquet() takes in 2 args: RecordStore and Parquet filepath.
+# Function: Export the record store as a typed table (uid, description, species, sequence, length).
+# The string columns are built straight from the store's byte buffers and offsets, without a copy per record.
+def write_records_parquet(store, parquet_path):
+    pa = import_pyarrow()
+    arrays = [pa.LargeStringArray.from_buffers(len(store), pa.py_buffer(np.ascontiguousarray(store.offsets[j])), pa.py_buffer(store.buffers[column])) for j, column in enumerate(COLUMNS)]
+    arrays.append(pa.array(store.lengths().astype(np.int32)))
+    pa.parquet.write_table(pa.Table.from_arrays(arrays, names = COLUMNS + ["length"]), parquet_path)
+
+# write_locations_parquet() takes in 2 args: MotifMatrix of PROSITE hits and Parquet filepath.
+# Function: Write the motif locations as one row per sequence and one column per motif.
+# Each cell is a list of (start, end, score) structs, or null where the motif was not found. The list offsets of a motif column
+# come straight from the matrix's per-cell hit counts.
+def write_locations_parquet(matrix, parquet_path):
+    pa = import_pyarrow()
+    location_type = pa.struct([("start", pa.int32()), ("end", pa.int32()), ("score", pa.float32())])
+    arrays = [pa.array(list(matrix.seq_names), type = pa.string())]
+    for j in range(len(matrix.motifs)):
+        cells = matrix.cell_motif == j
+        counts = np.zeros(len(matrix.seq_names), dtype = np.int32)
+        counts[matrix.cell_seq[cells]] = np.diff(matrix.cell_ptr)[cells]
+        hits = matrix.hit_motifs == j
+        values = pa.StructArray.from_arrays([pa.array(matrix.starts[hits].astype(np.int32)), pa.array(matrix.ends[hits].astype(np.int32)), pa.array(matrix.scores[hits].astype(np.float32))], fields = list(location_type))
+        offsets = pa.array(np.concatenate([[0], np.cumsum(counts)]).astype(np.int32))
+        arrays.append(pa.ListArray.from_arrays(offsets, values, mask = pa.array(counts == 0)))
+    pa.parquet.write_table(pa.Table.from_arrays(arrays, names = ["SeqName"] + list(matrix.motifs)), parquet_path)
+
+# write_hits_parquet() takes in 3 args: list of sequence names, numpy structured array of BLAST hits and Parquet filepath.
+# Function: Write the typed hit table. query and subject are dictionary-encoded against the name list, as they are indexed in the array.
+def write_hits_parquet(names, hits, parquet_path):
+    pa = import_pyarrow()
+    dictionary = pa.array(names, type = pa.string())
+    arrays = [pa.DictionaryArray.from_arrays(pa.array(hits[field]), dictionary) if field in ["query", "subject"] else pa.array(hits[field]) for field in hits.dtype.names]
+    pa.parquet.write_table(pa.Table.from_arrays(arrays, names = list(hits.dtype.names)), parquet_path)
+
+# write_hits_tsv() takes in 4 args: list of sequence names, numpy structured array of BLAST hits, TSV filepath and rows written per slice.
+# Function: Write the hit table as TSV, with query and subject names and floats in %g form.
+# Rows are converted to Python values one slice of the array at a time, so the whole table is never held as tuples.
+def write_hits_tsv(names, hits, tsv_path, block_size = 100000):
+    with open(tsv_path, "w") as file:
+        file.write("\t".join(hits.dtype.names) + "\n")
+        for first in range(0, len(hits), block_size):
+            file.writelines(f"{names[hit[0]]}\t{names[hit[1]]}\t" + "\t".join(f"{x:g}" if isinstance(x, float) else str(x) for x in hit[2:]) + "\n" for hit in hits[first:first + block_size].tolist())